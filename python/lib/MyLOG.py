@@ -20,24 +20,39 @@ package MyLOG;
 require Exporter;
 use Sys::Hostname;
 use File::Basename;
+use Fcntl qw(:flock);
+use IO::Handle;
+use POSIX ();
+use Compress::Zlib ();
+use IO::Select;
+use IO::Socket::INET;
+use Socket qw(IPPROTO_TCP TCP_NODELAY);
+use Time::HiRes ();
+use Config;
+use Cwd ();
+use Digest::MD5 ();
 use strict;
 
 our @ISA    = qw(Exporter);
 our @EXPORT = qw(send_customized_email send_email set_email get_email log_email
                  mylog mydbg myrec mytrim get_country get_hpss_command
                  show_usage check_hosts get_host get_short_host
-                 get_local_command get_remote_command get_sync_command
+                 get_local_command get_remote_command get_sync_command close_ssh_sessions
                  current_datetime cmdlog %MYLOG $MYATTR %WTYPE %MTYPE
                  SUCCESS FINISH FAILURE MSGLOG WARNLG EXITLG LOGWRN LOGEXT
                  WRNEXT LGWNEX LGWNEM LWEMEX EMLLOG ERRLOG LOGERR DOSUDO
                  LGEREX LGEREM DOLOCK ENDLCK AUTOID DODFLT SNDEML RETMSG FRCLOG
                  MISLOG SEPLIN BRKLIN EMLTOP EMLSUM EMEROL EMLALL NOTLOG
-                 mysystem tosystem mytar join_paths valid_command add_carbon_copy
+                 mysystem mysystem_stream tosystem run_commands run_on_hosts set_retry_policy
+                 clear_command_cache report_command_stats mytar join_paths valid_command
+                 add_carbon_copy get_carbon_copy
                  set_suid untaint_suid untaint_string untaint_hash untaint_array
                  get_environment convert_chars escape_chars
                  break_long_string get_command set_specialist_environments
                  replace_environments current_process_info check_process_host
-                 argv_to_string get_lsf_host set_lsf_host seconds_to_string_time);
+                 argv_to_string get_lsf_host set_lsf_host seconds_to_string_time
+                 query_log_records query_logs search_emails flush_email_digests
+                 run_email_spool set_debug_level add_metric add_metric_time dump_metrics);
 
 # define some constants for logging actions
 use constant MSGLOG => (0x0001);   # logging message
@@ -78,7 +93,7 @@ use constant FAILURE => 0;   # Unsuccessful function call
 
 our %MYLOG = (  # more defined in untaint_suid() with environment variables
    EMLADDR  => '',
-   CCDADDR  => '',
+   CCDADDR  => '',       # carbon copies, kept in sync with %CCDADDRS
    SEPLINE  => "===========================================================\n",
    TWOGBS   => 2147483648,
    MINSIZE  => 100,      # minimal file size in bytes to be valid
@@ -87,8 +102,10 @@ our %MYLOG = (  # more defined in untaint_suid() with environment variables
    ERRCNT   => 0,        # record number of errors for email
    ERRMSG   => '',       # record error message for email
    SUMMSG   => '',       # record summary message for email
-   EMLMSG   => '',       # record detail message for email
+   EMLMSG   => '',       # record detail message for email, up to EMLMEM bytes in memory
    PRGMSG   => '',       # record progressing message for email, replaced each time
+   EMLSKIP  => 0,        # number of messages not recorded for email buffer over EMLMAX
+   DUPWINS  => {ERRLOG => 60, WARNLG => 60, EMLLOG => 300}, # seconds to count repeated messages
    GMTZ     => 0,        # 0 - use local time, 1 - use greenwich mean time
    NOLEAP   => 0,        # 1 - skip 29 of Feburary while add days to date
    GMTDIFF  => 6,        # gmt is 6 hours ahead of us
@@ -112,6 +129,9 @@ our %MYLOG = (  # more defined in untaint_suid() with environment variables
    HPSSLMT  => 15,       # up limit of HPSS streams 
    NOQUIT   => 0,        # do not quit if this flag is set for daemons
    TIMEOUT  => 15,       # default timeout (in seconds) for tosystem()
+   KILLWAIT => 5,        # seconds to wait after TERM before KILL a timed out command
+   CMDTIME  => 0,        # timeout (in seconds) of a mysystem() call, all retries included, 0 none
+   SYSRETRY => '',       # retry policy name or hash for commands run by mysystem()
    SYSERR   => undef,    # cache the error message generated inside mysystem()
    ERR2STD  => undef,    # if non-empty reference to array of strings, change stderr to stdout if match
    STD2ERR  => undef,    # if non-empty reference to array of strings, change stdout to stderr if match
@@ -140,6 +160,12 @@ our %MTYPE = (
 );
 
 our %COMMANDS = ();    # caching valid command
+# shell builtins and keywords, run by run_command() via '/bin/sh -c' as they have
+# no executables, or behave differently from them
+our %SHBUILTINS = map {$_ => 1} qw(. : ! [ alias bg break case cd command continue declare do done elif
+   else esac eval exec exit export false fc fg fi for function getopts hash if jobs kill let local newgrp
+   pwd read readonly return select set shift source test then time times trap true type typeset ulimit
+   umask unalias unset until wait while echo printf);
 our (@LSFHOSTS, %LSFSTATS);    # caching lsf host info
 
 our %CPID = (
@@ -160,6 +186,115 @@ our %MYDOWN = (
    curdowns   => undef,    # reference to hash of system currently down, hpss => UntilDateTime
 );
 
+# compiled debug level filter of $MYLOG{DBGLEVEL}, recompiled once it is changed
+our %DBGFILTER = (
+   spec  => "",         # the $MYLOG{DBGLEVEL} compiled
+   min   => 0,          # lowest level of all ranges, for quick filtering
+   max   => -1,         # highest level of all ranges
+   all   => undef,      # [min, max] levels for all callers
+   files => {},         # caller file name => [min, max] levels
+);
+
+# flight recorder of the last $MYLOG{DBGRING} mydbg() records of any levels
+our @DBGRING = ();   # [time, level, message, reference to @locs] of records
+our $DBGRIDX = 0;    # number of records recorded since last dumped
+
+# in-process metrics of logging, commands and email, exported by dump_metrics()
+our %METRICS = (
+   counters   => {},    # name => {labels => count}
+   histograms => {},    # name => {labels => {counts => [per bucket], sum => secs, count => n}}
+);
+our @METRICBKTS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 1800);   # in seconds
+
+# detail messages for email spilled from $MYLOG{EMLMSG} over $MYLOG{EMLMEM} bytes
+our %EMLBUF = (
+   head    => "",       # EMLTOP messages, joined before the details by take_email()
+   spilled => 0,        # bytes of detail messages spilled to file
+   spill   => "",       # spill file name, under $MYLOG{TMPPATH}
+   spfh    => undef,    # handle of the spill file
+   pid     => 0,        # process that created the spill file
+);
+
+# carbon copies for email, added by add_carbon_copy() and rendered by send_email()
+our %CCDADDRS = (list => [], seen => {}, str => '');   # recipient set, see add_email_recipients();
+                                                       # str is $MYLOG{CCDADDR} it is synced with
+
+# emails held for digests while $MYLOG{EMLDIGEST} is set, keyed by sender and To/Cc recipients
+our %EMLDIGESTS = ();   # key => {time, receiver, cc, sender, logact, msgs => [[time, subject, msg]]}
+
+our $EMLSPOOLSEQ = 0;   # number of emails spooled by this process
+
+# result of the last command run by mysystem(), as returned by run_command() with
+# the command added; check $SYSRESULT{timedout} for timeout of tosystem()
+our %SYSRESULT = ();
+our $CMDPGRP = 0;   # process group of the command running with a timeout
+
+# retry policies of commands run by mysystem(), see set_retry_policy()
+our %RETRYPOLICIES = (
+   default => {attempts => 2, backoff => 6, factor => 2, maxwait => 300, jitter => 0, timeout => 0,
+               codes => [], retry => [], fatal => [], breaker => 0, cooldown => 300},
+);
+our @RETRYRULES = ();   # [command pattern, policy name]
+our %CIRCUITS = ();     # command target => {fails, opened (time), cooldown}, of this process
+our $CIRCUITRECS;       # [target, result, breaker, cooldown] recorded by a run_commands() worker,
+                        # replayed by the parent into its %CIRCUITS
+
+# results of commands run by mysystem() with $cmdopt 512, keyed by the user, the
+# $cmdopt bits of output, the working directory, a digest of the environment and
+# the command; see command_cache_get()
+our %CMDCACHE = (
+   entries => {},   # key => {stdout, syserr, time, used (sequence), files (path => mtime), size}
+   size    => 0,    # total bytes of the cached results
+   seq     => 0,    # sequence of the cache uses, for least recently used eviction
+);
+
+# wait4() system call number to reap a command with its resource usage, 0 to use
+# waitpid() and times(), which give CPU times only; for the 64-bit Linux ABIs only,
+# not x32 (x86_64-linux-gnux32) whose system call numbers and longs differ
+our $WAIT4 = 0;
+if($Config{ptrsize} == 8 && $Config{longsize} == 8) {
+   if($Config{archname} =~ /^x86_64-linux(-gnu)?(-thread-multi)?$/) {
+      $WAIT4 = 61;
+   } elsif($Config{archname} =~ /^aarch64-linux(-gnu)?(-thread-multi)?$/) {
+      $WAIT4 = 260;
+   }
+}
+
+# persistent SMTP session to $MYLOG{SMTPHOST}, reused by all emails sent
+our %SMTPCONN = (
+   sock  => undef,      # connected socket, undef if not connected
+   pid   => 0,          # process that opened the socket
+   host  => "",         # host:port connected to
+   pipe  => 0,          # 1 if the server supports PIPELINING
+   rbuf  => "",         # buffered reply bytes not parsed yet
+   error => "",         # last SMTP error
+);
+
+# multiplexed ssh sessions to remote hosts, see ssh_session()
+our %SSHSESSIONS = ();   # host => {sock (control socket), checked (time), failed (time)}
+
+# repeated messages counted by normalized signatures, for suppressing message storms
+our %MSGDUPS = ();
+our $DUPTIME = 0;    # time the expired repeated messages are reported last time
+
+# cache opened log file handles and buffered log records, keyed by file names
+our %LOGFILES = (
+   pid     => $$,       # process that opens the handles and owns the buffers
+   ftime   => time,     # time the buffered records are flushed last time
+   handles => {},       # file name => opened file handle for appending
+   buffers => {},       # file name => buffered records to be written
+   indexes => {},       # file name => index info of the buffered records
+   writer  => 0,        # pid of the background log writer if $MYLOG{LOGASYNC}
+   pipe    => undef,    # handle to send queued records to the log writer
+   wpipe   => undef,    # handle that reads EOF once the log writer quits
+   queue   => [],       # records queued for the log writer, in frames
+   pending => "",       # part of a record frame not sent to the writer yet
+   dropped => 0,        # number of records dropped for full queue
+   nowrite => 0,        # 1 if failed to start the log writer
+   spill   => "",       # file the records are spilled to, till the queue drained
+   spillno => 0,        # sequence number of the spill files
+);
+
 # untaint info for setuid
 untaint_suid();
 
@@ -190,13 +325,18 @@ sub get_call_trace {
 #
 # $logact = 0/undef - replace
 #
+# EMLTOP messages are kept in their own head segment, and detail messages over
+# $MYLOG{EMLMEM} bytes are spilled to a file under $MYLOG{TMPPATH}; $MYLOG{EMLMAX}
+# limits the bytes buffered, in memory and spilled, messages over it are counted
+# in $MYLOG{EMLSKIP} only
+#
 sub set_email {
    my ($msg, $logact) = @_;
 
    if($logact && $msg) {
       if($logact&EMLTOP) {
          if($MYLOG{PRGMSG}) {
-            $msg = $MYLOG{PRGMSG} ."\n" . $msg;
+            $msg = $MYLOG{PRGMSG} . "\n" . $msg;
             $MYLOG{PRGMSG} = "";
          }
          if($MYLOG{ERRCNT} == 0) {
@@ -211,18 +351,25 @@ sub set_email {
             $MYLOG{ERRCNT} = 0;
             $MYLOG{ERRMSG} = "";
          }
+         $msg .= email_skip_note();
          if($MYLOG{SUMMSG}) {
             $msg .= $MYLOG{SEPLINE};
             $msg .= "Summary:\n" if($MYLOG{EMLLOG});
             $msg .= $MYLOG{SUMMSG};
          }
-         if($MYLOG{EMLMSG}) {
+         if(email_pending()) {
             $msg .= $MYLOG{SEPLINE};
             $msg .= "Detail Information:\n" if($MYLOG{SUMMSG});
          }
-         $MYLOG{EMLMSG} = $msg . $MYLOG{EMLMSG};    # prepend
+         $EMLBUF{head} = $msg . $EMLBUF{head};    # prepend to the head segment
          $MYLOG{SUMMSG} = "";   # in case not
       } else {
+         if(length($MYLOG{EMLMSG}) + length($MYLOG{SUMMSG}) + length($MYLOG{ERRMSG}) +
+            length($EMLBUF{head}) + $EMLBUF{spilled} + length($msg) > $MYLOG{EMLMAX}) {   # email_size() inline
+            $MYLOG{ERRCNT}++ if($logact&ERRLOG);
+            $MYLOG{EMLSKIP}++;   # email buffer is full
+            return;
+         }
          if($logact&ERRLOG) { # record error for email summary
             $MYLOG{ERRCNT}++;
             $MYLOG{ERRMSG} .= $MYLOG{ERRCNT} . ". " . $msg;
@@ -234,20 +381,150 @@ sub set_email {
             $MYLOG{SUMMSG} .= $msg; # append
          }
          if($logact&EMLLOG) {
-            if($MYLOG{EMLMSG}) {
+            if(length($MYLOG{EMLMSG}) || $EMLBUF{spilled}) {
                $MYLOG{EMLMSG} .= "\n" if($logact&BRKLIN);
                $MYLOG{EMLMSG} .= $MYLOG{SEPLINE} if($logact&SEPLIN);
             }
             $MYLOG{EMLMSG} .= $msg; # append
+            spill_email() if(length($MYLOG{EMLMSG}) > $MYLOG{EMLMEM});
          }
       }
    } elsif(! defined $msg) {
-      $MYLOG{EMLMSG} = "";
+      clear_email();
+   }
+}
+
+#
+# return the bytes of messages buffered for email in memory, not counting the spilled ones
+#
+sub email_size {
+   return length($MYLOG{EMLMSG}) + length($MYLOG{SUMMSG}) + length($MYLOG{ERRMSG}) + length($EMLBUF{head});
+}
+
+#
+# return true if any head or detail message is buffered for email
+#
+sub email_pending {
+   return (length($MYLOG{EMLMSG}) || length($EMLBUF{head}) || $EMLBUF{spilled}) ? 1 : 0;
+}
+
+#
+# move the detail messages of $MYLOG{EMLMSG} to the spill file $MYLOG{TMPPATH}/myemail.PID.spill;
+# keep them in memory if the file cannot be written
+#
+sub spill_email {
+   my $fh;
+
+   if(!$EMLBUF{spfh} || $EMLBUF{pid} != $$) {
+      $EMLBUF{spill} = "$MYLOG{TMPPATH}/myemail.$$.spill";
+      $EMLBUF{pid} = $$;
+      $EMLBUF{spilled} = 0;
+      open($fh, "+>", $EMLBUF{spill}) or return FAILURE;
+      $EMLBUF{spfh} = $fh;
+   }
+   print {$EMLBUF{spfh}} $MYLOG{EMLMSG} or return FAILURE;
+   $EMLBUF{spilled} += length($MYLOG{EMLMSG});
+   $MYLOG{EMLMSG} = "";
+
+   return SUCCESS;
+}
+
+#
+# clear the head and detail messages buffered for email, and the spill file
+#
+sub clear_email {
+   $MYLOG{EMLMSG} = "";
+   $EMLBUF{head} = "";
+   if($EMLBUF{spfh}) {
+      close($EMLBUF{spfh});
+      unlink $EMLBUF{spill} if($EMLBUF{pid} == $$);
+      $EMLBUF{spfh} = undef;
    }
+   $EMLBUF{spilled} = 0;
 }
 
+#
+# return the head and detail messages buffered for email as one string;
+# the spilled details are read back, so send_email() uses take_email() instead
+#
 sub get_email {
-   return $MYLOG{EMLMSG};
+   my $str = "";
+
+   return $EMLBUF{head} . $MYLOG{EMLMSG} if(!$EMLBUF{spilled});
+   email_chunks(take_email(1), sub { $str .= $_[0]; return 1; });
+
+   return $str;
+}
+
+#
+# return the email buffered by set_email() and detach it from the buffer: the head
+# and $MYLOG{EMLMSG} joined in a string, or a reference to parts [head, [spill
+# handle, 0], tail] if spilled; the spill file is unlinked and removed when the
+# last reference is gone
+#
+# $keep - true to leave the messages in the buffer
+#
+sub take_email {
+   my ($keep) = @_;
+   my ($fh, $msg);
+
+   if(!$EMLBUF{spilled} || !$EMLBUF{spfh}) {
+      $msg = $EMLBUF{head} . $MYLOG{EMLMSG};
+      $EMLBUF{head} = $MYLOG{EMLMSG} = "" if(!$keep);
+      return $msg;
+   }
+   $fh = $EMLBUF{spfh};
+   $fh->flush();
+   $msg = [$EMLBUF{head}, [$fh, 0], $MYLOG{EMLMSG}];
+   if(!$keep) {
+      unlink $EMLBUF{spill} if($EMLBUF{pid} == $$);
+      $EMLBUF{spfh} = undef;
+      $EMLBUF{spilled} = 0;
+      $EMLBUF{head} = $MYLOG{EMLMSG} = "";
+   }
+
+   return $msg;
+}
+
+#
+# pass the text of an email to $code in chunks, stop if $code returns false; the email is
+# a string, or a reference to array of strings and [file handle, offset] pairs read from
+# offset to end in blocks of about 64KB ending at line ends
+#
+# return SUCCESS if all chunks are passed; FAILURE otherwise
+#
+sub email_chunks {
+   my ($emlmsg, $code) = @_;
+   my ($part, $fh, $buf, $line);
+
+   foreach $part (ref($emlmsg) eq "ARRAY" ? @$emlmsg : ($emlmsg)) {
+      if(!ref($part)) {
+         return FAILURE if(defined($part) && length($part) && !$code->($part));
+         next;
+      }
+      $fh = $part->[0];
+      seek($fh, $part->[1], 0) or return FAILURE;
+      while(read($fh, $buf, 65536)) {
+         $buf .= $line if($buf !~ /\n$/ && defined($line = <$fh>));
+         return FAILURE if(!$code->($buf));
+      }
+   }
+
+   return SUCCESS;
+}
+
+#
+# return a note of the messages not recorded for email buffer over $MYLOG{EMLMAX}
+# bytes, and reset the count
+#
+sub email_skip_note {
+   my $note = "";
+
+   if($MYLOG{EMLSKIP}) {
+      $note = "($MYLOG{EMLSKIP} more message(s) not included, over $MYLOG{EMLMAX} bytes)\n";
+      $MYLOG{EMLSKIP} = 0;
+   }
+   return $note;
 }
 
 #
@@ -276,10 +553,7 @@ sub send_customized_email {
       }
    }
 
-   if(open OUT, "| $MYLOG{EMLSEND}") {
-      print OUT $emlmsg;
-      close(OUT);
-      log_email($emlmsg);
+   if(!($key = post_email($emlmsg))) {
       if($logact) {
          $entry = $logmsg . "Email $entries{to}[2] ";
          $entry .= "Cc'd $entries{cc}[2] " if($entries{cc}[2]);
@@ -288,22 +562,27 @@ sub send_customized_email {
       }
       return SUCCESS;
    } else {
-      return mylog("Error open '| $MYLOG{EMLSEND}', $!", $logact|ERRLOG, @locs, __LINE__);
+      return mylog($key, $logact|ERRLOG, @locs, __LINE__);
    }
 }
 
 #
-#  send email, if empty $msg, send $MYLOG{EMLMSG} instead
+#  send email, if empty $msg, send the messages buffered by set_email() instead
 #
 sub send_email {
    my ($subject, $receiver, $msg, $sender, $logact) = @_;
 
-   my ($logmsg, $emlmsg);
+   my ($logmsg, $emlmsg, $err, $cc, %to);
    my $docc = 0;
 
-   if(!$msg && $MYLOG{EMLMSG}) {
-      $msg = $MYLOG{EMLMSG};
-      $MYLOG{EMLMSG} = '';
+   carbon_copy_set();
+   if(!$msg && email_pending()) {
+      $msg = take_email();     # string, or parts with the spilled details
+      if(ref($msg)) {
+         $msg->[-1] .= email_skip_note();
+      } else {
+         $msg .= email_skip_note();
+      }
    }
    if($msg) {
       if($sender) {
@@ -312,275 +591,2009 @@ sub send_email {
          $sender = "$MYLOG{CURUID}\@ucar.edu";
          $docc = 1;
       }
-      if($receiver) {
-         $receiver .= "\@ucar.edu" if($receiver !~ /\@/);
-      } else {
-         $receiver = ($MYLOG{EMLADDR} ? $MYLOG{EMLADDR} : "$MYLOG{CURUID}\@ucar.edu");
-      }
-      add_carbon_copy($sender, 1) if($docc && $receiver !~ /$sender/);
-      $emlmsg = "From: $sender\nTo: $receiver\n";
+      $receiver = ($MYLOG{EMLADDR} ? $MYLOG{EMLADDR} : "$MYLOG{CURUID}\@ucar.edu") if(!$receiver);
+      add_email_recipients(\%to, $receiver, 1);
+      $receiver = email_recipients_string(\%to);
+      add_carbon_copy($sender, 1) if($docc && !$to{seen}{lc((email_addresses($sender))[0])});
+      return digest_email($subject, \%to, $msg, $sender, $logact) if($MYLOG{EMLDIGEST} && !ref($msg));
+      $emlmsg = "From: $sender\nTo: " . email_recipients_string(\%to, 1) . "\n";
       $logmsg = "Email $receiver";
-      if($MYLOG{CCDADDR}) {
-          $emlmsg .= "Cc: $MYLOG{CCDADDR}\n";
-          $logmsg .= " Cc'd $MYLOG{CCDADDR}";
+      if(@{$CCDADDRS{list}}) {
+          $emlmsg .= "Cc: " . email_recipients_string(\%CCDADDRS, 1) . "\n";
+          $cc = @{$CCDADDRS{list}};
+          if($cc > 10) {
+             $logmsg .= " Cc'd " . join(", ", @{$CCDADDRS{list}}[0..9]) . " and " . ($cc - 10) . " more";
+          } else {
+             $logmsg .= " Cc'd " . email_recipients_string(\%CCDADDRS);
+          }
       }
       $emlmsg .= "Subject: " . ($subject ? $subject : ("Message from $MYLOG{HOSTNAME}-" . get_command()));
-      $emlmsg .= "!\n\n$msg\n";
+      if(ref($msg)) {
+         $emlmsg = [$emlmsg . "!\n\n" . $msg->[0], @$msg[1..$#$msg-1], $msg->[-1] . "\n"];
+      } else {
+         $emlmsg .= "!\n\n$msg\n";
+      }
       $logmsg .= " in $CPID{CPID}" if($CPID{CPID});
       $logmsg .= ", Subject: $subject!" if($subject);
       $logmsg .= "\n";
 
-      if(open MAIL, "| $MYLOG{EMLSEND}") {
-         print MAIL $emlmsg;
-         close(MAIL);
-         log_email($emlmsg);
+      if(!($err = post_email($emlmsg))) {
          mylog($logmsg, $logact&(~EXITLG)) if($logact);
          return $logmsg;
       } else {
-         mylog("Error Open '| $MYLOG{EMLSEND}': $!", ERRLOG);
+         mylog($err, ERRLOG);
       }
    }
    return "";
 }
 
 #
-# log email sent
+# Function: digest_email($subject, $to: recipient set, $msg, $sender, $logact)
 #
-sub log_email {
-   my ($emlmsg) = @_;
-
-   my $cmd;
-   $CPID{PID} =  "$MYLOG{HOSTNAME}-" . get_command() . "-$MYLOG{CURUID}" if(!$CPID{PID});
-   $cmd = $CPID{PID} . " " . break_long_string($CPID{CMD}, 40, "...", 1);
-   $cmd .= "  at " . current_datetime(time) . "\n";
-   if(open EML, ">> $MYLOG{LOGPATH}/$MYLOG{EMLFILE}") {
-      print EML $cmd;
-      print EML $emlmsg;
-      close(EML);
+# hold an email for the digest of the same sender and To/Cc recipients, while
+# $MYLOG{EMLDIGEST} is set; digests started over $MYLOG{EMLDIGEST} seconds ago are
+# sent by the next send_email() or mylog() call, and the rest are sent by
+# flush_email_digests(), at exit by default
+#
+sub digest_email {
+   my ($subject, $to, $msg, $sender, $logact) = @_;
+
+   my ($key, $dgst, $cnt, $receiver);
+   my $now = time;
+
+   $receiver = email_recipients_string($to);
+   $key = lc($sender) . ";" . join(",", sort keys %{$to->{seen}}) . ";" . join(",", sort keys %{$CCDADDRS{seen}});
+   flush_email_digests(0, $now);
+   $dgst = $EMLDIGESTS{$key};
+   if(!$dgst) {
+      $dgst = $EMLDIGESTS{$key} = {
+         time => $now, receiver => $receiver, cc => [@{$CCDADDRS{list}}],
+         sender => $sender, logact => $logact, msgs => []
+      };
    }
+   $dgst->{logact} |= $logact if($logact);
+   push @{$dgst->{msgs}}, [$now, $subject, $msg];
+   $cnt = @{$dgst->{msgs}};
+   add_metric("email_digested_total", "");
+
+   return "Email $receiver held for digest ($cnt pending)\n";
 }
 
 #
-# Function: check_hosts(@hosts: array of hosts the program is OK to run) 
+# Function: flush_email_digests($all: 1 - send all, 0 - send the due ones only)
 #
-#   Return: no return, exit directly if not valid hosts
+# send the emails held by digest_email(), one email per digest with a summary of
+# message counts per subject and a section per message
 #
-sub check_hosts {
-   my ($progname, $msg, @hosts) = @_;
-
-   my $ok = 0;
-   my $host;
-
-   foreach $host (@hosts) {
-      if($MYLOG{HOSTNAME} eq $host) {
-         $ok = 1;
-         last;
-      }
-   }
-
-   if(!$ok) {
-      my $tmp = "\n***********************************************************\n";
-      $tmp .= "** You Must Run $progname On ";
-      $tmp .= join " Or ", @hosts;
-      if($msg) {
-         $tmp .= "\n** For $msg\n";
+# return the number of emails sent
+#
+sub flush_email_digests {
+   my ($all, $now) = @_;
+
+   my ($key, $dgst, $msgs, $msg, $cnt, $i, $subject, $sent, %subjects, @subjects);
+
+   $now = time if(!$now);
+   $sent = 0;
+   foreach $key (sort keys %EMLDIGESTS) {
+      $dgst = $EMLDIGESTS{$key} or next;   # sent by a nested call
+      next if(!$all && ($MYLOG{EMLDIGEST} < 0 || $now - $dgst->{time} < $MYLOG{EMLDIGEST}));
+      delete $EMLDIGESTS{$key};
+      $msgs = $dgst->{msgs};
+      $cnt = @$msgs;
+      if($cnt == 1) {
+         ($subject, $msg) = @{$msgs->[0]}[1,2];
+      } else {
+         %subjects = ();
+         @subjects = ();
+         foreach (@$msgs) {
+            $subject = ($_->[1] ? $_->[1] : "Message from $MYLOG{HOSTNAME}-" . get_command());
+            push @subjects, $subject if(!$subjects{$subject}++);
+         }
+         $subject = (@subjects == 1 ? "$subjects[0] ($cnt Messages)" : "Digest of $cnt Messages from $MYLOG{HOSTNAME}-" . get_command());
+         $msg = "$cnt messages between " . current_datetime($msgs->[0][0]) . " and " . current_datetime($msgs->[-1][0]) . ":\n";
+         $msg .= sprintf("%6d x %s\n", $subjects{$_}, $_) foreach (@subjects);
+         for($i = 0; $i < $cnt; $i++) {
+            $msg .= $MYLOG{SEPLINE};
+            $msg .= sprintf("Message %d of %d at %s%s\n\n", $i + 1, $cnt, current_datetime($msgs->[$i][0]),
+                            ($msgs->[$i][1] ? ", Subject: $msgs->[$i][1]" : ""));
+            $msg .= $msgs->[$i][2];
+            $msg .= "\n" if($msg !~ /\n$/);
+         }
       }
-      $tmp .= "***********************************************************\n",
-
-      mylog($tmp, LGWNEX);
+      local $MYLOG{EMLDIGEST} = 0;
+      local %CCDADDRS = (list => [], seen => {});
+      add_email_recipients(\%CCDADDRS, $dgst->{cc});
+      local $MYLOG{CCDADDR} = $CCDADDRS{str} = email_recipients_string(\%CCDADDRS);
+      $sent++ if(send_email($subject, $dgst->{receiver}, $msg, $dgst->{sender}, $dgst->{logact}&(~EXITLG)));
    }
-}
-
-sub current_datetime {
-   my ($time) = @_;
 
-   my @date =  (defined $time) ? localtime($time) : localtime;
-
-   return sprintf "%02d%02d%02d%02d%02d%02d",  $date[5]%100, ($date[4] + 1),
-                  $date[3],  $date[2], $date[1], $date[0];
+   return $sent;
 }
 
 #
-# Function: cmdlog($cmdline)
-# $cmdline - program name and all arguments
-# $ctime - time (in seconds) when the command starts 
+# Function: post_email($emlmsg: email with header lines From/To/Cc/Bcc/Subject)
 #
-sub cmdlog {
-   my ($cmdline, $ctime, $logact) = @_;
+# the email is a string, or a reference to array of parts, see email_chunks(), with
+# the header lines in the first string part
+#
+# write an email to the spool directory $MYLOG{EMLSPOOL} if set, for run_email_spool()
+# to deliver it later; or deliver it now and record it in $MYLOG{EMLFILE}
+#
+# return empty string if successful, error message otherwise
+#
+sub post_email {
+   my ($emlmsg) = @_;
 
-   my $cinfo;
+   my ($err, $stime);
 
-   $logact = MSGLOG|FRCLOG if(!defined $logact);
-   $ctime = time if(!$ctime);
+   if($MYLOG{EMLSPOOL}) {
+      $err = spool_email($emlmsg);
+      add_metric("email_spooled_total", 'status="' . ($err ? "failure" : "success") . '"');
+      return "" if(!$err);
+      mylog("$err, send email now", MSGLOG);
+   }
 
-   if(!$cmdline || $cmdline =~ /^(end|quit|exit|abort)/i) {
-      $cmdline = ($cmdline ? ucfirst($cmdline) : "Ends");
-      $cinfo = cmd_execute_time("$CPID{PID} $cmdline", ($ctime - $CPID{CTM})) . ": ";
-      $cinfo .= "$CPID{CPID} <= " if($CPID{CPID});
-      $cinfo .= break_long_string($CPID{CMD}, 40, "...", 1);
-      mylog($cinfo, $logact) if($logact);
+   $stime = Time::HiRes::time;
+   if(!($err = deliver_email($emlmsg))) {
+      add_metric_time("email_send_seconds", "", Time::HiRes::time - $stime);
+      add_metric("email_sent_total", 'status="success"');
+      log_email($emlmsg);
    } else {
-      $cinfo = current_datetime($ctime);
-      if($cmdline =~ /^CPID \d+/) {
-         $CPID{PID} = "$MYLOG{HOSTNAME}-$MYLOG{CURUID}$cinfo";
-         mylog("$CPID{PID}: $cmdline", $logact) if($logact);
-         $CPID{CPID} = $cmdline;
-      } elsif($CPID{PID} && $cmdline =~ /^(starts|catches) /) {
-         mylog("$CPID{PID}: $cmdline at $cinfo", $logact) if($logact);
-      } else {
-         $CPID{PID} = "$MYLOG{HOSTNAME}-$MYLOG{CURUID}$cinfo";
-         mylog("$CPID{PID}: $cmdline", $logact) if($logact);
-         $CPID{CMD} = $cmdline;
-      }
-      $CPID{CTM} = $ctime;
+      add_metric("email_sent_total", 'status="failure"');
    }
+
+   return $err;
 }
 
 #
-# Function: mylog($msg, $logact, @locs) return FAILURE if not exit
-# $msg  -- message to log
-# $locact -- logging actions: MSGLOG, WARNLG, ERRLOG, EXITLG, EMLLOG, & SNDEML
+# write an email to $MYLOG{EMLSPOOL}/new/NEXT-TRIES-HOST-PID-SEQ atomically, via a
+# file synced under $MYLOG{EMLSPOOL}/tmp; NEXT is the time to try and TRIES the
+# number of failed tries
 #
-# log and display message/error and exit program according $logact value
+# return empty string if successful, error message otherwise
 #
-sub mylog {
-   my ($msg, $logact, @locs) = @_;
+sub spool_email {
+   my ($emlmsg) = @_;
 
-   my ($ctime, $cmd, $retmsg, $title);
-   my $output = 0;
+   my ($dir, $name, $tmp, $fh);
 
-   $logact = MSGLOG if(!defined $logact);
-   $logact &= $MYLOG{LOGMASK};  # filtering the log actions
-   $logact |= MSGLOG if($logact&RCDMSG);
-   $logact &= ~EXITLG if($MYLOG{NOQUIT});
-   if($logact&EMEROL) {
-      $logact &= ~EMLLOG if($logact&EMLLOG);
-      $logact &= ~EMEROL if(!($logact&ERRLOG));
+   foreach $dir ("", "/tmp", "/new", "/cur", "/failed") {
+      next if(-d "$MYLOG{EMLSPOOL}$dir");
+      mkdir("$MYLOG{EMLSPOOL}$dir", 0775) or -d "$MYLOG{EMLSPOOL}$dir" or
+         return "Error mkdir '$MYLOG{EMLSPOOL}$dir', $!";
    }
-   $msg =~ s/^\s+// if($msg); # remove leading whitespaces for logging message
-   if($logact&EXITLG) {
-      if(!$msg) {
-         $msg = "Exit 1";
-      } elsif($msg =~ /(\n|\r)$/) {
-         $msg =~ s/$1$/; Exit 1/;
-      } else {
-         $msg .= "; Exit 1";
-      }
-   } elsif($logact&RETMSG) {
-      $retmsg = $msg;
-      $retmsg .= "\n" if($retmsg && $retmsg !~ /(\n|\r)$/);
+   $name = sprintf("%d-0-%s-%d-%d", time, $MYLOG{HOSTNAME}, $$, ++$EMLSPOOLSEQ);
+   $tmp = "$MYLOG{EMLSPOOL}/tmp/$name";
+   open($fh, ">", $tmp) or return "Error open '$tmp', $!";
+   if(!email_chunks($emlmsg, sub { print $fh $_[0] }) || !$fh->flush() || !$fh->sync() || !close($fh)) {
+      $name = "Error write '$tmp', $!";
+      unlink $tmp;
+      return $name;
    }
-
-   $msg .= "\n" if($msg && $msg !~ /(\n|\r)$/ && !($logact&SNDEML));
-
-   if($logact&EMLALL) {
-      if(($logact&SNDEML) || !$msg) {
-         $title = ($msg ? $msg : "Message from $MYLOG{HOSTNAME}-" . get_command());
-         $msg = send_email($title);
-      } else {
-         set_email($msg, $logact) if($msg);
-      }
+   if(!rename($tmp, "$MYLOG{EMLSPOOL}/new/$name")) {
+      $name = "Error rename '$tmp' to '$MYLOG{EMLSPOOL}/new/$name', $!";
+      unlink $tmp;
+      return $name;
    }
-   return ($retmsg ? $retmsg : FAILURE) if(!$msg);
 
-   if($logact&EXITLG && ($MYLOG{EMLMSG} || $MYLOG{SUMMSG} || $MYLOG{ERRMSG} || $MYLOG{PRGMSG})) {
-      set_email($msg, $logact) if(!($logact&EMLALL)); 
-      $title = "ABORTS $MYLOG{HOSTNAME}-" . get_command();
-      set_email(($CPID{PID} ? ("ABORTS " . $CPID{PID}) : $title), EMLTOP);
-      $msg .= send_email($title);
-   }
-   $msg .= get_call_trace(@locs) if(@locs);
+   return "";
+}
 
-   if($logact&LOGERR) { # make sure error is always logged
-      $msg = break_long_string($msg);
-      if($logact&(ERRLOG|EXITLG)) {
-         $ctime = time;
-         $CPID{PID} =  "$MYLOG{HOSTNAME}-" . get_command() . "-$MYLOG{CURUID}" if(!$CPID{PID});
-         $cmd = ($logact&EXITLG ? ($logact&ERRLOG ? "ABORTS" : "QUITS") : "ERROR") . " $CPID{PID}";
-         $cmd = cmd_execute_time($cmd, ($ctime - $CPID{CTM}));
-         $cmd .= " $CPID{CPID} <=" if($CPID{CPID});
-         $cmd .= " " . break_long_string($CPID{CMD}, 40, "...", 1);
-         $cmd .= "  at " . current_datetime($ctime) . "\n";
-         $msg = $cmd. $msg;
+#
+# Function: run_email_spool($loop: 0 - one pass, 1 - keep polling)
+#
+# worker to deliver emails spooled under $MYLOG{EMLSPOOL}; each due email is claimed
+# by renaming it into cur/, and it is removed after delivered and recorded in
+# $MYLOG{EMLFILE}. A failed email is renamed back into new/ to be retried after
+# $MYLOG{EMLBACKOFF} seconds, doubled per try up to an hour; it is moved into
+# failed/ after $MYLOG{EMLTRIES} tries. Emails claimed but not finished over an
+# hour by another worker, died probably, are put back into new/.
+#
+# return the number of emails delivered
+#
+sub run_email_spool {
+   my ($loop) = @_;
+
+   my ($dh, $fh, $name, $file, $next, $tries, $rest, $head, $line, $err, $wait, $now, $cnt);
+   my $spool = $MYLOG{EMLSPOOL};
+
+   return mylog("EMLSPOOL: Missing spool directory to deliver emails", LOGERR) if(!$spool);
+   local $MYLOG{EMLSPOOL} = "";   # deliver now
+   $cnt = 0;
+   while(1) {
+      $now = time;
+      if(opendir($dh, "$spool/cur")) {
+         foreach $name (readdir($dh)) {
+            $file = "$spool/cur/$name";
+            next if(! -f $file || $now - (stat(_))[9] < 3600);
+            rename($file, "$spool/new/$name");
+         }
+         closedir($dh);
       }
-      if(!($logact&NOTLOG)) {
-         if($logact&ERRLOG) {
-            if(!$MYLOG{ERRFILE}) {
-               $MYLOG{ERRFILE} = $MYLOG{LOGFILE};
-               $MYLOG{ERRFILE} =~ s/log$/err/;
-            }
-            if(open ERR, ">> $MYLOG{LOGPATH}/$MYLOG{ERRFILE}") {
-               print ERR $msg;
-               close(ERR);
-               if($logact&EXITLG && open LOG, ">> $MYLOG{LOGPATH}/$MYLOG{LOGFILE}") {
-                  print LOG $cmd;
-                  close(LOG);
-               }
-            }
-         } elsif(open LOG, ">> $MYLOG{LOGPATH}/$MYLOG{LOGFILE}") {
-            print LOG $msg;
-            close(LOG);
+      if(!opendir($dh, "$spool/new")) {
+         return $cnt if(!$loop);
+         sleep($MYLOG{EMLPOLL});
+         next;
+      }
+      foreach $name (map {$_->[1]} sort {$a->[0] <=> $b->[0]} map {[/^(\d+)-/, $_]} grep {/^\d+-\d+-/} readdir($dh)) {
+         ($next, $tries, $rest) = split(/-/, $name, 3);
+         last if($next > $now);
+         $file = "$spool/cur/$name";
+         next if(!rename("$spool/new/$name", $file));  # claimed by another worker
+         utime($now, $now, $file);
+         if(!open($fh, "<", $file)) {
+            rename($file, "$spool/new/$name");
+            next;
+         }
+         $head = "";    # header lines, and the body read in chunks
+         while(defined($line = <$fh>)) {
+            $head .= $line;
+            last if($line eq "\n");
+         }
+         $err = post_email([$head, [$fh, tell($fh)]]);
+         close($fh);
+         if(!$err) {
+            unlink $file;
+            $cnt++;
+            next;
+         }
+         $tries++;
+         if($tries >= $MYLOG{EMLTRIES}) {
+            rename($file, "$spool/failed/$rest");
+            mylog("Spooled email $rest: $err, moved to $spool/failed after $tries tries", LOGERR);
+         } else {
+            $wait = $MYLOG{EMLBACKOFF} * 2**($tries - 1);
+            $wait = 3600 if($wait > 3600);
+            rename($file, sprintf("%s/new/%d-%d-%s", $spool, $now + $wait, $tries, $rest));
+            mylog("Spooled email $rest: $err, try again in $wait seconds", MSGLOG);
          }
       }
+      closedir($dh);
+      flush_logs();
+      last if(!$loop);
+      sleep($MYLOG{EMLPOLL});
    }
 
-   if(!$MYLOG{BCKGRND} && $logact&(ERRLOG|WARNLG)) {
-      $output = ($logact&(ERRLOG|EXITLG) ? \*STDERR : \*STDOUT);
-      print $output "\n" if($logact&BRKLIN);
-      print $output $MYLOG{SEPLINE} if($logact&SEPLIN);
-      print $output $msg;
+   return $cnt;
+}
+
+#
+# Function: deliver_email($emlmsg: email with header lines From/To/Cc/Bcc/Subject)
+#
+# submit an email over the persistent SMTP session to $MYLOG{SMTPHOST}:$MYLOG{SMTPPORT}
+# if set, and fall back to pipe it to $MYLOG{EMLSEND} if SMTP fails
+#
+# return empty string if successful, error message otherwise
+#
+sub deliver_email {
+   my ($emlmsg) = @_;
+
+   if($MYLOG{SMTPHOST}) {
+      return "" if(smtp_send($emlmsg));
+      add_metric("email_smtp_fallback_total", "");
+      mylog("SMTP $MYLOG{SMTPHOST}:$MYLOG{SMTPPORT}: $SMTPCONN{error}, use '$MYLOG{EMLSEND}'", MSGLOG);
    }
-   
-   if($logact&EXITLG) {
-      exit 1;
+
+   if(open MAIL, "| $MYLOG{EMLSEND}") {
+      email_chunks($emlmsg, sub { print MAIL $_[0] });
+      return "" if(close(MAIL));
+      return ($! ? "Error close '| $MYLOG{EMLSEND}', $!" : "Error '$MYLOG{EMLSEND}', exit status " . ($? >> 8));
    } else {
-      return ($retmsg ? $retmsg : FAILURE);
+      return "Error open '| $MYLOG{EMLSEND}', $!";
    }
 }
 
-# mydbg($level, $msg, @locs) return none
-# $msg  -- message to log
-# @locs -- array of file names and line numbers of function calling trace
+#
+# submit an email over the SMTP session, reconnect once if the session is gone;
+# commands of a transaction are sent at once if the server supports PIPELINING
+#
+# return SUCCESS or FAILURE with error message in $SMTPCONN{error}
+#
+sub smtp_send {
+   my ($emlmsg) = @_;
+
+   my ($head, $body, @parts, $rest, $sender, @rcpts, @cmds, @codes, $code, $msg, $try, $ok, $i);
+
+   @parts = (ref($emlmsg) ? @$emlmsg : ($emlmsg));
+   ($head, $body) = split(/\n\n/, shift(@parts), 2);
+   $head .= "\n";
+   $body = "" if(!defined $body);
+   $sender = ($head =~ /^From:\s*(.+)$/mi) ? (email_addresses($1))[0] : "";
+   $sender = "$MYLOG{CURUID}\@ucar.edu" if(!$sender);
+   ($rest = $head) =~ s/\n[ \t]+/ /g;    # unfold header lines
+   while($rest =~ /^(To|Cc|Bcc):\s*(.+)$/mgi) {
+      push @rcpts, email_addresses($2);
+   }
+   if(!@rcpts) {
+      $SMTPCONN{error} = "Missing Recipient";
+      return FAILURE;
+   }
+   $head =~ s/^Bcc:.*\n//mgi;
+   unshift @parts, "$head\n$body";
+
+   @cmds = ("MAIL FROM:<$sender>", (map {"RCPT TO:<$_>"} @rcpts), "DATA");
+   for($try = 0; $try < 2; $try++) {
+      next if(!smtp_connect($try));
+      @codes = ();
+      if($SMTPCONN{pipe}) {   # send all commands, then read all replies
+         next if(!smtp_write(join("\r\n", @cmds) . "\r\n"));
+         for($i = 0; $i < @cmds; $i++) {
+            ($code, $msg) = smtp_reply();
+            last if(!$code);
+            push @codes, [$code, $msg];
+         }
+      } else {
+         for($i = 0; $i < @cmds; $i++) {
+            last if($i == $#cmds && !grep {$_->[0] =~ /^25/} @codes[1..$#codes]);
+            ($code, $msg) = smtp_command($cmds[$i]);
+            last if(!$code);
+            push @codes, [$code, $msg];
+            last if($i == 0 && $code !~ /^25/);
+         }
+      }
+      if(!$code) {    # session lost, try a new one
+         smtp_close(1);
+         next;
+      }
+      ($code, $msg) = @{$codes[-1]};
+      if($codes[0][0] !~ /^25/) {
+         ($code, $msg) = @{$codes[0]};
+      } elsif($code ne "354") {
+         ($ok) = grep {$_->[0] !~ /^25/} @codes[1..$#codes];
+         ($code, $msg) = @$ok if($ok && @codes < @cmds);
+      }
+      if($code ne "354") {
+         $msg =~ s/\n$//;
+         $SMTPCONN{error} = "$code $msg";
+         smtp_command("RSET");
+         return FAILURE;
+      }
+      if(smtp_data(\@parts)) {
+         ($code, $msg) = smtp_reply();
+      } else {
+         $code = "";
+      }
+      return SUCCESS if($code && $code =~ /^25/);
+      $msg =~ s/\n$// if($msg);
+      $SMTPCONN{error} = ($code ? "$code $msg" : "Lost connection after DATA");
+      smtp_close(1) if(!$code);
+      return FAILURE;   # no retry after the message data sent
+   }
+
+   return FAILURE;
+}
+
+#
+# write the message data of an email in chunks, dot-stuffed with CRLF line ends,
+# and the ending line of a single dot
+#
+sub smtp_data {
+   my ($parts) = @_;
+
+   my $bol = 1;   # at the beginning of a line
+
+   return FAILURE if(!email_chunks($parts, sub {
+      my ($data) = @_;
+      if($bol) {
+         $data =~ s/^\./../mg;     # dot-stuffing
+      } else {
+         $data =~ s/\n\./\n../g;
+      }
+      $bol = ($data =~ /\n$/) ? 1 : 0;
+      $data =~ s/\r?\n/\r\n/g;
+      return smtp_write($data);
+   }));
+
+   return smtp_write($bol ? ".\r\n" : "\r\n.\r\n");
+}
+
+#
+# return the bare email addresses in a header value, with domain ucar.edu by default
+#
+sub email_addresses {
+   my ($str) = @_;
+
+   return map {$_->[1] =~ /\@/ ? $_->[1] : "$_->[1]\@ucar.edu"} parse_email_addresses($str);
+}
+
+#
+# split a list of recipients at the commas outside of quotes, comments and angle
+# brackets; the ones without angle brackets may be separated by spaces too
+#
+# return array of [text as given, bare email address]
+#
+sub parse_email_addresses {
+   my ($str) = @_;
+
+   my ($item, @rcpts);
+
+   return () if(!defined $str);
+   foreach $item ($str =~ /((?:"(?:[^"\\]|\\.)*"?|\([^)]*\)?|<[^>]*>?|[^,"(<])+)/g) {
+      $item =~ s/^\s+//;
+      $item =~ s/\s+$//;
+      if($item =~ /<\s*([^>\s]*)\s*>?/) {
+         push @rcpts, [$item, $1] if(length($1));
+      } else {
+         push @rcpts, map {[$_, $_]} split(/\s+/, $item);
+      }
+   }
+
+   return @rcpts;
+}
+
+#
+# connect to $MYLOG{SMTPHOST}:$MYLOG{SMTPPORT} if not yet, or if $force is set
+# while the session is reused by this process
+#
+sub smtp_connect {
+   my ($force) = @_;
+
+   my ($sock, $code, $msg, $host);
+
+   $host = "$MYLOG{SMTPHOST}:$MYLOG{SMTPPORT}";
+   if($SMTPCONN{sock}) {
+      return SUCCESS if(!$force && $SMTPCONN{pid} == $$ && $SMTPCONN{host} eq $host);
+      smtp_close($SMTPCONN{pid} != $$);
+   }
+   $sock = IO::Socket::INET->new(PeerAddr => $MYLOG{SMTPHOST}, PeerPort => $MYLOG{SMTPPORT},
+                                 Proto => "tcp", Timeout => $MYLOG{SMTPTIME});
+   if(!$sock) {
+      $SMTPCONN{error} = "Error connect, $@";
+      return FAILURE;
+   }
+   $sock->autoflush(1);
+   $sock->setsockopt(IPPROTO_TCP, TCP_NODELAY, 1);
+   @SMTPCONN{qw(sock pid host pipe rbuf)} = ($sock, $$, $host, 0, "");
+   ($code, $msg) = smtp_reply();
+   ($code, $msg) = smtp_command("EHLO $MYLOG{HOSTNAME}") if($code eq "220");
+   ($code, $msg) = smtp_command("HELO $MYLOG{HOSTNAME}") if($code && $code =~ /^5/);
+   if(!$code || $code ne "250") {
+      $SMTPCONN{error} = ($code ? "$code $msg" : "No Reply");
+      smtp_close(1);
+      return FAILURE;
+   }
+   $SMTPCONN{pipe} = ($msg =~ /^PIPELINING\b/mi) ? 1 : 0;
+
+   return SUCCESS;
+}
+
+#
+# write a string to the SMTP session; a session closed by the server fails with
+# EPIPE instead of killing the process by SIGPIPE, and is dropped
+#
+sub smtp_write {
+   my ($str) = @_;
+
+   my ($len, $off);
+
+   local $SIG{PIPE} = 'IGNORE';
+   for($off = 0; $off < length($str); $off += $len) {
+      $len = syswrite($SMTPCONN{sock}, $str, length($str) - $off, $off);
+      if(!$len) {
+         $SMTPCONN{error} = "Error write, $!";
+         smtp_close(1);
+         return FAILURE;
+      }
+   }
+
+   return SUCCESS;
+}
+
+#
+# send a command and return its reply code and text
+#
+sub smtp_command {
+   my ($cmd) = @_;
+
+   return () if(!$SMTPCONN{sock} || !smtp_write("$cmd\r\n"));
+   return smtp_reply();
+}
+
+#
+# read a reply, of one or more lines, from the SMTP session in $MYLOG{SMTPTIME} seconds
+#
+# return (code, text), or empty if the session is gone
+#
+sub smtp_reply {
+   my ($sel, $buf, $line, $text, $pos);
+
+   $sel = IO::Select->new($SMTPCONN{sock});
+   $text = "";
+   while(1) {
+      while(($pos = index($SMTPCONN{rbuf}, "\n")) >= 0) {
+         $line = substr($SMTPCONN{rbuf}, 0, $pos + 1, "");
+         $line =~ s/\r?\n$//;
+         next if($line !~ /^(\d{3})([ -])(.*)$/);
+         $text .= "$3\n";
+         return ($1, $text) if($2 eq " ");
+      }
+      if(!$sel->can_read($MYLOG{SMTPTIME}) || !sysread($SMTPCONN{sock}, $buf, 8192)) {
+         $SMTPCONN{error} = "No Reply";
+         return ();
+      }
+      $SMTPCONN{rbuf} .= $buf;
+   }
+}
+
+#
+# end the SMTP session, without QUIT if $noquit
+#
+sub smtp_close {
+   my ($noquit) = @_;
+
+   return if(!$SMTPCONN{sock});
+   smtp_command("QUIT") if(!$noquit && $SMTPCONN{pid} == $$);
+   return if(!$SMTPCONN{sock});   # dropped by a failed QUIT
+   close($SMTPCONN{sock});
+   $SMTPCONN{sock} = undef;
+   $SMTPCONN{rbuf} = "";
+}
+
+#
+# log email sent
+#
+sub log_email {
+   my ($emlmsg) = @_;
+
+   my $cmd;
+   $CPID{PID} =  "$MYLOG{HOSTNAME}-" . get_command() . "-$MYLOG{CURUID}" if(!$CPID{PID});
+   $cmd = $CPID{PID} . " " . break_long_string($CPID{CMD}, 40, "...", 1);
+   $cmd .= "  at " . current_datetime(time) . "\n";
+   if($MYLOG{EMLARCH}) {
+      archive_email($cmd, $emlmsg);
+   } else {
+      write_email_log($cmd, $emlmsg);
+   }
+}
+
+#
+# write an email sent, with its log line, to $MYLOG{EMLFILE} in text
+#
+sub write_email_log {
+   my ($cmd, $emlmsg) = @_;
+
+   my $file = "$MYLOG{LOGPATH}/$MYLOG{EMLFILE}";
+
+   return write_log($file, $cmd . $emlmsg) if(!ref($emlmsg));
+   write_log($file, $cmd);
+   return email_chunks($emlmsg, sub { write_log($file, $_[0]) });
+}
+
+#
+# append an email sent, with its log line, to the email archive $MYLOG{EMLFILE}.gz
+# as a gzip member of its own, so the archive is still readable by zcat; and append
+# a line to its index file "$MYLOG{EMLFILE}.gz.idx" under the same lock, of the
+# sidecar index format of log files, see read_indexed_records():
+#   Offset Length Time PIDTag Subject Recipients
+#
+sub archive_email {
+   my ($cmd, $emlmsg) = @_;
+
+   my ($file, $fh, $ih, $gz, $zs, $len, $off, $head, $subject, @rcpts, $line);
+
+   $file = "$MYLOG{LOGPATH}/$MYLOG{EMLFILE}.gz";
+   ($head) = split(/\n\n/, (ref($emlmsg) ? $emlmsg->[0] : $emlmsg), 2);
+   $head =~ s/\n[ \t]+/ /g;
+   $subject = ($head =~ /^Subject:\s*(.*)$/mi) ? $1 : "";
+   while($head =~ /^(To|Cc|Bcc):\s*(.+)$/mgi) {
+      push @rcpts, email_addresses($2);
+   }
+   ($zs) = Compress::Zlib::deflateInit(-WindowBits => 31);   # gzip wrapped, as memGzip()
+
+   if(!($zs && open($fh, ">>", $file) && open($ih, ">>", "$file.idx"))) {
+      write_email_log($cmd, $emlmsg);  # keep it in text
+      return FAILURE;
+   }
+   flock($fh, LOCK_EX);
+   binmode($fh);
+   seek($fh, 0, 2);
+   $off = tell($fh);
+   $len = 0;
+   email_chunks([$cmd, (ref($emlmsg) ? @$emlmsg : $emlmsg)], sub {   # compressed in chunks
+      ($gz) = $zs->deflate($_[0]);
+      $len += length($gz);
+      print $fh $gz;
+   });
+   ($gz) = $zs->flush();
+   $len += length($gz);
+   print $fh $gz;
+   $fh->flush();
+   $line = join("\t", time, $CPID{PID}, $subject, lc(join(",", @rcpts)));
+   $line =~ s/[\r\n]+/ /g;
+   print $ih "$off\t$len\t$line\n";
+   close($ih);
+   close($fh);   # release the lock
+
+   return SUCCESS;
+}
+
+#
+# Function: search_emails($cond, $file)
+# $cond -- reference to hash of conditions; undefined ones match all:
+#          to      - email address of a recipient, To, Cc or Bcc
+#          subject - pattern of subject
+#          pid     - PID tag of the run the emails are sent in
+#          btime   - begin time, in seconds since epoch
+#          etime   - end time, in seconds since epoch
+#          text    - pattern of the email text, checked after decompressed
+# $file -- email archive file, default to $MYLOG{LOGPATH}/$MYLOG{EMLFILE}.gz
+#
+# find the emails in the sidecar index file "$file.idx", and decompress only the
+# matching ones from the archive; for example
+#   search_emails({to => 'zji', subject => 'dsupdt', btime => time - 86400})
+#
+# Return: array of hash references of the matching emails, with keys: time, pid,
+#         subject, recipients and email (log line and text of the email)
+#
+sub search_emails {
+   my ($cond, $file) = @_;
+
+   my ($ent, $to, $email, @emails);
+
+   $file = "$MYLOG{LOGPATH}/$MYLOG{EMLFILE}.gz" if(!$file);
+   if(defined $cond->{to}) {
+      $to = lc($cond->{to});
+      $to .= "\@ucar.edu" if($to !~ /\@/);
+   }
+   foreach $ent (read_indexed_records($file, $cond, [qw(subject recipients)],
+                                      sub {(!defined $cond->{subject} || $_[0]{subject} =~ /$cond->{subject}/) &&
+                                           (!$to || index(",$_[0]{recipients},", ",$to,") > -1)})) {
+      $email = Compress::Zlib::memGunzip($ent->{record});
+      next if(!defined $email || (defined $cond->{text} && $email !~ /$cond->{text}/));
+      push @emails, {time => $ent->{time}, pid => $ent->{pid}, subject => $ent->{subject},
+                     recipients => $ent->{recipients}, email => $email};
+   }
+
+   return @emails;
+}
+
+#
+# Function: check_hosts(@hosts: array of hosts the program is OK to run) 
+#
+#   Return: no return, exit directly if not valid hosts
+#
+sub check_hosts {
+   my ($progname, $msg, @hosts) = @_;
+
+   my $ok = 0;
+   my $host;
+
+   foreach $host (@hosts) {
+      if($MYLOG{HOSTNAME} eq $host) {
+         $ok = 1;
+         last;
+      }
+   }
+
+   if(!$ok) {
+      my $tmp = "\n***********************************************************\n";
+      $tmp .= "** You Must Run $progname On ";
+      $tmp .= join " Or ", @hosts;
+      if($msg) {
+         $tmp .= "\n** For $msg\n";
+      }
+      $tmp .= "***********************************************************\n",
+
+      mylog($tmp, LGWNEX);
+   }
+}
+
+sub current_datetime {
+   my ($time) = @_;
+
+   my @date =  (defined $time) ? localtime($time) : localtime;
+
+   return sprintf "%02d%02d%02d%02d%02d%02d",  $date[5]%100, ($date[4] + 1),
+                  $date[3],  $date[2], $date[1], $date[0];
+}
+
+#
+# Function: cmdlog($cmdline)
+# $cmdline - program name and all arguments
+# $ctime - time (in seconds) when the command starts 
+#
+sub cmdlog {
+   my ($cmdline, $ctime, $logact) = @_;
+
+   my $cinfo;
+
+   $logact = MSGLOG|FRCLOG if(!defined $logact);
+   $ctime = time if(!$ctime);
+
+   if(!$cmdline || $cmdline =~ /^(end|quit|exit|abort)/i) {
+      $cmdline = ($cmdline ? ucfirst($cmdline) : "Ends");
+      $cinfo = cmd_execute_time("$CPID{PID} $cmdline", ($ctime - $CPID{CTM})) . ": ";
+      $cinfo .= "$CPID{CPID} <= " if($CPID{CPID});
+      $cinfo .= break_long_string($CPID{CMD}, 40, "...", 1);
+      mylog($cinfo, $logact) if($logact);
+   } else {
+      $cinfo = current_datetime($ctime);
+      if($cmdline =~ /^CPID \d+/) {
+         $CPID{PID} = "$MYLOG{HOSTNAME}-$MYLOG{CURUID}$cinfo";
+         mylog("$CPID{PID}: $cmdline", $logact) if($logact);
+         $CPID{CPID} = $cmdline;
+      } elsif($CPID{PID} && $cmdline =~ /^(starts|catches) /) {
+         mylog("$CPID{PID}: $cmdline at $cinfo", $logact) if($logact);
+      } else {
+         $CPID{PID} = "$MYLOG{HOSTNAME}-$MYLOG{CURUID}$cinfo";
+         mylog("$CPID{PID}: $cmdline", $logact) if($logact);
+         $CPID{CMD} = $cmdline;
+      }
+      $CPID{CTM} = $ctime;
+   }
+}
+
+#
+# Function: mylog($msg, $logact, @locs) return FAILURE if not exit
+# $msg  -- message to log, or a deferred message built only if it is to be
+#          logged, displayed, emailed or returned: a code reference returning
+#          the message, or an array reference of a sprintf() format and arguments
+# $locact -- logging actions: MSGLOG, WARNLG, ERRLOG, EXITLG, EMLLOG, & SNDEML
+#
+# log and display message/error and exit program according $logact value
+#
+sub mylog {
+   my ($msg, $logact, @locs) = @_;
+
+   my ($ctime, $cmd, $retmsg, $title, $trace, $rawmsg, $tofile, $toscrn, $stime, $label);
+   my $output = 0;
+
+   $logact = MSGLOG if(!defined $logact);
+   $logact &= $MYLOG{LOGMASK};  # filtering the log actions
+   $logact |= MSGLOG if($logact&RCDMSG);
+   $logact &= ~EXITLG if($MYLOG{NOQUIT});
+   if($logact&EMEROL) {
+      $logact &= ~EMLLOG if($logact&EMLLOG);
+      $logact &= ~EMEROL if(!($logact&ERRLOG));
+   }
+   $tofile = ($logact&LOGERR && !($logact&NOTLOG));
+   $toscrn = (!$MYLOG{BCKGRND} && $logact&(ERRLOG|WARNLG));
+   return FAILURE if(!($tofile || $toscrn || $logact&(EMLALL|EXITLG|RETMSG)));   # filtered out
+   $stime = Time::HiRes::time;
+   flush_email_digests(0) if(%EMLDIGESTS && $MYLOG{EMLDIGEST} > 0);   # digests due
+   $msg = build_message($msg) if(ref $msg);
+   $msg =~ s/^\s+// if($msg); # remove leading whitespaces for logging message
+   if($logact&EXITLG) {
+      if(!$msg) {
+         $msg = "Exit 1";
+      } elsif($msg =~ /(\n|\r)$/) {
+         $msg =~ s/$1$/; Exit 1/;
+      } else {
+         $msg .= "; Exit 1";
+      }
+   } elsif($logact&RETMSG) {
+      $retmsg = $msg;
+      $retmsg .= "\n" if($retmsg && $retmsg !~ /(\n|\r)$/);
+   }
+   if($logact&EXITLG) {
+      report_duplicates(1);
+   } elsif($MYLOG{DUPMAX} && $msg && is_duplicate($msg, $logact)) {
+      return ($retmsg ? $retmsg : FAILURE);   # suppressed
+   }
+
+   $msg .= "\n" if($msg && $msg !~ /(\n|\r)$/ && !($logact&SNDEML));
+
+   if($logact&EMLALL) {
+      if(($logact&SNDEML) || !$msg) {
+         $title = ($msg ? $msg : "Message from $MYLOG{HOSTNAME}-" . get_command());
+         $msg = send_email($title);
+      } else {
+         set_email($msg, $logact) if($msg);
+      }
+   }
+   return ($retmsg ? $retmsg : FAILURE) if(!$msg);
+
+   if($logact&EXITLG && (email_pending() || $MYLOG{SUMMSG} || $MYLOG{ERRMSG} || $MYLOG{PRGMSG})) {
+      set_email($msg, $logact) if(!($logact&EMLALL)); 
+      $title = "ABORTS $MYLOG{HOSTNAME}-" . get_command();
+      set_email(($CPID{PID} ? ("ABORTS " . $CPID{PID}) : $title), EMLTOP);
+      $msg .= send_email($title);
+   }
+   return ($retmsg ? $retmsg : FAILURE) if(!($tofile || $toscrn || $logact&EXITLG));
+
+   $rawmsg = $msg;
+   $trace = get_call_trace(@locs) if(@locs);
+   $msg .= $trace if($trace);
+
+   if($logact&LOGERR) { # make sure error is always logged
+      $msg = break_long_string($msg);
+      if($logact&(ERRLOG|EXITLG)) {
+         $ctime = time;
+         $CPID{PID} =  "$MYLOG{HOSTNAME}-" . get_command() . "-$MYLOG{CURUID}" if(!$CPID{PID});
+         $cmd = ($logact&EXITLG ? ($logact&ERRLOG ? "ABORTS" : "QUITS") : "ERROR") . " $CPID{PID}";
+         $cmd = cmd_execute_time($cmd, ($ctime - $CPID{CTM}));
+         $cmd .= " $CPID{CPID} <=" if($CPID{CPID});
+         $cmd .= " " . break_long_string($CPID{CMD}, 40, "...", 1);
+         $cmd .= "  at " . current_datetime($ctime) . "\n";
+         $msg = $cmd. $msg;
+      }
+      if(!($logact&NOTLOG)) {
+         if($logact&ERRLOG && !$MYLOG{ERRFILE}) {
+            $MYLOG{ERRFILE} = $MYLOG{LOGFILE};
+            $MYLOG{ERRFILE} =~ s/log$/err/;
+         }
+         if($MYLOG{LOGFORMAT} eq "json") {
+            write_json_log($rawmsg, $trace, $logact, $ctime);
+         } elsif($logact&ERRLOG) {
+            if(write_log("$MYLOG{LOGPATH}/$MYLOG{ERRFILE}", $msg, 0, log_record_index($msg)) && $logact&EXITLG) {
+               write_log("$MYLOG{LOGPATH}/$MYLOG{LOGFILE}", $cmd, 0, log_record_index($cmd));
+            }
+         } else {
+            write_log("$MYLOG{LOGPATH}/$MYLOG{LOGFILE}", $msg, 0, log_record_index($msg));
+         }
+      }
+   }
+   if($DBGRIDX && $logact&(ERRLOG|EXITLG) && !($logact&NOTLOG)) {   # recent debug records for the error
+      if($MYLOG{LOGFORMAT} eq "json") {
+         dump_debug_ring("$MYLOG{DBGPATH}/$MYLOG{DBGFILE}");
+      } else {
+         dump_debug_ring("$MYLOG{LOGPATH}/" . ($logact&ERRLOG ? $MYLOG{ERRFILE} : $MYLOG{LOGFILE}));
+      }
+   }
+
+   if($toscrn) {
+      $output = ($logact&(ERRLOG|EXITLG) ? \*STDERR : \*STDOUT);
+      print $output "\n" if($logact&BRKLIN);
+      print $output $MYLOG{SEPLINE} if($logact&SEPLIN);
+      print $output $msg;
+   }
+   $stime = Time::HiRes::time - $stime;
+   $label = 'class="' . logact_class($logact) . '"';
+   add_metric("mylog_records_total", $label);
+   add_metric_time("mylog_seconds", $label, $stime);
+   
+   if($logact&EXITLG) {
+      flush_email_digests(1) if(%EMLDIGESTS);
+      close_logs();
+      exit 1;
+   } else {
+      return ($retmsg ? $retmsg : FAILURE);
+   }
+}
+
+#
+# build a deferred message given to mylog() or mydbg(), a code reference or an
+# array reference of a sprintf() format and its arguments
+#
+sub build_message {
+   my ($msg) = @_;
+
+   if(ref $msg eq "CODE") {
+      return $msg->();
+   } elsif(ref $msg eq "ARRAY") {
+      return sprintf($msg->[0], @{$msg}[1..$#{$msg}]);
+   } else {
+      return "$msg";
+   }
+}
+
+#
+# write a log record of mylog() in JSON lines for $MYLOG{LOGFORMAT} 'json', and
+# index it in the sidecar file "$LogFile.idx", see log_record_index()
+#
+sub write_json_log {
+   my ($msg, $trace, $logact, $ctime) = @_;
+
+   my ($pid, $level, $rec, $index);
+
+   $ctime = time if(!$ctime);
+   $pid = ($CPID{PID} ? $CPID{PID} : "$MYLOG{HOSTNAME}-" . get_command() . "-$MYLOG{CURUID}");
+   $level = ($logact&EXITLG ? ($logact&ERRLOG ? "ABORTS" : "QUITS") : ($logact&ERRLOG ? "ERROR" : "LOG"));
+   $msg =~ s/\n$//;
+   if($trace) {
+      $trace =~ s/^Called://;
+      $trace =~ s/\n$//;
+   }
+
+   $rec = sprintf("{\"time\":%d,\"date\":%s,\"level\":%s,\"host\":%s,\"uid\":%s,\"pid\":%s," .
+                  "\"cpid\":%s,\"cmd\":%s,\"logact\":%d,\"elapsed\":%d,\"trace\":%s,\"msg\":%s}\n",
+                  $ctime, json_string(current_datetime($ctime)), json_string($level),
+                  json_string($MYLOG{HOSTNAME}), json_string($MYLOG{CURUID}), json_string($pid),
+                  json_string($CPID{CPID}), json_string($CPID{CMD}), $logact,
+                  ($ctime - $CPID{CTM}), json_string($trace), json_string($msg));
+   $index = log_record_index($rec);
+
+   if($logact&ERRLOG) {
+      if(write_log("$MYLOG{LOGPATH}/$MYLOG{ERRFILE}", $rec, 0, $index) && $logact&EXITLG) {
+         write_log("$MYLOG{LOGPATH}/$MYLOG{LOGFILE}", $rec, 0, $index);
+      }
+   } else {
+      write_log("$MYLOG{LOGPATH}/$MYLOG{LOGFILE}", $rec, 0, $index);
+   }
+}
+
+#
+# quote a string for JSON; null if undefined
+#
+sub json_string {
+   my ($str) = @_;
+
+   return "null" if(!defined $str);
+
+   $str =~ s/([\\"])/\\$1/g;
+   $str =~ s/\n/\\n/g;
+   $str =~ s/\r/\\r/g;
+   $str =~ s/\t/\\t/g;
+   $str =~ s/([\x00-\x1f])/sprintf("\\u%04x", ord($1))/eg;
+
+   return "\"$str\"";
+}
+
+#
+# Function: query_log_records($file, $cond)
+# $file -- full path of a log file
+# $cond -- reference to hash of conditions, as of query_logs()
+#
+# Return: array of matching records, as in the log file
+#
+sub query_log_records {
+   my ($file, $cond) = @_;
+
+   return map {$_->{record}} query_logs($cond, $file);
+}
+
+#
+# Function: query_logs($cond, @files)
+# $cond  -- reference to hash of conditions; undefined ones match all:
+#           pid     - PID tag of a run, as set by cmdlog()
+#           cpid    - CPID of the run, as set by cmdlog()
+#           host    - host name the records are logged on
+#           kind    - record kind, START/END (by cmdlog()), ERROR/QUITS/ABORTS
+#                     (by mylog() with ERRLOG/EXITLG) or LOG (other JSON records)
+#           btime   - begin time, in seconds since epoch
+#           etime   - end time, in seconds since epoch
+#           slowest - return only this many records with the longest run times
+# @files -- log files to query; default to $MYLOG{LOGFILE} and $MYLOG{ERRFILE}
+#           under $MYLOG{LOGPATH}; rolled segments are queried only if given
+#           and not compressed, see roll_log_file()
+#
+# query the log files via their sidecar index files "$LogFile.idx", written along
+# with the records, and read only the matching records from the memory mapped
+# log files; for example
+#   query_logs({pid => $pid})                              # all records of a run
+#   query_logs({kind => 'ABORTS', btime => time - 3600})   # aborts in last hour
+#   query_logs({kind => 'END', btime => $today, slowest => 10})  # slowest runs
+#
+# Return: array of hash references of the matching records, sorted by time (by
+#         run time for slowest), with keys: file, offset, length, time, pid, cpid,
+#         kind, host, secs (run time) and record
+#
+sub query_logs {
+   my ($cond, @files) = @_;
+
+   my ($file, $ent, @recs);
+
+   if(!@files) {
+      $file = $MYLOG{ERRFILE};
+      if(!$file) {
+         $file = $MYLOG{LOGFILE};
+         $file =~ s/log$/err/;
+      }
+      @files = ("$MYLOG{LOGPATH}/$MYLOG{LOGFILE}", "$MYLOG{LOGPATH}/$file");
+   }
+   flush_logs();
+
+   foreach $file (@files) {
+      index_log_file($file) if(!-e "$file.idx" && -s $file);   # written without index
+      foreach $ent (read_indexed_records($file, $cond, [qw(cpid kind secs)],
+                                         sub {(!defined $cond->{cpid} || $_[0]{cpid} eq $cond->{cpid}) &&
+                                              (!defined $cond->{kind} || $_[0]{kind} eq $cond->{kind}) &&
+                                              (!defined $cond->{host} || $_[0]{host} eq $cond->{host})})) {
+         $ent->{file} = $file;
+         push @recs, $ent;
+      }
+   }
+
+   if($cond->{slowest}) {
+      @recs = sort {$b->{secs} <=> $a->{secs}} @recs;
+      splice(@recs, $cond->{slowest}) if(@recs > $cond->{slowest});
+   } else {
+      @recs = sort {$a->{time} <=> $b->{time}} @recs;
+   }
+
+   return @recs;
+}
+
+#
+# read the records of a file matching conditions via its sidecar index file
+# "$file.idx", which has a line per record of tab separated fields:
+#   Offset Length Time PIDTag Info...
+# Info fields are named by @$fields, CPID, Kind and Seconds for log files, and
+# Subject and Recipients for the email archive
+#
+# $cond  -- reference to hash of the common conditions: pid, btime and etime
+# $match -- code reference called with the index entry for other conditions,
+#           the record is read only if it returns true
+#
+# return array of hash references of the index entries with keys offset, length,
+# time, pid, host, the Info fields and record (bytes read from the file)
+#
+sub read_indexed_records {
+   my ($file, $cond, $fields, $match) = @_;
+
+   my ($ih, $fh, $line, @vals, $ent, @ents);
+
+   open($ih, "<", "$file.idx") or return ();
+   if(!open($fh, "<:mmap", $file)) {
+      close($ih);
+      return ();
+   }
+   binmode($fh);
+   while($line = <$ih>) {
+      chomp($line);
+      @vals = split(/\t/, $line, 4 + @$fields);
+      next if(defined $cond->{pid} && $vals[3] ne $cond->{pid});
+      next if(defined $cond->{btime} && $vals[2] < $cond->{btime});
+      next if(defined $cond->{etime} && $vals[2] > $cond->{etime});
+      $ent = {};
+      @{$ent}{'offset', 'length', 'time', 'pid', @$fields} = map {defined $_ ? $_ : ""} @vals[0..(3 + @$fields)];
+      $ent->{host} = ($ent->{pid} =~ /^([^-]+)-/ ? $1 : "");
+      next if($match && !$match->($ent));
+      seek($fh, $ent->{offset}, 0);
+      next if(read($fh, $ent->{record}, $ent->{length}) != $ent->{length});
+      push @ents, $ent;
+   }
+   close($ih);
+   close($fh);
+
+   return @ents;
+}
+
+#
+# get the index info of a log record for its sidecar index file, tab separated
+# Time, PIDTag, CPID, Kind and Seconds (run time); undef if the record is not of
+# a kind indexed, run start and end lines, error records, and any JSON records
+#
+sub log_record_index {
+   my ($rec) = @_;
+
+   my ($ent, $cpid);
+
+   $ent = parse_log_line(substr($rec, 0, index($rec, "\n") + 1)) or return undef;
+   $cpid = ($CPID{CPID} ? $CPID{CPID} : "");
+   $cpid =~ s/\s+/ /g;   # keep index info in one line
+
+   return join("\t", $ent->{time}, $ent->{pid}, $cpid, $ent->{kind}, $ent->{secs} || 0);
+}
+
+#
+# index the records of a log file written without index, such as by a previous
+# version, up to offset $end, default to the end of file, in its sidecar index
+# file; called with the log file locked, or lock it here
+#
+sub index_log_file {
+   my ($file, $end) = @_;
+
+   my ($lfh, $ifh, $line, $pos, $rec, $ent, $buf);
+
+   open($lfh, "<", $file) or return;
+   if(!defined $end) {
+      flock($lfh, LOCK_EX);   # not to be appended meanwhile
+      if(-e "$file.idx") {    # indexed by another process
+         close($lfh);
+         return;
+      }
+      $end = -s $file;
+   }
+   $buf = "";
+   for($pos = 0; $pos < $end && defined($line = <$lfh>); $pos += length($line)) {
+      last if($line !~ /\n$/);   # partial line being written
+      $ent = parse_log_line($line);
+      if($ent) {
+         $buf .= join("\t", @{$rec}{qw(offset length time pid)}, "", @{$rec}{qw(kind secs)}) . "\n" if($rec);
+         $rec = $ent;
+         $rec->{offset} = $pos;
+         $rec->{length} = length($line);
+         $rec->{secs} = 0 if(!$rec->{secs});
+      } elsif($rec && $rec->{kind} =~ /^(ERROR|QUITS|ABORTS)$/) {
+         $rec->{length} += length($line);   # body of an error record
+      } elsif($rec) {
+         $buf .= join("\t", @{$rec}{qw(offset length time pid)}, "", @{$rec}{qw(kind secs)}) . "\n";
+         $rec = undef;
+      }
+   }
+   $buf .= join("\t", @{$rec}{qw(offset length time pid)}, "", @{$rec}{qw(kind secs)}) . "\n" if($rec);
+   if(open($ifh, ">>", "$file.idx")) {
+      flock($ifh, LOCK_EX);
+      print $ifh $buf;
+      close($ifh);
+   }
+   close($lfh);
+}
+
+#
+# parse a log line into a hash of index info if it starts a record
+#
+sub parse_log_line {
+   my ($line) = @_;
+
+   my ($kind, $pid, $time, $secs, $msg);
+
+   if($line =~ /^\{"time":(\d+),/) {   # JSON record
+      $time = $1;
+      $kind = ($line =~ /"level":"(\w+)"/ ? $1 : "LOG");
+      $pid = ($line =~ /"pid":"((?:[^"\\]|\\.)*)"/ ? $1 : "");
+      $secs = ($line =~ /"elapsed":(\d+)/ ? $1 : 0);
+      $msg = ($line =~ /"msg":"((?:[^"\\]|\\.)*)"/ ? $1 : "");
+      $kind = "END" if($kind eq "LOG" && $msg =~ /^\S+ (End|Quit|Exit|Abort)\w*( within \w+)?: /);
+      $kind = "START" if($kind eq "LOG" && $msg =~ /^\S+: /);
+   } elsif($line =~ /^(ERROR|QUITS|ABORTS) (\S+)( within (\w+))?.*  at (\d{12})$/) {
+      ($kind, $pid, $secs, $time) = ($1, $2, $4, $5);
+      $time = datetime_to_seconds($time);
+      $secs = string_time_to_seconds($secs);
+   } elsif($line =~ /^(\S+-\S*?(\d{12}))( (End|Quit|Exit|Abort)\w*( within (\w+))?)?: /) {
+      ($pid, $time, $secs) = ($1, $2, $6);
+      $kind = ($3 ? "END" : "START");
+      $secs = string_time_to_seconds($secs);
+      $time = datetime_to_seconds($time) + $secs;
+   } else {
+      return undef;
+   }
+   $pid = "" if(!defined $pid);
+
+   return {time => $time, kind => $kind, pid => $pid, secs => $secs,
+           host => ($pid =~ /^([^-]+)-/ ? $1 : "")};
+}
+
+#
+# convert a date time string YYMMDDHHMMSS from current_datetime() to seconds
+#
+sub datetime_to_seconds {
+   my ($str) = @_;
+
+   return 0 if(!($str && $str =~ /^(\d\d)(\d\d)(\d\d)(\d\d)(\d\d)(\d\d)$/));
+   return POSIX::mktime($6, $5, $4, $3, $2 - 1, $1 + 100, 0, 0, -1);
+}
+
+#
+# convert a time string from seconds_to_string_time(), like 1D2H3M4S, to seconds
+#
+sub string_time_to_seconds {
+   my ($str) = @_;
+
+   my %units = (D => 86400, H => 3600, M => 60, S => 1);
+   my $secs = 0;
+
+   return 0 if(!$str);
+   while($str =~ /(\d+)([DHMS])/g) {
+      $secs += $1 * $units{$2};
+   }
+   return $secs;
+}
+
+#
+# check if a message is repeated more than $MYLOG{DUPMAX} times within the window
+# of $MYLOG{DUPWINS} seconds for its log action class, ERRLOG, WARNLG or EMLLOG;
+# messages are matched by signatures with digits and spaces normalized
+#
+# a suppressed error to be emailed is still counted in $MYLOG{ERRCNT}, and the
+# suppressed ones are summarized by report_duplicates()
+#
+# return 1 if the message is to be suppressed; 0 otherwise
+#
+sub is_duplicate {
+   my ($msg, $logact) = @_;
+
+   my ($class, $win, $sig, $dup, $now);
+
+   return 0 if($logact&SNDEML);
+   $class = logact_class($logact);
+   $win = $MYLOG{DUPWINS}{$class} or return 0;
+
+   $now = time;
+   report_duplicates() if($now > $DUPTIME);
+   $sig = $msg;
+   $sig =~ s/\d+/#/g;
+   $sig =~ s/\s+/ /g;
+   $sig = "$class:$sig";
+   $dup = $MSGDUPS{$sig};
+   if(!$dup) {
+      $MSGDUPS{$sig} = {start => $now, end => $now, count => 1, skip => 0,
+                        win => $win, logact => $logact, msg => $msg};
+      return 0;
+   }
+   $dup->{end} = $now;
+   return 0 if(++$dup->{count} <= $MYLOG{DUPMAX});
+   $dup->{skip}++;
+   $MYLOG{ERRCNT}++ if($logact&ERRLOG && $logact&EMLALL);
+   add_metric("mylog_suppressed_total", "class=\"$class\"");
+
+   return 1;
+}
+
+#
+# return the most severe class of a log action: EXITLG, ERRLOG, WARNLG, EMLLOG or MSGLOG
+#
+sub logact_class {
+   my ($logact) = @_;
+
+   return "EXITLG" if($logact&EXITLG);
+   return "ERRLOG" if($logact&ERRLOG);
+   return "WARNLG" if($logact&WARNLG);
+   return "EMLLOG" if($logact&EMLLOG);
+   return "MSGLOG";
+}
+
+#
+# Function: add_metric($name, $labels, $count)
+# $name   -- counter name, e.g. mylog_records_total
+# $labels -- labels in Prometheus format, e.g. 'class="ERRLOG"'; empty for none
+# $count  -- count to add, default to 1
+#
+sub add_metric {
+   my ($name, $labels, $count) = @_;
+
+   $METRICS{counters}{$name}{$labels} += (defined $count ? $count : 1);
+}
+
+#
+# Function: add_metric_time($name, $labels, $secs)
+# $name   -- histogram name, e.g. mysystem_seconds
+# $labels -- labels in Prometheus format, e.g. 'cmd="tar"'; empty for none
+# $secs   -- observed time in seconds, counted into buckets of @METRICBKTS
+#
+sub add_metric_time {
+   my ($name, $labels, $secs) = @_;
+
+   my ($hist, $i);
+
+   $hist = $METRICS{histograms}{$name}{$labels};
+   $hist = $METRICS{histograms}{$name}{$labels} = {counts => [(0) x @METRICBKTS], sum => 0, count => 0} if(!$hist);
+   for($i = 0; $i < @METRICBKTS; $i++) {
+      last if($secs <= $METRICBKTS[$i]);
+   }
+   $hist->{counts}[$i]++ if($i < @METRICBKTS);
+   $hist->{sum} += $secs;
+   $hist->{count}++;
+}
+
+#
+# Function: dump_metrics($file, $format)
+# $file   -- file to dump the metrics to; default to a file named
+#            Host.Command.PID.Format under $MYLOG{METRICPATH}
+# $format -- 'prom' for Prometheus text format or 'json'; default to $MYLOG{METRICFMT}
+#
+# dump the metrics collected in this process, called at exit if $MYLOG{METRICPATH}
+# is set; the file is written to a temporary name and renamed to be atomic
+#
+# Return: SUCCESS or FAILURE
+#
+sub dump_metrics {
+   my ($file, $format) = @_;
+
+   my ($name, $labels, $hist, $str, $lbls, $i, $cnt, @items, $fh);
+   my $job = 'host="' . $MYLOG{HOSTNAME} . '",prog="' . get_command() . '"';
+
+   $format = $MYLOG{METRICFMT} if(!$format);
+   if(!$file) {
+      return FAILURE if(!$MYLOG{METRICPATH});
+      $file = "$MYLOG{METRICPATH}/$MYLOG{HOSTNAME}." . get_command() . ".$$.$format";
+   }
+
+   if($format eq "json") {
+      foreach $name (sort keys %{$METRICS{counters}}) {
+         foreach $labels (sort keys %{$METRICS{counters}{$name}}) {
+            push @items, sprintf("{\"name\":%s,\"labels\":%s,\"value\":%s}", json_string($name),
+                                 json_string($labels), $METRICS{counters}{$name}{$labels});
+         }
+      }
+      foreach $name (sort keys %{$METRICS{histograms}}) {
+         foreach $labels (sort keys %{$METRICS{histograms}{$name}}) {
+            $hist = $METRICS{histograms}{$name}{$labels};
+            push @items, sprintf("{\"name\":%s,\"labels\":%s,\"buckets\":[%s],\"counts\":[%s],\"sum\":%.6f,\"count\":%d}",
+                                 json_string($name), json_string($labels), join(",", @METRICBKTS),
+                                 join(",", @{$hist->{counts}}), $hist->{sum}, $hist->{count});
+         }
+      }
+      $str = sprintf("{\"host\":%s,\"prog\":%s,\"pid\":%d,\"time\":%d,\"metrics\":[%s]}\n",
+                     json_string($MYLOG{HOSTNAME}), json_string(get_command()), $$, time, join(",\n", @items));
+   } else {
+      $str = "";
+      foreach $name (sort keys %{$METRICS{counters}}) {
+         $str .= "# TYPE $name counter\n";
+         foreach $labels (sort keys %{$METRICS{counters}{$name}}) {
+            $lbls = ($labels ? "$job,$labels" : $job);
+            $str .= "$name\{$lbls\} $METRICS{counters}{$name}{$labels}\n";
+         }
+      }
+      foreach $name (sort keys %{$METRICS{histograms}}) {
+         $str .= "# TYPE $name histogram\n";
+         foreach $labels (sort keys %{$METRICS{histograms}{$name}}) {
+            $hist = $METRICS{histograms}{$name}{$labels};
+            $lbls = ($labels ? "$job,$labels" : $job);
+            for($cnt = $i = 0; $i < @METRICBKTS; $i++) {
+               $cnt += $hist->{counts}[$i];
+               $str .= "${name}_bucket\{$lbls,le=\"$METRICBKTS[$i]\"\} $cnt\n";
+            }
+            $str .= "${name}_bucket\{$lbls,le=\"+Inf\"\} $hist->{count}\n";
+            $str .= sprintf("%s_sum{%s} %.6f\n", $name, $lbls, $hist->{sum});
+            $str .= "${name}_count\{$lbls\} $hist->{count}\n";
+         }
+      }
+   }
+
+   open($fh, ">", "$file.$$.tmp") or return FAILURE;
+   print $fh $str;
+   close($fh);
+   return (rename("$file.$$.tmp", $file) ? SUCCESS : FAILURE);
+}
+
+#
+# return a Prometheus label string for the base name of the program of a command
+#
+sub command_label {
+   my ($cmd) = @_;
+
+   my $name = ($cmd =~ /^\s*(\S+)/ ? basename($1) : "");
+
+   $name =~ s/(["\\])/\\$1/g;
+   return "cmd=\"$name\"";
+}
+
+#
+# log "repeated N times over T seconds" summaries for the suppressed messages
+# whose windows are expired, or all of them if $all is set
+#
+sub report_duplicates {
+   my ($all) = @_;
+
+   my ($sig, $dup, $msg);
+
+   $DUPTIME = time;
+   foreach $sig (keys %MSGDUPS) {
+      $dup = $MSGDUPS{$sig};
+      next if(!$all && ($DUPTIME - $dup->{start}) < $dup->{win});
+      delete $MSGDUPS{$sig};
+      next if(!$dup->{skip});
+      $msg = $dup->{msg};
+      $msg =~ s/\s+$//;
+      $msg = "Repeated $dup->{count} times over " .
+             (seconds_to_string_time($dup->{end} - $dup->{start}) || "0S") .
+             " ($dup->{skip} not logged): $msg";
+      $MYLOG{ERRCNT}-- if($dup->{logact}&ERRLOG && $dup->{logact}&EMLALL);   # counted again by set_email()
+      mylog($msg, $dup->{logact}&(~EXITLG));
+   }
+}
+
+# mydbg($level, $msg, @locs) return none
+# $msg  -- message to log, or a deferred message as for mylog()
+# @locs -- array of file names and line numbers of function calling trace
 #
 # log message for degugging processes 
 #
-sub mydbg {
-   my ($level, $msg, @locs) = @_;
+sub mydbg {
+   my ($level, $msg, @locs) = @_;
+
+   my ($dfile, $range, $loc, $name);
+
+   if($MYLOG{DBGRING}) {   # record for dumping on error, built only if dumped
+      $DBGRING[$DBGRIDX++ % $MYLOG{DBGRING}] = [time, $level, $msg, (@locs ? \@locs : undef)];
+   }
+   return if(!$MYLOG{DBGLEVEL});
+   set_debug_level($MYLOG{DBGLEVEL}, @locs) if($MYLOG{DBGLEVEL} ne $DBGFILTER{spec});
+   return if($level > $DBGFILTER{max} || $level < $DBGFILTER{min});
+
+   $range = $DBGFILTER{all};
+   if(%{$DBGFILTER{files}}) {   # find levels for the caller file
+      foreach $loc (@locs ? @locs : (caller)[1]) {
+         next if(!$loc || $loc =~ /^\d+$/);
+         $name = basename($loc);
+         $name = $1 if(!$DBGFILTER{files}{$name} && $name =~ /^(.+)\.\w+$/);
+         if($DBGFILTER{files}{$name}) {
+            $range = $DBGFILTER{files}{$name};
+            last;
+         }
+      }
+   }
+   return if(!$range || $level > $range->[1] || $level < $range->[0]);
+
+   $msg = build_message($msg) if(ref $msg);
+   $dfile = $MYLOG{DBGPATH};
+   $dfile .= "/$MYLOG{DBGFILE}" if($dfile);
+
+   if(!$msg) {
+      mylog("Append debug Info (levels $MYLOG{DBGLEVEL}) to $dfile", WARNLG);
+      $level = "$range->[0]-$range->[1]";
+      $msg = "DEBUG for $CPID{PID} ";
+      $msg .= "$CPID{CPID} <= " if($CPID{CPID});
+      $msg .= break_long_string($CPID{CMD}, 40, "...", 1);
+   }
+
+   # logging debug info
+   $msg = "$level:$msg\n";
+   $msg .= get_call_trace(@locs) if(@locs);
+   write_log($dfile, $msg) or mylog("Error open '>> $dfile': $!", LGEREX, @locs);
+}
+
+#
+# dump the debug records kept in the flight recorder to a log file, the file of
+# the record when mylog() is called with ERRLOG or EXITLG, or the debug file for
+# JSON records; deferred messages are built now, so a code reference or sprintf()
+# arguments see the values at the time of dumping; the recorder is emptied after
+#
+sub dump_debug_ring {
+   my ($file) = @_;
+
+   my ($i, $cnt, $size, $ent, $msg, $str);
+
+   $size = @DBGRING;
+   $cnt = ($DBGRIDX < $size ? $DBGRIDX : $size);
+   return if(!$cnt);
+
+   $str = "DEBUG RING for $CPID{PID}: last $cnt debug record(s)\n";
+   for($i = $DBGRIDX - $cnt; $i < $DBGRIDX; $i++) {
+      $ent = $DBGRING[$i % $size];
+      $msg = (ref $ent->[2] ? build_message($ent->[2]) : $ent->[2]);
+      $msg = "" if(!defined $msg);
+      $msg =~ s/\n$//;
+      $str .= current_datetime($ent->[0]) . " $ent->[1]:$msg\n";
+      $str .= get_call_trace(@{$ent->[3]}) if($ent->[3]);
+   }
+   $str .= "END DEBUG RING\n";
+   @DBGRING = ();
+   $DBGRIDX = 0;
+
+   write_log($file, $str);
+}
+
+#
+# Function: set_debug_level($spec, @locs)
+# $spec -- debug levels, comma separated ranges of "N" (0-N) or "N-M"; a range
+#          prefixed by "Name:" applies only to the callers in file Name, matched
+#          by base name with or without extension, e.g. "0-3,MyDBI:5-9,dsarch:9"
+#
+# set $MYLOG{DBGLEVEL} and compile it into the debug level filter for mydbg();
+# mydbg() also recompiles it if $MYLOG{DBGLEVEL} is changed directly
+#
+sub set_debug_level {
+   my ($spec, @locs) = @_;
+
+   my ($item, $name, $range);
+
+   $MYLOG{DBGLEVEL} = $spec;
+   %DBGFILTER = (spec => (defined $spec ? $spec : ""), min => 9999, max => -1,
+                 all => undef, files => {});
+   return if(!$spec);
+
+   foreach $item (split(/\s*,\s*/, $spec)) {
+      $name = ($item =~ s/^([^:]+)://) ? $1 : undef;
+      if($item =~ /^(\d+)$/) {
+         $range = [0, $1];
+      } elsif($item =~ /^(\d*)-(\d*)$/) {
+         $range = [($1 ? $1 : 0), ($2 ? $2 : 9999)];
+         $range = [$range->[1], $range->[0]] if($range->[1] < $range->[0]);
+      } else {
+         mylog("$spec: Invalid Debug Levels", LGEREX, @locs);
+      }
+      if(defined $name) {
+         $DBGFILTER{files}{$name} = $range;
+      } else {
+         $DBGFILTER{all} = $range;
+      }
+      $DBGFILTER{min} = $range->[0] if($range->[0] < $DBGFILTER{min});
+      $DBGFILTER{max} = $range->[1] if($range->[1] > $DBGFILTER{max});
+   }
+}
+
+#
+# Function: write_log($file, $str, $flush)
+# $file  -- full path of the log file to append the record to
+# $str   -- record to append
+# $flush -- write out the buffered records of $file right away if set
+#
+# append a record to a log file via a handle kept open for the process; records
+# are buffered and written once $MYLOG{LOGBUFSZ} bytes are buffered for the file
+# or $MYLOG{LOGFLUSH} seconds passed since the last flush; records are queued
+# to a background log writer instead if $MYLOG{LOGASYNC} is set
+#
+# $index -- index info of the record, tab separated fields; written with the
+#           record offset and length to the sidecar index file "$file.idx"
+#
+# return SUCCESS, or FAILURE if the log file cannot be opened
+#
+sub write_log {
+   my ($file, $str, $flush, $index) = @_;
+
+   return FAILURE if(!$file);
+   utf8::encode($str) if(defined $str && utf8::is_utf8($str));
+   if(start_log_writer()) {
+      queue_log($file, $str, $index) if(defined $str && length($str));
+      return SUCCESS;
+   }
+   return FAILURE if(!get_log_handle($file));
+
+   if(defined $str) {
+      if(defined $index) {
+         push @{$LOGFILES{indexes}{$file}}, [length($LOGFILES{buffers}{$file}), length($str), $index];
+      }
+      $LOGFILES{buffers}{$file} .= $str;
+   }
+   if($flush || length($LOGFILES{buffers}{$file}) >= $MYLOG{LOGBUFSZ}) {
+      flush_log($file);
+   } elsif((time - $LOGFILES{ftime}) >= $MYLOG{LOGFLUSH}) {
+      flush_logs();
+   }
+
+   return SUCCESS;
+}
+
+#
+# return the cached handle for appending to $file, open it if not cached yet
+#
+sub get_log_handle {
+   my ($file) = @_;
+
+   my $fh;
+
+   check_log_owner();
+   return $LOGFILES{handles}{$file} if($LOGFILES{handles}{$file});
+
+   open($fh, ">>", $file) or return undef;
+   $LOGFILES{handles}{$file} = $fh;
+   $LOGFILES{buffers}{$file} = "" if(!defined $LOGFILES{buffers}{$file});
+
+   return $fh;
+}
+
+#
+# write out the buffered records of a given log file, and then their index info
+# to the sidecar index file; both are written under an exclusive lock on the
+# log file, so records appended by processes on any host never interleave
+#
+# records not written, for the log file cannot be reopened or a short write, are
+# kept in the buffer with their index info for the next flush
+#
+sub flush_log {
+   my ($file) = @_;
+
+   my ($fh, $buf, $len, $off, $cnt, $pos, $idxes, @done);
+
+   $buf = $LOGFILES{buffers}{$file};
+   return if(!(defined $buf && length($buf)));
+   $len = length($buf);
+   $fh = lock_log_handle($file, $len) or return;
+
+   for($off = 0; $off < $len; $off += $cnt) {
+      $cnt = syswrite($fh, $buf, $len - $off, $off);
+      last if(!$cnt);
+   }
+   $LOGFILES{buffers}{$file} = substr($buf, $off);
+   $idxes = delete $LOGFILES{indexes}{$file};
+   if($idxes) {
+      @done = grep {$_->[0] + $_->[1] <= $off} @{$idxes};
+      $LOGFILES{indexes}{$file} = [map {[$_->[0] - $off, $_->[1], $_->[2]]} grep {$_->[0] >= $off} @{$idxes}] if($off < $len);
+   }
+   if(@done) {
+      $pos = sysseek($fh, 0, 1) - $off;   # appended at the end of file
+      index_log_file($file, $pos) if($pos > 0 && !-e "$file.idx");   # records not indexed
+      write_log("$file.idx", join("", map {($pos + $_->[0]) . "\t$_->[1]\t$_->[2]\n"} @done), 1);
+   }
+   flock($fh, LOCK_UN);
+}
+
+#
+# lock a log file exclusively for appending $len bytes; reopen it if it is rolled
+# or removed by another process, and roll it first if it reaches $MYLOG{LOGROTSZ}
+# bytes, or it is last modified on a previous day and $MYLOG{LOGROTDAY} is set
+#
+# return the locked file handle; undef if the log file cannot be reopened
+#
+sub lock_log_handle {
+   my ($file, $len) = @_;
+
+   my ($fh, @fstat, @pstat);
+
+   while(1) {
+      $fh = get_log_handle($file) or return undef;
+      flock($fh, LOCK_EX);
+      @fstat = stat($fh);
+      @pstat = stat($file);
+      if(@pstat && $pstat[0] == $fstat[0] && $pstat[1] == $fstat[1]) {
+         return $fh if($file =~ /\.idx$/ || !log_roll_due(\@fstat, $len) || !roll_log_file($file));
+      }
+      flock($fh, LOCK_UN);   # rolled, reopen it
+      close($fh);
+      delete $LOGFILES{handles}{$file};
+   }
+}
+
+#
+# check if a log file, given stat() info, is due to be rolled before appending
+# $len bytes
+#
+sub log_roll_due {
+   my ($fstat, $len) = @_;
+
+   my (@mdate, @cdate);
+
+   return 0 if(!$fstat->[7]);   # empty file
+   return 1 if($MYLOG{LOGROTSZ} > 0 && ($fstat->[7] + $len) > $MYLOG{LOGROTSZ});
+   if($MYLOG{LOGROTDAY}) {
+      @mdate = localtime($fstat->[9]);
+      @cdate = localtime;
+      return 1 if($mdate[3] != $cdate[3] || $mdate[4] != $cdate[4] || $mdate[5] != $cdate[5]);
+   }
+
+   return 0;
+}
+
+#
+# roll a locked log file, and its sidecar index file if any, to names suffixed
+# with current date time, and compress the rolled log file in background; the
+# index file of a compressed log file is removed, as its offsets are not valid
+# in the compressed file, so query_logs() does not search compressed segments
+#
+# return SUCCESS, or FAILURE if cannot rename the log file
+#
+sub roll_log_file {
+   my ($file) = @_;
+
+   my ($base, $rolled, @zipped);
+   my $i = 0;
+
+   $rolled = $base = "$file." . current_datetime();
+   while(-e $rolled || (@zipped = glob("$rolled.[a-zA-Z]*"))) {   # rolled in the same second
+      $rolled = "$base." . ++$i;
+   }
+   return FAILURE if(!rename($file, $rolled));
+   if($MYLOG{LOGCOMPRESS}) {
+      unlink("$file.idx");
+      compress_log_file($rolled);
+   } elsif(-e "$file.idx") {
+      rename("$file.idx", "$rolled.idx");
+   }
+
+   return SUCCESS;
+}
+
+#
+# compress a rolled log file with $MYLOG{LOGCOMPRESS} in a detached process
+#
+sub compress_log_file {
+   my ($file) = @_;
+
+   my $pid = fork;
+
+   return if(!defined $pid);
+   if($pid == 0) {
+      POSIX::setsid();
+      if(!fork) {
+         exec(split(/\s+/, $MYLOG{LOGCOMPRESS}), $file);
+      }
+      POSIX::_exit(0);
+   }
+   waitpid($pid, 0);
+}
+
+#
+# write out buffered records of all log files, called before exit
+#
+sub flush_logs {
+   my $file;
+
+   return if($LOGFILES{pid} != $$);   # buffers belong to the parent process
+
+   replay_log_spill(0) if($LOGFILES{spill});
+   foreach $file (keys %{$LOGFILES{buffers}}) {
+      flush_log($file);
+   }
+   $LOGFILES{ftime} = time;
+}
+
+#
+# write out all buffered and queued records, and stop the background log
+# writer; called before exit
+#
+sub close_logs {
+   stop_log_writer();
+   flush_logs();
+}
+
+#
+# reset the cached log handles, buffers and writer queue inherited by a forked
+# child process, they are left to the parent process
+#
+sub check_log_owner {
+   return if($LOGFILES{pid} == $$);
+
+   close($LOGFILES{pipe}) if($LOGFILES{pipe});
+   close($LOGFILES{wpipe}) if($LOGFILES{wpipe});
+   $LOGFILES{pid} = $$;
+   $LOGFILES{handles} = {};
+   $LOGFILES{buffers} = {};
+   $LOGFILES{indexes} = {};
+   $LOGFILES{writer} = $LOGFILES{dropped} = $LOGFILES{nowrite} = 0;
+   $LOGFILES{pipe} = $LOGFILES{wpipe} = undef;
+   $LOGFILES{queue} = [];
+   $LOGFILES{pending} = "";
+   $LOGFILES{spill} = "";
+}
+
+#
+# start the background log writer process if $MYLOG{LOGASYNC} is set; the writer
+# is detached like compress_log_file(), so it is not a child the calling script
+# may wait for or reap; it writes its pid to a second pipe, and holds the pipe
+# open till it quits
+#
+# return 1 if log records are to be queued to the log writer; 0 otherwise
+#
+sub start_log_writer {
+   my ($rfh, $wfh, $rwfh, $wwfh, $pid, $wpid);
+
+   check_log_owner();
+   return 1 if($LOGFILES{writer});
+   return 0 if(!$MYLOG{LOGASYNC} || $LOGFILES{nowrite});
+
+   $LOGFILES{nowrite} = 1;   # do not try again if fails
+   return 0 if(!pipe($rfh, $wfh));
+   if(!pipe($rwfh, $wwfh)) {
+      close($rfh);
+      close($wfh);
+      return 0;
+   }
+   flush_logs();
+   $pid = fork;
+   if($pid == 0) {
+      close($wfh);
+      close($rwfh);
+      POSIX::setsid();
+      $wpid = fork;
+      if(defined $wpid && $wpid == 0) {
+         syswrite($wwfh, "$$\n");
+         run_log_writer($rfh);   # never returns
+      }
+      POSIX::_exit(0);
+   }
+   close($rfh);
+   close($wwfh);
+   waitpid($pid, 0) if(defined $pid);
+   $wpid = (defined $pid ? <$rwfh> : undef);
+   if(!$wpid) {   # writer not started
+      close($wfh);
+      close($rwfh);
+      return 0;
+   }
+   chomp($wpid);
+   $wfh->blocking(0);
+   $LOGFILES{writer} = $wpid;
+   $LOGFILES{pipe} = $wfh;
+   $LOGFILES{wpipe} = $rwfh;
+   $LOGFILES{nowrite} = 0;
+
+   return 1;
+}
+
+#
+# close the pipe to the background log writer, and wait for the writer to quit
+# by reading EOF from the pipe it holds
+#
+sub wait_log_writer {
+   my ($buf, $cnt);
+
+   close($LOGFILES{pipe});
+   while(1) {
+      $cnt = sysread($LOGFILES{wpipe}, $buf, 64);
+      last if(defined $cnt ? !$cnt : !$!{EINTR});
+   }
+   close($LOGFILES{wpipe});
+   $LOGFILES{writer} = 0;
+   $LOGFILES{pipe} = $LOGFILES{wpipe} = undef;
+}
+
+#
+# queue a log record to the background log writer; if more than $MYLOG{LOGQSIZE}
+# records are waiting, $MYLOG{LOGQMODE} decides to block till the writer catches
+# up, drop the record, or spill the queued records to a file under $MYLOG{TMPPATH}
+#
+# once spilled, the following records are spilled too, in order, till the queue
+# is drained; then the writer is told to replay the spill file before any others
+#
+sub queue_log {
+   my ($file, $str, $index) = @_;
+
+   $file .= "\t" . length($str);
+   $file .= "\t$index" if(defined $index);
+   push @{$LOGFILES{queue}}, "$file\n$str";
+   if($LOGFILES{spill}) {
+      pump_log_queue(1) if(!spill_log_queue());
+      replay_log_spill(0);
+      return;
+   }
+   pump_log_queue(0);
+   return if(@{$LOGFILES{queue}} <= $MYLOG{LOGQSIZE});
+
+   if($MYLOG{LOGQMODE} eq "drop") {
+      pop @{$LOGFILES{queue}};
+      $LOGFILES{dropped}++;
+   } elsif(!($MYLOG{LOGQMODE} eq "spill" && spill_log_queue())) {
+      pump_log_queue(1);
+   }
+}
+
+#
+# send queued log records to the background log writer; stop when the pipe is
+# full unless $block is set
+#
+sub pump_log_queue {
+   my ($block) = @_;
+
+   my ($fh, $cnt);
+
+   local $SIG{PIPE} = 'IGNORE';
+   $fh = $LOGFILES{pipe};
+   $fh->blocking(1) if($block);
+   while(length($LOGFILES{pending}) || @{$LOGFILES{queue}}) {
+      $LOGFILES{pending} = shift(@{$LOGFILES{queue}}) if(!length($LOGFILES{pending}));
+      $cnt = syswrite($fh, $LOGFILES{pending});
+      if(!defined $cnt) {
+         last if($!{EAGAIN});
+         return abort_log_writer();   # log writer is gone
+      }
+      substr($LOGFILES{pending}, 0, $cnt) = "";
+   }
+   $fh->blocking(0) if($block);
+}
+
+#
+# spill queued log records to the local file $MYLOG{TMPPATH}/mylog.PID.spill.N;
+# the log writer writes them to the log files once the queue is drained
+#
+# return SUCCESS if all queued records spilled, FAILURE otherwise
+#
+sub spill_log_queue {
+   my ($fh, $spill);
+
+   $spill = ($LOGFILES{spill} ? $LOGFILES{spill} : "$MYLOG{TMPPATH}/mylog.$$.spill." . ($LOGFILES{spillno} + 1));
+   open($fh, ">>", $spill) or return FAILURE;
+   print $fh @{$LOGFILES{queue}};
+   close($fh) or return FAILURE;
+   $LOGFILES{queue} = [];
+   if(!$LOGFILES{spill}) {
+      $LOGFILES{spill} = $spill;
+      $LOGFILES{spillno}++;
+   }
 
-   my ($dfile, @levels);
+   return SUCCESS;
+}
 
-   return if(!$MYLOG{DBGLEVEL});
+#
+# send the frame "\tspill\tFileName\n" to tell the log writer to write the records
+# in the spill file, once the records queued before are all sent, or wait till
+# they are sent if $block is set
+#
+sub replay_log_spill {
+   my ($block) = @_;
+
+   return if(!$LOGFILES{spill});
+   pump_log_queue($block);
+   return if(length($LOGFILES{pending}) || @{$LOGFILES{queue}} || !$LOGFILES{writer});
+   push @{$LOGFILES{queue}}, "\tspill\t$LOGFILES{spill}\n";
+   $LOGFILES{spill} = "";
+   pump_log_queue($block);
+}
+
+#
+# drain the queued log records to the background log writer, and wait for it
+# to write all records out and quit
+#
+sub stop_log_writer {
+   my $dropped;
+
+   return if(!$LOGFILES{writer} || $LOGFILES{pid} != $$);
+
+   $dropped = $LOGFILES{dropped};
+   if($dropped) {
+      $LOGFILES{dropped} = 0;
+      queue_log("$MYLOG{LOGPATH}/$MYLOG{LOGFILE}",
+                "$dropped log record(s) dropped for full log queue\n");
+   }
+   replay_log_spill(1);
+   push @{$LOGFILES{queue}}, "\t0\n";   # tell the writer to quit
+   pump_log_queue(1);
+   return if(!$LOGFILES{writer});   # aborted
+   wait_log_writer();
+}
+
+#
+# the background log writer is gone; write the queued records in process
+#
+sub abort_log_writer {
+   my $buf;
+
+   wait_log_writer();
+   $LOGFILES{nowrite} = 1;
+   $LOGFILES{pending} = "";   # a partially sent record is lost
+   $buf = join("", @{$LOGFILES{queue}});
+   $buf .= "\tspill\t$LOGFILES{spill}\n" if($LOGFILES{spill});
+   $LOGFILES{queue} = [];
+   $LOGFILES{spill} = "";
+   write_log_frames(\$buf);
+   write_log("$MYLOG{LOGPATH}/$MYLOG{LOGFILE}", "Background log writer is gone\n");
+}
 
-   if($MYLOG{DBGLEVEL} =~ /^(\d+)$/) {
-      $levels[0] = 0;
-      $levels[1] = $1;
-   } elsif($MYLOG{DBGLEVEL} =~ /^(\d*)-(\d*)$/) {
-      $levels[0] = ($1 ? $1 : 0);
-      $levels[1] = ($2 ? $2 : 9999);
-      @levels = ($levels[1], $levels[0]) if($levels[1] < $levels[0]);
+#
+# main loop of the background log writer process, reading record frames from
+# the pipe and writing them out via the buffered log writer
+#
+sub run_log_writer {
+   my ($rfh) = @_;
+
+   my ($rin, $cnt, $spill);
+   my $buf = "";
+   my $spills = "$MYLOG{TMPPATH}/mylog.$LOGFILES{pid}.spill.*";   # by parent process
+
+   $SIG{INT} = $SIG{QUIT} = $SIG{TERM} = $SIG{HUP} = 'IGNORE';   # quit when told by parent
+   $MYLOG{LOGASYNC} = 0;
+   check_log_owner();
+
+   while(1) {
+      $rin = "";
+      vec($rin, fileno($rfh), 1) = 1;
+      if(select($rin, undef, undef, $MYLOG{LOGFLUSH} > 0 ? $MYLOG{LOGFLUSH} : 1) < 1) {
+         flush_logs();   # idle, write out buffered records
+         next;
+      }
+      $cnt = sysread($rfh, $buf, 65536, length($buf));
+      last if(!$cnt);      # parent is gone
+      last if(write_log_frames(\$buf));
    }
-   if(!@levels || $levels[1] < $levels[0]) {
-      mylog("$MYLOG{DBGLEVEL}: Invalid Debug Levels", LGEREX, @locs);
+   foreach $spill (sort {($a =~ /(\d+)$/)[0] <=> ($b =~ /(\d+)$/)[0]} glob($spills)) {
+      write_log_spill($spill);   # not replayed, parent is gone
    }
+   flush_logs();
+   POSIX::_exit(0);
+}
 
-   return if($level > $levels[1] || $level < $levels[0]);
+#
+# write the log records in a spill file, and remove the file
+#
+sub write_log_spill {
+   my ($spill) = @_;
 
-   $dfile = $MYLOG{DBGPATH};
-   $dfile .= "/$MYLOG{DBGFILE}" if($dfile);
+   my ($fh, $buf);
 
-   if(!$msg) {
-      mylog("Append debug Info (levels $levels[0]-$levels[1]) to $dfile", WARNLG);
-      $level = "$levels[0]-$levels[1]";
-      $msg = "DEBUG for $CPID{PID} ";
-      $msg .= "$CPID{CPID} <= " if($CPID{CPID});
-      $msg .= break_long_string($CPID{CMD}, 40, "...", 1);
+   return if(!open($fh, "<", $spill));
+   $buf = do { local $/; <$fh> };
+   close($fh);
+   unlink($spill);
+   write_log_frames(\$buf);
+}
+
+#
+# write complete record frames, "FileName\tLength[\tIndex]\nRecord", in the buffer,
+# and leave a partial frame in the buffer; a frame "\tspill\tSpillFile\n" is to
+# write the records in the spill file
+#
+# return 1 if the quit frame is found; 0 otherwise
+#
+sub write_log_frames {
+   my ($buf) = @_;
+
+   my ($pos, $file, $len, $index);
+
+   while(($pos = index($$buf, "\n")) > -1) {
+      ($file, $len, $index) = split(/\t/, substr($$buf, 0, $pos), 3);
+      if(!$file && $len eq "spill") {
+         substr($$buf, 0, $pos + 1) = "";
+         write_log_spill($index);
+         next;
+      }
+      return 1 if(!$file);
+      last if(length($$buf) < $pos + 1 + $len);
+      write_log($file, substr($$buf, $pos + 1, $len), 0, $index);
+      substr($$buf, 0, $pos + 1 + $len) = "";
    }
 
-   # logging debug info
-   open DBG, ">> $dfile" or mylog("Error open '>> $dfile': $!", LGEREX, @locs);
-   print DBG "$level:$msg\n";
-   print DBG get_call_trace(@locs) if(@locs);
-   close(DBG);
+   return 0;
+}
+
+END {
+   flush_email_digests(1) if(%EMLDIGESTS);
+   report_duplicates(1);
+   dump_metrics() if($MYLOG{METRICPATH});
+   close_logs();
+   clear_email() if($EMLBUF{spfh});
+   smtp_close();
 }
  
 #
@@ -720,146 +2733,715 @@ sub myrec {
 }
 
 #
-# Function: mysystem($cmd, $logact, $cmdopt)
-# $cmd - unix system command
-# $cmdopt - 0 - no log,
-#           1 - cmd (catch and pass the previous system calls),
-#           2 - log standard output,
-#           4 - log error output;
-#           7 - log all (cmd, and standard/error outputs),
-#           8 - log command with time,
-#          16 - return standard output message upon success
-#          32 - log error as standard output
-#          64 - force returning FAILURE if called process aborts
-#         128 - tries 2 times for failed cammand before quits
-#         256 - cashe standard error message
+# Function: mysystem($cmd, $logact, $cmdopt)
+# $cmd - unix system command
+# $cmdopt - 0 - no log,
+#           1 - cmd (catch and pass the previous system calls),
+#           2 - log standard output,
+#           4 - log error output;
+#           7 - log all (cmd, and standard/error outputs),
+#           8 - log command with time,
+#          16 - return standard output message upon success
+#          32 - log error as standard output
+#          64 - force returning FAILURE if called process aborts
+#         128 - tries 2 times for failed cammand before quits, by the 'default'
+#               retry policy; see set_retry_policy() for retry policies
+#         256 - cashe standard error message
+#         512 - reuse the result of the same successful command run by the same user
+#               in the same directory and environment within $MYLOG{CMDCACHETTL}
+#               seconds, for read-only queries; not with 2, as the standard output
+#               is not logged again; see command_cache_get()
+#
+sub mysystem {
+   my ($cmd, $logact, $cmdopt, @locs) = @_;
+
+   return mysystem_stream($cmd, $logact, $cmdopt, undef, @locs);
+}
+
+#
+# Function: mysystem_stream($cmd, $logact, $cmdopt, $callback)
+# $cmdopt   -- as of mysystem(), except 16 that is ignored
+# $callback -- code reference called as $callback->($line, $isstd) for each output
+#              line while the command runs, with $isstd 1 for a line taken as
+#              standard output by mysystem(), 0 for an error line; the command is
+#              stopped if it returns true
+#
+# run a command as mysystem(), but pass its output lines to a callback instead of
+# holding them, for commands of large output; for example
+#   mysystem_stream("hsi ls -1 $dir", LOGWRN, 4, sub {print $_[0] if($_[1]); 0});
+#
+# Return: SUCCESS or FAILURE; $SYSRESULT{stopped} is set if stopped by $callback
+#
+sub mysystem_stream {
+   my ($cmd, $logact, $cmdopt, $callback, @locs) = @_;
+
+   my ($line, $act, $stdout, $error, $isstd);
+   my ($cmdlog, $stdlog, $errlog, $last, $end, $abort);
+   my ($loop, $loops, $stime, $label, $online, $res);
+   my ($policy, $target, $errtxt, $retry, $wait, $msg, $key, $deadline);
+   my $ret = SUCCESS;
+
+   return $ret if(!$cmd);  # empty command
+
+   $stime = Time::HiRes::time;
+   $deadline = ($MYLOG{CMDTIME} ? $stime + $MYLOG{CMDTIME} : 0);   # for all tries
+   $label = command_label($cmd);
+
+   $cmd = untaint_string($cmd);
+
+   if($logact) {
+      $act = ($logact&(~EXITLG));
+      $act = ($act&(~ERRLOG))|WARNLG if($act&ERRLOG);
+   } else {
+      $act = $logact = LOGWRN; # set default log action option 
+   }
+   $act |= FRCLOG if($act&MSGLOG); # make sure system calls always logged
+   $cmdopt = 5 if(!defined $cmdopt);   # set default command log option
+   $cmdlog = ($cmdopt&1 ? $act : 0);
+   ($cmdopt&8) ? cmdlog("starts '$cmd'", undef, $cmdlog) : mylog("> $cmd", $cmdlog) if($cmdlog);
+   $stdlog = ($cmdopt&2) ? $act : 0;
+   $stdout = ($cmdopt&16 && !$callback) ? "" : undef;
+   $MYLOG{SYSERR} = ($cmdopt&256) ? "" : undef;
+   if($cmdopt&512 && !($cmdopt&2) && !$callback) {
+      $key = join("\t", ($MYLOG{SETUID} ? $MYLOG{SETUID} : $MYLOG{CURUID}), $cmdopt&(16|32|64|256),
+                  (Cwd::getcwd() || ""), Digest::MD5::md5_hex(map {"$_=$ENV{$_}\n"} sort keys %ENV), $cmd);
+      $res = command_cache_get($key, $label);
+      if($res) {   # no fork for the cached result
+         $MYLOG{SYSERR} = (defined $res->{syserr} ? $res->{syserr} : "") if(defined $MYLOG{SYSERR});
+         %SYSRESULT = (cmd => $cmd, cached => 1);
+         add_metric("mysystem_calls_total", $label . ',status="success"');
+         $MYLOG{SYSRET} = SUCCESS;
+         return (defined $stdout ? $res->{stdout} : SUCCESS);
+      }
+   }
+   $policy = retry_policy($cmd, $cmdopt);
+   $loops = ($policy ? $policy->{attempts} : 1);
+   $target = command_target($cmd) if($policy && $policy->{breaker});
+
+   $online = sub {   # process output lines of the command; return 1 to stop it
+      my ($lines, $isstd) = @_;
+
+      my ($line, $isout);
+
+      foreach $line (@$lines) {
+         $isout = (($line =~ /\r/ || $line eq "\n") ? strip_output_line(\$line, $isstd) : $isstd);
+         if($isout) {
+            if($MYLOG{STD2ERR} && std2err($line)) {
+               $isout = 0;
+            } else {
+               $ret  = SUCCESS if($ret == FAILURE && mytrim($line));
+               $line = '>' . $line if($line =~ /^>\s/);
+            }
+         } elsif($MYLOG{ERR2STD} && err2std($line)) {
+            $isout = 1;
+         } elsif($cmdopt&32) {
+            $isout = 1;
+            $MYLOG{SYSERR} .= $line if(defined $MYLOG{SYSERR});
+         }
+         if($isout) {
+            mylog($line, $stdlog) if($stdlog);
+            $stdout .= $line if(defined $stdout);
+         } else {
+            $ret  = FAILURE;
+            $error .= $line if($cmdopt&4 || defined $MYLOG{SYSERR});
+            $errtxt .= $line if($policy && length($errtxt) < 65536);
+            $abort = 1 if($abort == -1 && $line =~ /^ABORTS /);
+         }
+         return 1 if($callback && $callback->($line, $isout));
+      }
+      return 0;
+   };
+
+   for($loop = 1; ; $loop++) {
+      $ret = SUCCESS;
+      $error = $errtxt = "";
+      $stdout = "" if(defined $stdout);
+      $abort = ($cmdopt&64) ? -1 : 0;
+      $last = time;
+      if($target && ($msg = circuit_check($target))) {   # do not run
+         $ret = FAILURE;
+         $res = {timedout => 0, stopped => 0};
+         %SYSRESULT = (cmd => $cmd, circuit => $target);
+         $error = "$msg\n";
+      } else {
+         $res = run_command($cmd, $online, ($deadline ? $deadline - Time::HiRes::time : 0));
+         return mylog("open '$cmd': $!", $logact, @locs, __FILE__, __LINE__) if(!$res);
+         %SYSRESULT = (cmd => $cmd, %$res);
+         if($res->{timedout}) {
+            $ret = FAILURE;
+            $online->(["Timeout($MYLOG{CMDTIME}): killed process group $res->{pid}\n"], 0);
+         }
+         $ret = FAILURE if($ret == SUCCESS && $abort == 1);
+         $msg = ($target ? circuit_record($target, $ret, $policy) : "");
+      }
+      $end = time;
+      $last = $end - $last;
+      $retry = ($ret == FAILURE && $loop < $loops && !$res->{stopped} && !$SYSRESULT{circuit} &&
+                retry_failure($policy, $res, $errtxt));
+      if($retry) {
+         $wait = retry_wait($policy, $loop);
+         $retry = 0 if($deadline && Time::HiRes::time + $wait >= $deadline);   # no time left to retry
+      }
+
+      if($error) {
+         if($ret == FAILURE) {
+            $error = "Error Execute: $cmd\n$error";
+         } else {
+            $error = "Error From: $cmd\n$error";
+         }
+         $error = "Retry " . $error if($loop > 1);
+         $MYLOG{SYSERR} = $error if(defined $MYLOG{SYSERR});
+         if($cmdopt&4) {
+            $errlog = ($act|ERRLOG);
+            $errlog |= $logact if($ret == FAILURE && !$retry);
+            if(@locs) {
+               mylog($error, $errlog, @locs, __FILE__, __LINE__);
+            } else {
+               mylog($error, $errlog);
+            }
+         }
+      }
+
+      if($msg && !$SYSRESULT{circuit}) {   # circuit opened or closed by this try
+         $MYLOG{SYSERR} .= "$msg\n" if(defined $MYLOG{SYSERR});
+         mylog($msg, $act);
+      } elsif($msg && !($cmdopt&4)) {   # rejected by open circuit, error not logged
+         mylog($msg, $act);
+      }
+      if($last > 120 && $cmd !~ /(^|\/|\s)(dsarch|dsupdt|dsrqst|rdacp|rdasub)\s/) {
+         $msg = "> " . break_long_string($cmd, 60, "...", 1) . " Ends";
+         cmd_execute_time($msg, $last, $cmdlog); # more tham 5 minutes
+      }
+      last if(!$retry);
+      $msg = sprintf("Retry %d/%d in %.1fs: %s", $loop + 1, $loops, $wait, $cmd);
+      $MYLOG{SYSERR} .= "$msg\n" if(defined $MYLOG{SYSERR});
+      mylog($msg, $act);
+      Time::HiRes::sleep($wait) if($wait > 0);
+   }
+   add_metric("mysystem_calls_total", $label . ($ret == SUCCESS ? ',status="success"' : ',status="failure"'));
+   add_metric("mysystem_retries_total", $label, $loop - 1) if($loop > 1);
+   add_metric_time("mysystem_seconds", $label, Time::HiRes::time - $stime);
+   $MYLOG{SYSRET} = $ret;   # in case the standard output is returned
+   command_cache_put($key, $cmd, $stdout, $MYLOG{SYSERR}) if($key && $ret == SUCCESS && !$res->{stopped});
+
+   return (defined $stdout ? $stdout : $ret);
+}
+
+#
+# get the cached result of a command run by mysystem() with $cmdopt 512, if it is
+# not expired by $MYLOG{CMDCACHETTL} and the local files in the command are not
+# modified since
+#
+# return the cache entry, or undef if not cached
+#
+sub command_cache_get {
+   my ($key, $label) = @_;
+
+   my ($entry, $file, $status);
+
+   $entry = $CMDCACHE{entries}{$key};
+   if(!$entry) {
+      $status = "miss";
+   } elsif(time - $entry->{time} > $MYLOG{CMDCACHETTL}) {
+      $status = "expired";
+   } else {
+      $status = "hit";
+      foreach $file (keys %{$entry->{files}}) {
+         if(((stat($file))[9] || 0) != $entry->{files}{$file}) {
+            $status = "modified";
+            last;
+         }
+      }
+   }
+   add_metric("mysystem_cache_total", "$label,status=\"$status\"");
+   if($status ne "hit") {
+      command_cache_remove($key) if($entry);
+      return undef;
+   }
+   $entry->{used} = ++$CMDCACHE{seq};
+
+   return $entry;
+}
+
+#
+# cache the result of a command, with the modification times of its arguments of
+# local file paths, and evict the least recently used results over the size limits
+#
+sub command_cache_put {
+   my ($key, $cmd, $stdout, $syserr) = @_;
+
+   my ($entry, $file, $mtime, $lru);
+
+   return if(!$MYLOG{CMDCACHEMAX});
+   command_cache_remove($key) if($CMDCACHE{entries}{$key});
+   $entry = {stdout => $stdout, syserr => $syserr, time => time, used => ++$CMDCACHE{seq}, files => {}};
+   foreach $file ($cmd =~ m{(?:^|[\s'"=])(/[^\s'";|&<>()]+)}g) {
+      $entry->{files}{$file} = $mtime if(defined($mtime = (stat($file))[9]));
+   }
+   $entry->{size} = length($key) + (defined $stdout ? length($stdout) : 0) + (defined $syserr ? length($syserr) : 0);
+   return if($entry->{size} > $MYLOG{CMDCACHESZ});
+   $CMDCACHE{entries}{$key} = $entry;
+   $CMDCACHE{size} += $entry->{size};
+   while(keys(%{$CMDCACHE{entries}}) > $MYLOG{CMDCACHEMAX} || $CMDCACHE{size} > $MYLOG{CMDCACHESZ}) {
+      $lru = undef;
+      foreach (keys %{$CMDCACHE{entries}}) {
+         $lru = $_ if(!defined $lru || $CMDCACHE{entries}{$_}{used} < $CMDCACHE{entries}{$lru}{used});
+      }
+      command_cache_remove($lru);
+      add_metric("mysystem_cache_evictions_total", "");
+   }
+}
+
+sub command_cache_remove {
+   my ($key) = @_;
+
+   my $entry = delete $CMDCACHE{entries}{$key};
+
+   $CMDCACHE{size} -= $entry->{size} if($entry);
+}
+
+#
+# Function: clear_command_cache($pattern)
+# $pattern -- pattern of the commands to remove the cached results of; all if empty
+#
+# invalidate cached results of commands run by mysystem() with $cmdopt 512, for
+# example after changing the files or directories that the commands query
+#
+sub clear_command_cache {
+   my ($pattern) = @_;
+
+   my $key;
+
+   foreach $key (keys %{$CMDCACHE{entries}}) {
+      command_cache_remove($key) if(!$pattern || (split(/\t/, $key, 5))[4] =~ /$pattern/);
+   }
+}
+
+sub err2std {
+   my ($line) = @_;
+
+   foreach (@{$MYLOG{ERR2STD}}) {
+      if($line =~ /$_/) {
+         return 1;
+      }
+   }
+   return 0;
+}
+
+sub std2err {
+   my ($line) = @_;
+
+   foreach (@{$MYLOG{STD2ERR}}) {
+      if($line =~ /$_/) {
+         return 1;
+      }
+   }
+   return 0;
+}
+
+#
+# Function: set_retry_policy($name, $policy, @patterns)
+# $name     -- policy name; 'default' is used for mysystem() with $cmdopt 128
+# $policy   -- reference to hash of the policy settings to change, others are of
+#              the default policy:
+#              attempts - max tries of a command, including the first one
+#              backoff  - seconds to wait before the second try
+#              factor   - multiplier of the wait for each further try
+#              maxwait  - max seconds to wait between tries
+#              jitter   - fraction (0-1) of the wait to randomize by, +/-
+#              timeout  - 1 to retry a command timed out
+#              codes    - reference to array of exit codes to retry
+#              retry    - reference to array of patterns of error output to retry
+#              fatal    - reference to array of patterns of error output not to retry
+#              breaker  - consecutive failures to open a circuit for the command
+#                         target (ssh host, hsi, ...), 0 no circuit breaker
+#              cooldown - seconds a circuit stays open before a trial run
+# @patterns -- patterns of commands the policy applies to; or set $MYLOG{SYSRETRY}
+#              to the policy name, or a policy hash of settings to change, for the
+#              mysystem() calls
+#
+# a failed command is retried unless it matches a fatal pattern, or there are
+# retry patterns or codes but it matches none of them
+#
+# circuits are kept per process in %CIRCUITS; the results recorded by run_commands()
+# workers are passed back to the parent, so the workers started later see the
+# circuits opened by the ones finished, but not by the ones still running
+#
+sub set_retry_policy {
+   my ($name, $policy, @patterns) = @_;
+
+   my $pattern;
+
+   $RETRYPOLICIES{$name} = {%{$RETRYPOLICIES{default}}, %$policy};
+   foreach $pattern (@patterns) {
+      push @RETRYRULES, [qr/$pattern/, $name];
+   }
+}
+
+#
+# get the retry policy of a command, by $MYLOG{SYSRETRY}, the command patterns set
+# by set_retry_policy(), or the default policy for $cmdopt 128
+#
+sub retry_policy {
+   my ($cmd, $cmdopt) = @_;
+
+   my $rule;
+
+   if($MYLOG{SYSRETRY}) {
+      return {%{$RETRYPOLICIES{default}}, %{$MYLOG{SYSRETRY}}} if(ref($MYLOG{SYSRETRY}));
+      return $RETRYPOLICIES{$MYLOG{SYSRETRY}} if($RETRYPOLICIES{$MYLOG{SYSRETRY}});
+   }
+   foreach $rule (@RETRYRULES) {
+      return $RETRYPOLICIES{$rule->[1]} if($cmd =~ $rule->[0]);
+   }
+
+   return (($cmdopt&128) ? $RETRYPOLICIES{default} : undef);
+}
+
+#
+# return 1 if a failed command is to be retried by its policy
+#
+sub retry_failure {
+   my ($policy, $res, $errtxt) = @_;
+
+   my ($pattern, $code);
+
+   return 0 if(!$policy);
+   return ($policy->{timeout} ? 1 : 0) if($res->{timedout});
+   foreach $pattern (@{$policy->{fatal}}) {
+      return 0 if($errtxt =~ /$pattern/);
+   }
+   return 1 if(!(@{$policy->{retry}} || @{$policy->{codes}}));
+   foreach $pattern (@{$policy->{retry}}) {
+      return 1 if($errtxt =~ /$pattern/);
+   }
+   $code = (defined $res->{status} ? $res->{status} >> 8 : -1);
+   foreach (@{$policy->{codes}}) {
+      return 1 if($code == $_);
+   }
+
+   return 0;
+}
+
+#
+# seconds to wait before the try after $loop tries, by exponential backoff with jitter,
+# up to maxwait
+#
+sub retry_wait {
+   my ($policy, $loop) = @_;
+
+   my $wait = $policy->{backoff} * $policy->{factor}**($loop - 1);
+
+   $wait *= 1 + $policy->{jitter} * (2 * rand() - 1) if($policy->{jitter});
+   $wait = $policy->{maxwait} if($policy->{maxwait} && $wait > $policy->{maxwait});
+
+   return $wait;
+}
+
+#
+# get the target of a command for circuit breaking: the remote host of ssh, scp or
+# rsync, or the command name otherwise, such as hsi
+#
+sub command_target {
+   my ($cmd) = @_;
+
+   my (@words, $name, $i);
+
+   @words = split(' ', $cmd);
+   $name = basename($words[0]);
+   if($name eq "ssh") {
+      for($i = 1; $i < @words; $i++) {
+         if($words[$i] =~ /^-[bcDEeFIiJLlmOopQRSWw]$/) {
+            $i++;   # option with argument
+         } elsif($words[$i] !~ /^-/) {
+            ($name = $words[$i]) =~ s/^.*\@//;
+            return "ssh:$name";
+         }
+      }
+   } elsif($name eq "scp" || $name eq "rsync") {
+      foreach (@words[1..$#words]) {
+         return "$name:$1" if(/^(?:[^\/:\@]+\@)?([\w\.\-]+):/);
+      }
+   }
+
+   return $name;
+}
+
+#
+# return error message if the circuit of a target is open, so the command is not
+# to run; allow one trial run after the cooldown
+#
+sub circuit_check {
+   my ($target) = @_;
+
+   my $circuit = $CIRCUITS{$target};
+
+   return "" if(!$circuit || !$circuit->{opened});
+   return "" if(time >= $circuit->{opened} + $circuit->{cooldown});   # half open, try once
+   add_metric("mysystem_circuit_rejects_total", "target=\"$target\"");
+
+   return "Circuit open for $target after $circuit->{fails} failures, till " .
+          current_datetime($circuit->{opened} + $circuit->{cooldown});
+}
+
+#
+# record the result of a command for the circuit of its target
 #
-sub mysystem {
-   my ($cmd, $logact, $cmdopt, @locs) = @_;
+# return a message if the circuit is opened or closed
+#
+sub circuit_record {
+   my ($target, $ret, $policy) = @_;
+
+   my $circuit;
+
+   push @$CIRCUITRECS, [$target, $ret, $policy->{breaker}, $policy->{cooldown}] if($CIRCUITRECS);
+   $CIRCUITS{$target} = {fails => 0, opened => 0} if(!$CIRCUITS{$target});
+   $circuit = $CIRCUITS{$target};
+   if($ret == SUCCESS) {
+      $circuit->{fails} = 0;
+      return "" if(!$circuit->{opened});
+      $circuit->{opened} = 0;
+      return "Circuit closed for $target";
+   }
+   $circuit->{fails}++;
+   return "" if($circuit->{fails} < $policy->{breaker});
+   $circuit->{opened} = time;
+   $circuit->{cooldown} = $policy->{cooldown};
+   add_metric("mysystem_circuit_opens_total", "target=\"$target\"");
 
-   my ($line, $act, $stdout, $error, $isstd);
-   my ($cmdlog, $stdlog, $errlog, $last, $end, $abort);
-   my ($loop, $loops);
-   my $ret = SUCCESS;
+   return "Circuit opened for $target after $circuit->{fails} failures, for $policy->{cooldown}s";
+}
 
-   return $ret if(!$cmd);  # empty command
+#
+# Function: run_command($cmd, $online, $timeout)
+# $cmd     -- unix system command; executed via '/bin/sh -c' if it has any shell
+#             syntax or starts with a shell builtin, see %SHBUILTINS, or directly
+#             with its words as argument vector otherwise
+# $online  -- code reference called as $online->(\@lines, $isstd) with the complete
+#             output lines read each time, $isstd 1 for standard output and 0 for
+#             error output; the command is stopped if it returns true
+# $timeout -- seconds the command may run; if set, the command is run in a process
+#             group of its own, which is sent TERM at the deadline, and KILL if
+#             still running $MYLOG{KILLWAIT} seconds later
+#
+# run a command with its standard and error outputs read by separate pipes
+#
+# Return: reference to hash of the command result, with keys: pid, status (exit
+#         status as $?), timedout (1 if killed for timeout), stopped (1 if stopped
+#         by $online), secs (wall time) and the resource usage of reap_command();
+#         or undef if cannot run the command
+#
+sub run_command {
+   my ($cmd, $online, $timeout) = @_;
 
-   $cmd = untaint_string($cmd);
+   my ($outr, $outw, $errr, $errw, $pid, $sel, $fh, $buf, $len, @lines, %bufs);
+   my ($stime, $deadline, $wait, $killed, %res);
 
-   if($logact) {
-      $act = ($logact&(~EXITLG));
-      $act = ($act&(~ERRLOG))|WARNLG if($act&ERRLOG);
-   } else {
-      $act = $logact = LOGWRN; # set default log action option 
+   pipe($outr, $outw) or return undef;
+   if(!pipe($errr, $errw)) {
+      close($outr);
+      close($outw);
+      return undef;
+   }
+   $stime = Time::HiRes::time;
+   $pid = fork();
+   if(!defined $pid) {
+      close($_) foreach ($outr, $outw, $errr, $errw);
+      return undef;
+   }
+   if($pid == 0) {    # child to run the command
+      setpgrp(0, 0) if($timeout);
+      close($outr);
+      close($errr);
+      open(STDOUT, ">&", $outw);
+      open(STDERR, ">&", $errw);
+      @lines = split(' ', $cmd);
+      if($cmd =~ /[\$&*(){}\[\]'";\\|?<>~`\n#=%]/ || !@lines || $SHBUILTINS{$lines[0]}) {
+         exec("/bin/sh", "-c", $cmd);
+      } else {
+         exec {$lines[0]} @lines;
+      }
+      print STDERR "exec '$cmd': $!\n";
+      POSIX::_exit(127);
    }
-   $act |= FRCLOG if($act&MSGLOG); # make sure system calls always logged
-   $cmdopt = 5 if(!defined $cmdopt);   # set default command log option
-   $cmdlog = ($cmdopt&1 ? $act : 0);
-   ($cmdopt&8) ? cmdlog("starts '$cmd'", undef, $cmdlog) : mylog("> $cmd", $cmdlog) if($cmdlog);
-   $stdlog = ($cmdopt&2) ? $act : 0;
-   $stdout = ($cmdopt&16) ? "" : undef;
-   $MYLOG{SYSERR} = ($cmdopt&256) ? "" : undef;
-   $abort = ($cmdopt&64) ? -1 : 0;
-   $error = "";
-   $loops = ($cmdopt&128) ? 2 : 1;
 
-   for($loop = 1; ; $loop++) {
-      $last = time;
-      open CMD, "($cmd | sed 's/^/STDOUT /') 2>&1 |"
-         or return mylog("open '$cmd': $!", $logact, @locs, __FILE__, __LINE__);
-   
-      while($line = <CMD>) {
-         if(strip_output_line(\$line)) {
-            if($MYLOG{STD2ERR} && std2err($line)) {
-               $ret  = FAILURE;
-               $error .= $line if($cmdopt&4 || defined $MYLOG{SYSERR});
-               $abort = 1 if($abort == -1 && $line =~ /^ABORTS /);
+   close($outw);
+   close($errw);
+   $CMDPGRP = $pid if($timeout);
+   %res = (pid => $pid, timedout => 0, stopped => 0);
+   %bufs = (fileno($outr) => "", fileno($errr) => "");
+   $sel = IO::Select->new($outr, $errr);
+   $deadline = $stime + $timeout if($timeout);
+   $killed = 0;
+   while($sel->count()) {   # error output first, as its lines were not delayed by sed
+      if($deadline) {
+         $wait = $deadline - Time::HiRes::time;
+         if($wait <= 0) {
+            if($killed == 0) {
+               kill('TERM', -$pid);
+               $res{timedout} = 1;
+               $deadline = Time::HiRes::time + $MYLOG{KILLWAIT};
+            } elsif($killed == 1) {
+               kill('KILL', -$pid);
+               $deadline = Time::HiRes::time + 1;
             } else {
-               $ret  = SUCCESS if($ret == FAILURE && mytrim($line));
-               $line = '>' . $line if($line =~ /^>\s/);
-               mylog($line, $stdlog) if($stdlog);
-               $stdout .= $line if(defined $stdout);
+               last;   # outputs held by processes out of the group
             }
-         } elsif($MYLOG{ERR2STD} && err2std($line)) {
-            mylog($line, $stdlog) if($stdlog);
-            $stdout .= $line if(defined $stdout);
-         } elsif($cmdopt&32) {
-            mylog($line, $stdlog) if($stdlog);
-            $stdout .= $line if(defined $stdout);
-            $MYLOG{SYSERR} .= $line if(defined $MYLOG{SYSERR});
-         } else {
-            $ret  = FAILURE;
-            $error .= $line if($cmdopt&4 || defined $MYLOG{SYSERR});
-            $abort = 1 if($abort == -1 && $line =~ /^ABORTS /);
+            $killed++;
+            next;
          }
       }
-      close(CMD);
-      $ret = FAILURE if($ret == SUCCESS && $abort == 1);
-      $end = time;
-      $last = $end - $last;
-
-      if($error) {
-         if($ret == FAILURE) {
-            $error = "Error Execute: $cmd\n$error";
+      foreach $fh (sort {($a == $outr) <=> ($b == $outr)} $sel->can_read($wait)) {
+         $len = sysread($fh, $buf, 65536);
+         next if(!defined $len && $!{EINTR});
+         if(!$len) {   # end of output
+            @lines = (length($bufs{fileno($fh)}) ? ($bufs{fileno($fh)}) : ());
+            $sel->remove($fh);
+            close($fh);
          } else {
-            $error = "Error From: $cmd\n$error";
+            @lines = split(/^/, $bufs{fileno($fh)} . $buf);
+            $bufs{fileno($fh)} = (substr($lines[-1], -1) eq "\n" ? "" : pop(@lines));
          }
-         $error = "Retry " . $error if($loop > 1);
-         $MYLOG{SYSERR} = $error if(defined $MYLOG{SYSERR});
-         if($cmdopt&4) {
-            $errlog = ($act|ERRLOG);
-            $errlog |= $logact if($ret == FAILURE && $loop >= $loops);
-            if(@locs) {
-               mylog($error, $errlog, @locs, __FILE__, __LINE__);
-            } else {
-               mylog($error, $errlog);
-            }
+         if(@lines && $online->(\@lines, $fh == $outr)) {
+            $res{stopped} = 1;
+            kill('TERM', ($timeout ? -$pid : $pid));
+            last;
          }
       }
-
-      if($last > 120 && $cmd !~ /(^|\/|\s)(dsarch|dsupdt|dsrqst|rdacp|rdasub)\s/) {
-         $cmd = "> " . break_long_string($cmd, 60, "...", 1) . " Ends";
-         cmd_execute_time($cmd, $last, $cmdlog); # more tham 5 minutes
-         $cmd .= " by " .  current_datetime();
-      }
-      last if($ret == SUCCESS || $loop >= $loops);
-      sleep(6);
+      last if($res{stopped});
    }
+   close($_) foreach ($sel->handles());
+   reap_command($pid, \%res);
+   $CMDPGRP = 0;
+   $res{secs} = Time::HiRes::time - $stime;
+   record_command_stats($cmd, \%res);
 
-   return (defined $stdout ? $stdout : $ret);
+   return \%res;
 }
 
-sub err2std {
-   my ($line) = @_;
-
-   foreach (@{$MYLOG{ERR2STD}}) {
-      if($line =~ /$_/) {
-         return 1;
+#
+# wait for a command process to end, and set its exit status and resource usage
+# in hash %$res: status, utime and stime (CPU seconds), maxrss (KB), inblock and
+# oublock (blocks read and written); by the wait4() system call if available,
+# or by the CPU times of the children reaped otherwise
+#
+sub reap_command {
+   my ($pid, $res) = @_;
+
+   my ($status, $usage, $ret, @ru, @tms);
+
+   if($WAIT4) {
+      $status = pack("i", 0);
+      $usage = "\0" x 144;   # struct rusage, 2 timevals and 14 longs
+      do {
+         $ret = syscall($WAIT4, $pid + 0, $status, 0, $usage);
+      } while($ret == -1 && $!{EINTR});
+      if($ret == $pid) {
+         @ru = unpack("q18", $usage);
+         $res->{status} = unpack("i", $status);
+         $res->{utime} = $ru[0] + $ru[1] / 1000000;
+         $res->{stime} = $ru[2] + $ru[3] / 1000000;
+         $res->{maxrss} = $ru[4];
+         $res->{inblock} = $ru[11];
+         $res->{oublock} = $ru[12];
+         return;
       }
    }
-   return 0;
+   @tms = (POSIX::times())[3, 4];
+   waitpid($pid, 0);
+   $res->{status} = $?;
+   @ru = (POSIX::times())[3, 4];
+   $ret = POSIX::sysconf(POSIX::_SC_CLK_TCK()) || 100;
+   $res->{utime} = ($ru[0] - $tms[0]) / $ret;
+   $res->{stime} = ($ru[1] - $tms[1]) / $ret;
+   $res->{maxrss} = $res->{inblock} = $res->{oublock} = 0;
 }
 
-sub std2err {
-   my ($line) = @_;
+#
+# append a line of the resource usage of a command to the stats file of the host,
+# $MYLOG{CMDSTATS}/cmdstats.HostName, if $MYLOG{CMDSTATS} is set; tab separated:
+# time, pid, command name, exit status, flags (T - timed out, S - stopped), wall,
+# user and system CPU seconds, max RSS (KB), blocks in and out, and the command
+#
+sub record_command_stats {
+   my ($cmd, $res) = @_;
+
+   my ($name, $flags);
+
+   add_metric("command_cpu_seconds_total", command_label($cmd), $res->{utime} + $res->{stime});
+   return if(!$MYLOG{CMDSTATS});
+   $name = ($cmd =~ /^\s*(\S+)/ ? basename($1) : "");
+   $flags = ($res->{timedout} ? "T" : "") . ($res->{stopped} ? "S" : "");
+   $cmd =~ s/\s+/ /g;
+   $cmd = substr($cmd, 0, 253) . "..." if(length($cmd) > 256);
+   write_log("$MYLOG{CMDSTATS}/cmdstats.$MYLOG{HOSTNAME}",
+             sprintf("%d\t%d\t%s\t%d\t%s\t%.3f\t%.3f\t%.3f\t%d\t%d\t%d\t%s\n", time, $res->{pid},
+                     $name, $res->{status}, $flags, $res->{secs}, $res->{utime}, $res->{stime},
+                     $res->{maxrss}, $res->{inblock}, $res->{oublock}, $cmd));
+}
 
-   foreach (@{$MYLOG{STD2ERR}}) {
-      if($line =~ /$_/) {
-         return 1;
+#
+# Function: report_command_stats($files, $btime, $etime)
+# $files -- reference to array of stats files; default to all the host files
+#           $MYLOG{CMDSTATS}/cmdstats.*
+# $btime -- begin time, in seconds since epoch, of the commands counted
+# $etime -- end time, in seconds since epoch, of the commands counted
+#
+# aggregate the resource usage of the commands recorded by run_command() by command
+# name, such as tar, hsi, rdacp or ssh; for example
+#   print report_command_stats(undef, time - 86400);
+#
+# Return: report text, one line per command name, in descending order of CPU time
+#
+sub report_command_stats {
+   my ($files, $btime, $etime) = @_;
+
+   my ($file, $fh, $line, @fields, %stats, $stat, $name, $report);
+
+   flush_logs();
+   $files = [glob("$MYLOG{CMDSTATS}/cmdstats.*")] if(!$files && $MYLOG{CMDSTATS});
+   foreach $file (@$files) {
+      next if(!open($fh, "< $file"));
+      while($line = <$fh>) {
+         @fields = split(/\t/, $line, 12);
+         next if(@fields < 12 || ($btime && $fields[0] < $btime) || ($etime && $fields[0] > $etime));
+         $stat = $stats{$fields[2]};
+         $stat = $stats{$fields[2]} = {runs => 0, fails => 0, wall => 0, wmax => 0, utime => 0,
+                                       stime => 0, maxrss => 0, inblock => 0, oublock => 0} if(!$stat);
+         $stat->{runs}++;
+         $stat->{fails}++ if($fields[3] || $fields[4]);
+         $stat->{wall} += $fields[5];
+         $stat->{wmax} = $fields[5] if($fields[5] > $stat->{wmax});
+         $stat->{utime} += $fields[6];
+         $stat->{stime} += $fields[7];
+         $stat->{maxrss} = $fields[8] if($fields[8] > $stat->{maxrss});
+         $stat->{inblock} += $fields[9];
+         $stat->{oublock} += $fields[10];
       }
+      close($fh);
    }
-   return 0;
+
+   $report = sprintf("%-16s %8s %6s %12s %10s %10s %12s %12s %10s %12s %12s\n", "Command", "Runs", "Fails",
+                     "Wall(s)", "Avg(s)", "Max(s)", "User(s)", "Sys(s)", "MaxRSS(KB)", "BlocksIn", "BlocksOut");
+   foreach $name (sort {$stats{$b}{utime} + $stats{$b}{stime} <=> $stats{$a}{utime} + $stats{$a}{stime}} keys %stats) {
+      $stat = $stats{$name};
+      $report .= sprintf("%-16s %8d %6d %12.3f %10.3f %10.3f %12.3f %12.3f %10d %12d %12d\n", $name, $stat->{runs},
+                         $stat->{fails}, $stat->{wall}, $stat->{wall} / $stat->{runs}, $stat->{wmax}, $stat->{utime},
+                         $stat->{stime}, $stat->{maxrss}, $stat->{inblock}, $stat->{oublock});
+   }
+
+   return $report;
 }
 
 #
-# strip leading STDOUT and carrage return '\r', but keep ending newline '\n'
+# strip carrage return '\r', but keep ending newline '\n'
+#
+# return 1 for a standard output line, or a blank line
 #
 sub strip_output_line {
-   my ($line) = @_;
+   my ($line, $isstd) = @_;
 
-   my ($stdout, @lines, $ridx);
-
-   $stdout = ($$line =~ s/^STDOUT // ? 1 : 0);
+   my (@lines, $ridx);
 
    if($$line =~ /\r/) {
       @lines = split('\r', $$line);
@@ -867,7 +3449,7 @@ sub strip_output_line {
       $$line = $lines[$ridx];
       $$line = $lines[$ridx - 1] . "\n" if($$line eq "\n");
    }
-   return ($$line eq "\n" ? 1 : $stdout);
+   return ($$line eq "\n" ? 1 : $isstd);
 }
 
 sub cmd_execute_time {
@@ -913,65 +3495,328 @@ sub seconds_to_string_time {
    return $msg;
 }
 #
-#  wrap function to call mysystem() with a timeout control
-#  return FAILURE if error eval or time out
+#  wrap function to call mysystem() with a timeout control, by which the command
+#  runs in a process group of its own, killed at the timeout; check $SYSRESULT{timedout}
+#  for timeout
+#  return FAILURE, or empty standard output with $cmdopt 16, if time out
 #
 sub tosystem {
    my ($cmd, $timeout, $logact, $cmdopt, @locs) = @_;
 
-   my ($stdout, $error, $ret);
+   my ($ret, $stime, $label);
 
+   $stime = Time::HiRes::time;
+   $label = command_label($cmd);
    $timeout = $MYLOG{TIMEOUT} if(!$timeout);  # set default timeout if missed
-   eval {
-     local $SIG{ALRM} = sub {die "alarm\n"};
-     alarm $timeout;
-     if(@locs) {
-        $ret = mysystem($cmd, $logact, $cmdopt, @locs, __FILE__, __LINE__);
-     } else {
-        $ret = mysystem($cmd, $logact, $cmdopt);        
-     }
-     alarm 0;
-   };
+   %SYSRESULT = ();
+   {
+      local $MYLOG{CMDTIME} = $timeout;
+      if(@locs) {
+         $ret = mysystem($cmd, $logact, $cmdopt, @locs, __FILE__, __LINE__);
+      } else {
+         $ret = mysystem($cmd, $logact, $cmdopt);
+      }
+   }
 
-   return $ret if(!$@);
+   add_metric_time("tosystem_seconds", $label, Time::HiRes::time - $stime);
+   add_metric("tosystem_calls_total", "$label,status=\"" . ($SYSRESULT{timedout} ? "timeout" : "done") . "\"");
+   return "" if($SYSRESULT{timedout} && $cmdopt && $cmdopt&16 && !($cmdopt&32));
 
-   if($@ eq "alarm\n") {
-      $error = "Timeout($timeout) Execute: $cmd";
-      system("rdakill -P $$");      # kill child processes in case hung
-   } else {
-      $error = "Timeout($timeout) Error: $cmd\n$@";
+   return $ret;
+}
+
+#
+# Function: run_commands($cmds, $opts)
+# $cmds -- reference to array of commands, each a command string or a reference to
+#          array [$cmd, $logact, $cmdopt, $timeout], the first three as passed to
+#          mysystem(), and $timeout as passed to tosystem(); $cmd may be a code
+#          reference returning the command, called in the worker within $timeout,
+#          such as to start an ssh master session there
+# $opts -- reference to hash of options, all optional:
+#          workers  - max commands run at the same time, default $MYLOG{WORKERS}
+#          order    - 'submit' (default) or 'complete', order of the results
+#          failfast - 1 to stop running and kill the running commands at the first
+#                     failure; collect results of all commands otherwise; a command
+#                     failed with EXITLG in its $logact stops them too, and the
+#                     program exits by mylog() once the results are collected
+#          timeout  - default timeout in seconds of each command, 0 none
+#          logact   - log action to log a summary line of the run
+#
+# run commands in parallel by mysystem() in forked worker processes; the log
+# records of each command are held by its worker, and written together when the
+# command ends, so they are not interleaved with the other commands in log files;
+# EXITLG is not acted on by the workers, but by the calling process
+#
+# Return: array of hash references of the results, with keys: index (in $cmds),
+#         cmd, status ('success', 'failure', 'timeout', 'killed' or 'skipped'), ret (returned
+#         by mysystem()), error ($MYLOG{SYSERR} if set), pid and secs
+#
+sub run_commands {
+   my ($cmds, $opts) = @_;
+
+   my ($workers, $i, $cmd, $fh, $buf, $len, $res, $stop, $sel, $stime, $exit, %running, @results, @done, %cnts);
+
+   $opts = {} if(!$opts);
+   $workers = $opts->{workers} || $MYLOG{WORKERS};
+   $workers = 1 if($workers < 1);
+   $stime = Time::HiRes::time;
+   flush_logs();   # not to be written again by the workers
+   $sel = IO::Select->new();
+   $i = 0;
+   while($i < @$cmds || %running) {
+      while(!$stop && $i < @$cmds && keys(%running) < $workers) {
+         $cmd = (ref($cmds->[$i]) ? $cmds->[$i] : [$cmds->[$i]]);
+         $res = {index => $i, cmd => (ref($cmd->[0]) ? "" : $cmd->[0]), status => 'failure',
+                 stime => Time::HiRes::time, logact => ($cmd->[1] ? $cmd->[1] : 0)};
+         $fh = start_command_worker($cmd, $res, (defined $cmd->[3] ? $cmd->[3] : $opts->{timeout}));
+         if($fh) {
+            $running{fileno($fh)} = [$fh, $res, ""];
+            $sel->add($fh);
+         } else {
+            push @done, $res;
+         }
+         $i++;
+      }
+      if($stop) {   # mark the commands not started yet
+         for(; $i < @$cmds; $i++) {
+            $cmd = (ref($cmds->[$i]) ? $cmds->[$i][0] : $cmds->[$i]);
+            push @done, {index => $i, cmd => (ref($cmd) ? "" : $cmd), status => 'skipped'};
+         }
+      }
+      last if(!%running);
+      foreach $fh ($sel->can_read()) {
+         $len = sysread($fh, $buf, 65536);
+         next if(!defined $len && $!{EINTR});
+         if($len) {
+            $running{fileno($fh)}[2] .= $buf;
+            next;
+         }
+         $sel->remove($fh);
+         $res = finish_command_worker(@{delete $running{fileno($fh)}});
+         push @done, $res;
+         if($res->{status} ne 'success' && ($opts->{failfast} || $res->{logact}&EXITLG) && !$stop) {
+            $stop = 1;
+            foreach (values %running) {
+               kill('TERM', -$_->[1]{pid});
+               $_->[1]{killed} = 1;
+            }
+         }
+      }
+   }
+
+   foreach $res (@done) {
+      $res->{status} = 'killed' if(delete $res->{killed} && $res->{status} ne 'success');
+      $res->{secs} = 0 if(!defined $res->{secs});
+      delete $res->{stime};
+      $exit = $res if(!$exit && ($res->{logact}&EXITLG) && $res->{status} =~ /^(failure|timeout)$/);
+      delete $res->{logact};
+      $cnts{$res->{status}}++;
+      add_metric("run_commands_total", "status=\"$res->{status}\"");
+   }
+   @results = (($opts->{order} && $opts->{order} eq 'complete') ? @done : sort {$a->{index} <=> $b->{index}} @done);
+   if($opts->{logact}) {
+      mylog(sprintf("%d command(s) run by %d worker(s) in %s: %s", scalar(@$cmds), $workers,
+                    (seconds_to_string_time(int(Time::HiRes::time - $stime)) || "0S"),
+                    join(", ", map {"$cnts{$_} $_"} sort keys %cnts)), $opts->{logact});
+   }
+   mylog("Command $exit->{status}: $exit->{cmd}", $cmds->[$exit->{index}][1]) if($exit);   # exits
+
+   return @results;
+}
+
+#
+# Function: run_on_hosts($cmd, $hosts, $opts)
+# $cmd   -- command to run on each host, wrapped by get_remote_command()
+# $hosts -- reference to array of host names, a name of a host list in %MYLOG,
+#           'CHKHOSTS', 'LSFHOSTS' or 'WEBHOSTS', or a string of host names
+#           separated by ':'
+# $opts  -- reference to hash of options, all optional:
+#           workers - max hosts run on at the same time, default $MYLOG{WORKERS}
+#           timeout - timeout in seconds of the command on each host, 0 none
+#           asuser  - user to run the command as, passed to get_remote_command()
+#           cmdopt  - additional mysystem() $cmdopt bits, such as 128 to retry
+#           logact  - log action of the summary, default MSGLOG; 0 not to log
+#
+# run a command on the hosts in parallel by run_commands(), without logging the
+# command records of each host, and log one summary of all hosts instead, with
+# the first error line of each host failed; for example
+#   %res = run_on_hosts("df -h /data", 'WEBHOSTS', {timeout => 30});
+#
+# Return: hash of the host names to hash references of the results, with keys:
+#         status ('success', 'failure', 'timeout', 'killed' or 'skipped'), stdout,
+#         stderr, secs and cmd (the remote command run)
+#
+sub run_on_hosts {
+   my ($cmd, $hosts, $opts) = @_;
+
+   my (@hosts, @cmds, @results, $res, $host, $logact, $msg, $error, %hosts, %cnts);
+   my $stime = Time::HiRes::time;
+
+   $opts = {} if(!$opts);
+   if(ref($hosts)) {
+      @hosts = @$hosts;
+   } elsif(defined $hosts && defined $MYLOG{$hosts}) {
+      @hosts = (ref($MYLOG{$hosts}) ? @{$MYLOG{$hosts}} : split(/[:\s,]+/, $MYLOG{$hosts}));
+   } elsif(defined $hosts) {
+      @hosts = split(/[:\s,]+/, $hosts);
+   }
+   @hosts = grep {$_ && !$hosts{$_}++} @hosts;
+   return () if(!@hosts);
+
+   foreach $host (@hosts) {   # remote commands made by the workers, to start ssh master sessions in parallel
+      my $rhost = $host;
+      push @cmds, [sub { get_remote_command($cmd, $rhost, $opts->{asuser}) }, MSGLOG,
+                   16|256|($opts->{cmdopt} ? $opts->{cmdopt}&(~7) : 0), $opts->{timeout}];
+   }
+   @results = run_commands(\@cmds, {workers => $opts->{workers}, timeout => $opts->{timeout}});
+
+   %hosts = ();
+   foreach $res (@results) {
+      $host = $hosts[$res->{index}];
+      $error = (defined $res->{error} ? $res->{error} : "");
+      $error =~ s/^(Retry )?Error (Execute|From): [^\n]*\n//;
+      $hosts{$host} = {status => $res->{status}, stdout => (defined $res->{ret} ? $res->{ret} : ""),
+                       stderr => $error, secs => $res->{secs}, cmd => $res->{cmd}};
+      push @{$cnts{$res->{status}}}, $host;
+      add_metric("run_on_hosts_total", "status=\"$res->{status}\"");
+   }
+
+   $logact = (defined $opts->{logact} ? $opts->{logact} : MSGLOG);
+   if($logact) {
+      $msg = sprintf("'%s' run on %d host(s) in %s: %s", $cmd, scalar(@hosts),
+                     (seconds_to_string_time(int(Time::HiRes::time - $stime)) || "0S"),
+                     join("; ", map {scalar(@{$cnts{$_}}) . " $_ (" . join(", ", @{$cnts{$_}}) . ")"} sort keys %cnts));
+      foreach $host (@hosts) {
+         next if($hosts{$host}{status} eq 'success');
+         $error = ($hosts{$host}{stderr} =~ /^\s*(\S[^\n]*)/ ? $1 : $hosts{$host}{status});
+         $msg .= "\n  $host: $error";
+      }
+      mylog($msg, $logact);
+   }
+
+   return %hosts;
+}
+
+#
+# fork a worker process, in a process group of its own, to run a command by
+# mysystem(), and write the result back to the returned pipe: a line of the
+# command status, timeout flag and lengths of the returned value, error, command,
+# circuit results and ssh master sessions, followed by them
+#
+sub start_command_worker {
+   my ($cmd, $res, $timeout) = @_;
+
+   my ($rfh, $wfh, $pid, $ret, $err, $run, $stime, $circ, $sess);
+
+   if(!pipe($rfh, $wfh)) {
+      $res->{error} = "pipe: $!";
+      return undef;
+   }
+   $pid = fork();
+   if(!defined $pid) {
+      $res->{error} = "fork: $!";
+      close($rfh);
+      close($wfh);
+      return undef;
+   }
+   if($pid) {
+      close($wfh);
+      $res->{pid} = $pid;
+      return $rfh;
    }
 
-   if($cmdopt) {
-      if($cmdopt&32) {
-         $stdout = $error;
-         $error = undef;
-      } elsif($cmdopt&256) {
-         $MYLOG{SYSERR} .= $error;
+   # worker process
+   close($rfh);
+   setpgrp(0, 0);
+   reset_child_state();
+   $MYLOG{NOQUIT} = 1;   # write the result back; EXITLG is acted on by the parent
+   $MYLOG{LOGBUFSZ} = 67108864;   # hold log records till the command ends
+   $MYLOG{LOGFLUSH} = 86400;
+   $SIG{TERM} = sub {   # killed for failfast
+      kill('TERM', -$CMDPGRP) if($CMDPGRP);
+      flush_logs();
+      POSIX::_exit(1);
+   };
+   $MYLOG{SYSRET} = FAILURE;
+   $CIRCUITRECS = [];
+   $run = $cmd->[0];
+   if(ref($run) eq "CODE") {    # make the command here, with the time taken out of the timeout
+      $stime = Time::HiRes::time;
+      {
+         local $MYLOG{SSHTIME} = (($timeout && $timeout < $MYLOG{SSHTIME}) ? (int($timeout) || 1) : $MYLOG{SSHTIME});
+         $run = $run->();
       }
+      $timeout -= Time::HiRes::time - $stime if($timeout);
+   }
+   if($timeout && $timeout <= 0) {
+      %SYSRESULT = (timedout => 1);
+      $ret = "";
+      $MYLOG{SYSERR} = "Timed out before '$run' started\n";
    } else {
-      $cmdopt = 4;
+      $MYLOG{CMDTIME} = $timeout if($timeout);
+      $ret = mysystem($run, $cmd->[1], $cmd->[2]);
    }
-   if($error && $cmdopt&4) {
-      $logact = ($logact ? ($logact|ERRLOG) : LOGERR);
-      if(@locs) {
-         mylog($error, $logact, @locs, __FILE__, __LINE__);
-      } else {
-         mylog($error, $logact);         
+   $err = (defined $MYLOG{SYSERR} ? $MYLOG{SYSERR} : "");
+   $ret = "" if(!defined $ret);
+   $circ = join("", map {join("\t", @$_) . "\n"} @$CIRCUITRECS);
+   $sess = join("", map {"$_\t$SSHSESSIONS{$_}{sock}\t$SSHSESSIONS{$_}{checked}\n"}
+                    grep {!$SSHSESSIONS{$_}{failed}} keys %SSHSESSIONS);
+   print $wfh sprintf("%d\t%d\t%d\t%d\t%d\t%d\t%d\n", $MYLOG{SYSRET}, ($SYSRESULT{timedout} ? 1 : 0),
+                      length($ret), length($err), length($run), length($circ), length($sess)) .
+              $ret . $err . $run . $circ . $sess;
+   close($wfh);
+   flush_logs();
+   POSIX::_exit(0);
+}
+
+#
+# reap a worker process of run_commands() and parse the result it wrote
+#
+sub finish_command_worker {
+   my ($fh, $res, $buf) = @_;
+
+   my ($pos, $stat, $tout, $rlen, $elen, $clen, $blen, $slen, $rec, @recs);
+
+   close($fh);
+   waitpid($res->{pid}, 0);
+   $res->{secs} = Time::HiRes::time - delete($res->{stime});
+   if(($pos = index($buf, "\n")) > 0) {
+      ($stat, $tout, $rlen, $elen, $clen, $blen, $slen) = split(/\t/, substr($buf, 0, $pos));
+      $res->{ret} = substr($buf, $pos + 1, $rlen);
+      $res->{error} = substr($buf, $pos + 1 + $rlen, $elen) if($elen);
+      $res->{cmd} = substr($buf, $pos + 1 + $rlen + $elen, $clen);
+      foreach $rec (split(/\n/, substr($buf, $pos + 1 + $rlen + $elen + $clen, $blen))) {
+         @recs = split(/\t/, $rec);   # replay the circuit results of the worker
+         circuit_record($recs[0], $recs[1], {breaker => $recs[2], cooldown => $recs[3]});
       }
-   } elsif($stdout && $cmdopt&2) {
-      $logact = ($logact ? ($logact|WARNLG) : LOGWRN);
-      if(@locs) {
-         mylog($stdout, $logact, @locs, __FILE__, __LINE__);
-      } else {
-         mylog($stdout, $logact);         
+      foreach $rec (split(/\n/, substr($buf, $pos + 1 + $rlen + $elen + $clen + $blen, $slen))) {
+         @recs = split(/\t/, $rec);   # take over the ssh master sessions started by the worker
+         $SSHSESSIONS{$recs[0]} = {sock => $recs[1], checked => $recs[2], failed => 0}
+            if(!$SSHSESSIONS{$recs[0]} || $SSHSESSIONS{$recs[0]}{failed});
       }
-   }
-   if($cmdopt&16) {
-      return ($stdout ? $stdout : "");
+      $res->{status} = ($stat == SUCCESS ? 'success' : ($tout ? 'timeout' : 'failure'));
    } else {
-      return FAILURE;
+      $res->{error} = "Worker $res->{pid} ended with status $? without result";
    }
+
+   return $res;
+}
+
+#
+# reset the states inherited from the parent process that are not to be repeated
+# by a child process, such as emails and messages to be reported at exit
+#
+sub reset_child_state {
+   check_log_owner();
+   $MYLOG{LOGASYNC} = 0;
+   $MYLOG{METRICPATH} = "";
+   %MSGDUPS = ();
+   %EMLDIGESTS = ();
+   @MYLOG{qw(ERRMSG SUMMSG EMLMSG)} = ("", "", "");
+   @EMLBUF{qw(head spilled spfh)} = ("", 0, undef);
+   $MYLOG{ERRCNT} = 0;
+   $MYLOG{PRGMSG} = "";
+   $SMTPCONN{sock} = undef;
 }
 
 #
@@ -984,7 +3829,7 @@ sub tosystem {
 sub mytar {
    my ($tarfile, $file, $logact, $taract, @locs) = @_;
 
-   my ($buf, $line, $opt, $included, $tmpfile, $cmd);
+   my ($ret, $opt, $included, $tmpfile, $cmd, $member, @members);
 
    $taract = 1 if(!defined $taract);
 
@@ -994,11 +3839,12 @@ sub mytar {
    if(-f $tarfile) {
       $included = 0;
       $cmd = "tar -tf $tarfile $file";
-      $line = mysystem($cmd, LOGWRN, 16, @locs, __LINE__);
-      if($line) {
-         $line = mytrim($line);
-         $included = 1 if($line eq $file); # $file is included in the $tarfile already
-      }
+      mysystem_stream($cmd, LOGWRN, 0, sub {
+         my ($line, $isstd) = @_;
+         return 0 if(!$isstd);
+         $included = 1 if(mytrim($line) eq $file); # $file is included in the $tarfile already
+         return 1;   # the first line only
+      }, @locs, __LINE__);
    } else {
       $included = -1; # $tarfile not exists
    }
@@ -1016,22 +3862,29 @@ sub mytar {
 
    # now replace the included $file
    $tmpfile = "MyTeMp.tar";  # temporary tar file name
-   $opt = "-cvf";
    $cmd = "tar -tf $tarfile";
-   $buf = mysystem($cmd, $logact, 20, @locs, __LINE__);
-   return FAILURE if(!$buf);
-   foreach $line (split(/\n/, $buf)) {
-      if($line eq $file) {
+   @members = ();   # listed first; not to run tar on the files while listing them
+   return FAILURE if(!mysystem_stream($cmd, $logact, 4, sub {
+      my ($line, $isstd) = @_;
+      chomp($line);
+      push @members, $line if($isstd && $line ne "");
+      return 0;
+   }, @locs, __LINE__));
+   return FAILURE if(!@members);
+   $opt = "-cvf";
+   foreach $member (@members) {
+      if($member eq $file) {
          $cmd = "tar $opt $tmpfile $file";
-         return FAILURE if(!mysystem($cmd, $logact, 5, @locs, __LINE__));
+         $ret = mysystem($cmd, $logact, 5, @locs, __LINE__);
       } else {
-         $cmd = "tar -xvf $tarfile $line";
-         return FAILURE if(!mysystem($cmd, $logact, 4, @locs, __LINE__));
-         $cmd = "tar $opt $tmpfile $line";
-         return FAILURE if(!mysystem($cmd, $logact, 5, @locs, __LINE__));
-         $cmd = "rm -f $line";
-         return FAILURE if(!mysystem($cmd, $logact, 4, @locs, __LINE__));
+         $cmd = "tar -xvf $tarfile $member";
+         $ret = mysystem($cmd, $logact, 4, @locs, __LINE__);
+         $cmd = "tar $opt $tmpfile $member";
+         $ret = mysystem($cmd, $logact, 5, @locs, __LINE__) if($ret);
+         $cmd = "rm -f $member";
+         $ret = mysystem($cmd, $logact, 4, @locs, __LINE__) if($ret);
       }
+      return FAILURE if(!$ret);   # stop at failure
       $opt = "-uvf";
    }
    $cmd = "mv -f $tmpfile $tarfile";
@@ -1151,39 +4004,129 @@ sub join_paths {
 sub valid_command {
    my ($cmd, $logact, @locs) = @_;
 
-   push @locs, (__FILE__, __LINE__ + 1) if(@locs);
-   $COMMANDS{$cmd} = mysystem("which $cmd", $logact, 256, @locs) if(!defined $COMMANDS{$cmd});
+   if(defined $COMMANDS{$cmd}) {
+      add_metric("valid_command_cache_total", 'result="hit"');
+   } else {
+      add_metric("valid_command_cache_total", 'result="miss"');
+      push @locs, (__FILE__, __LINE__ + 1) if(@locs);
+      $COMMANDS{$cmd} = mysystem("which $cmd", $logact, 256, @locs);
+   }
 
    return $COMMANDS{$cmd};
 }
 
 #
-# add carbon copies to $MYLOG{CCDADDR}
+# add carbon copies to %CCDADDRS and $MYLOG{CCDADDR}, or clean them if empty $cc and
+# undefined $isstr
 #
 sub add_carbon_copy {
    my($cc, $isstr, $exclude, $specialist) = @_;
 
-   my ($email, @emails);
+   my %excl;
 
+   carbon_copy_set();
    if(!$cc) {
-      $MYLOG{CCDADDR} = '' if(!(defined $cc || defined $isstr)); # clean carbon copy
+      %CCDADDRS = (list => [], seen => {}) if(!(defined $cc || defined $isstr)); # clean carbon copy
    } else {
-      @emails = $isstr ? (split(/[,\s]+/, $cc)) : @{$cc};
-      foreach $email (@emails) {
-         next if(!$email || $email =~ /\// || $email eq 'N');
-         if($email eq "S") {
-            next if(!$specialist);
-            $email = $specialist;
-         }
-         $email .= "\@ucar.edu" if($email !~ /\@/);
-         next if($exclude && index($exclude, $email) > -1);
-         if($MYLOG{CCDADDR}) {
-            next if(index($MYLOG{CCDADDR}, $email) > -1);  # email Cc'd already
-            $MYLOG{CCDADDR} .= ", ";
+      add_email_recipients(\%excl, $exclude, 1) if($exclude);
+      add_email_recipients(\%CCDADDRS, $cc, $isstr, ($exclude ? \%excl : undef), $specialist);
+   }
+   $MYLOG{CCDADDR} = $CCDADDRS{str} = email_recipients_string(\%CCDADDRS);
+}
+
+#
+# return the carbon copies added, as a string of comma separated email addresses
+#
+sub get_carbon_copy {
+   return email_recipients_string(carbon_copy_set());
+}
+
+#
+# rebuild %CCDADDRS from $MYLOG{CCDADDR} if a caller has set it directly
+#
+# return reference to %CCDADDRS
+#
+sub carbon_copy_set {
+   $MYLOG{CCDADDR} = "" if(!defined $MYLOG{CCDADDR});
+   if($MYLOG{CCDADDR} ne $CCDADDRS{str}) {
+      %CCDADDRS = (list => [], seen => {});
+      add_email_recipients(\%CCDADDRS, $MYLOG{CCDADDR}, 1);
+      $CCDADDRS{str} = $MYLOG{CCDADDR};
+   }
+
+   return \%CCDADDRS;
+}
+
+#
+# Function: add_email_recipients($set: {list => [recipients in order added], seen => {email => 1}},
+#                                $emails: array ref or string if $isstr, $isstr,
+#                                $exclude: recipient set to skip, $specialist)
+#
+# add recipients to a recipient set once each, by their bare email addresses in lower
+# case with domain ucar.edu by default; a recipient with a display name, such as
+# "Zaihua Ji <zji@ucar.edu>", is kept as given. 'S' is replaced by $specialist, and
+# 'N' or ones with '/' are skipped
+#
+# return number of emails added
+#
+sub add_email_recipients {
+   my ($set, $emails, $isstr, $exclude, $specialist) = @_;
+
+   my ($rcpt, $text, $email, $cnt);
+
+   $set->{list} = [] if(!$set->{list});
+   $set->{seen} = {} if(!$set->{seen});
+   $cnt = 0;
+   foreach $rcpt (map {parse_email_addresses($_)} ($isstr ? ($emails) : @{$emails})) {
+      ($text, $email) = @$rcpt;
+      next if(!$email || $email =~ /\// || $email eq 'N');
+      if($email eq "S") {
+         next if(!$specialist);
+         $text = $email = $specialist;
+      }
+      if($email !~ /\@/) {
+         $text =~ s/<\Q$email\E>$/<$email\@ucar.edu>/ if($text ne $email);
+         $email .= "\@ucar.edu";
+      }
+      $email = lc($email);
+      $text = $email if($text !~ /</);
+      next if($set->{seen}{$email} || ($exclude && $exclude->{seen}{$email}));
+      $set->{seen}{$email} = 1;
+      push @{$set->{list}}, $text;
+      $cnt++;
+   }
+
+   return $cnt;
+}
+
+#
+# render a recipient set for an email header, folded to lines of about 78
+# characters if $fold
+#
+sub email_recipients_string {
+   my ($set, $fold) = @_;
+
+   my ($str, $len, $email);
+
+   return "" if(!$set->{list} || !@{$set->{list}});
+   return join(", ", @{$set->{list}}) if(!$fold);
+   $str = "";
+   $len = 4;  # for "Cc: "
+   foreach $email (@{$set->{list}}) {
+      if($str) {
+         $str .= ",";
+         if($len + length($email) + 2 > 78) {
+            $str .= "\n";
+            $len = 0;
          }
-         $MYLOG{CCDADDR} .= $email;
+         $str .= " ";
+         $len += 2;
       }
+      $str .= $email;
+      $len += length($email);
    }
+
+   return $str;
 }
 
 #
@@ -1288,13 +4231,135 @@ sub get_local_command {
 # wrap a given command $cmd for either sudo or setuid wrapper mystart_{username}
 # to run as user $asuser on a given remote host
 #
+# the ssh connection is shared through the control socket of a persistent master
+# session to the host if $MYLOG{SSHMUX} is set
+#
 sub get_remote_command {
    my ($cmd, $host, $asuser) = @_;
 
-   $cmd = "ssh $host $cmd" if($host && $host !~ /^$MYLOG{HOSTNAME}/);
+   my $sock;
+
+   if($host && $host !~ /^$MYLOG{HOSTNAME}/) {
+      $sock = ($MYLOG{SSHMUX} ? ssh_session($host) : "");
+      $cmd = "$MYLOG{SSHCMD} " . ($sock ? "-S $sock " : "") . "$host $cmd";
+   }
    return get_local_command($cmd, $asuser);
 }
 
+#
+# Function: ssh_session($host)
+# $host -- remote host name
+#
+# get the control socket of a persistent ssh master session to the host, started
+# in background if not running yet; the master quits after $MYLOG{SSHIDLE} idle
+# seconds, and is checked if alive every $MYLOG{SSHCHECK} seconds
+#
+# Return: control socket path; empty if no master session, so commands connect
+#         by their own
+#
+sub ssh_session {
+   my ($host) = @_;
+
+   my ($dir, $sess, $now);
+
+   $now = time;
+   $sess = $SSHSESSIONS{$host};
+   if($sess) {
+      return "" if($sess->{failed} && $now < $sess->{failed} + $MYLOG{SSHCHECK});
+      return $sess->{sock} if(!$sess->{failed} && $now < $sess->{checked} + $MYLOG{SSHCHECK} && -S $sess->{sock});
+   } else {
+      $dir = ssh_socket_dir();
+      return "" if(!$dir);
+      $sess = $SSHSESSIONS{$host} = {sock => "$dir/$host", checked => 0, failed => 0};
+   }
+
+   if(-S $sess->{sock} && ssh_control($host, "-S", $sess->{sock}, "-O", "check") == 0) {
+      add_metric("ssh_session_checks_total", "status=\"alive\"");
+   } else {
+      unlink($sess->{sock}) if(-e $sess->{sock});   # stale, ssh warns on it to stderr
+      if(ssh_control($host, "-S", $sess->{sock}, "-o", "ControlMaster=yes", "-o",
+                     "ControlPersist=$MYLOG{SSHIDLE}", "-o", "ConnectTimeout=$MYLOG{SSHTIME}",
+                     "-o", "BatchMode=yes", "-f", "-N") == 0 && -S $sess->{sock}) {
+         add_metric("ssh_session_starts_total", "status=\"success\"");
+      } else {
+         add_metric("ssh_session_starts_total", "status=\"failure\"");
+         mydbg(1, "$host: cannot start ssh master session at $sess->{sock}");
+         unlink($sess->{sock}) if(-e $sess->{sock});
+         $sess->{failed} = $now;
+         return "";
+      }
+   }
+   $sess->{checked} = $now;
+   $sess->{failed} = 0;
+
+   return $sess->{sock};
+}
+
+#
+# return the directory $MYLOG{TMPPATH}/myssh.USER for the control sockets, created
+# if not yet; empty if it is not a real directory owned by this user with mode 0700,
+# so other users of a shared $MYLOG{TMPPATH} cannot get at the sessions
+#
+sub ssh_socket_dir {
+   my ($dir, @st);
+
+   $dir = "$MYLOG{TMPPATH}/myssh." . ($MYLOG{CURUID} ? $MYLOG{CURUID} : $<);
+   mkdir($dir, 0700);
+   @st = lstat($dir);
+   if(!@st || !-d _ || $st[4] != $> || ($st[2] & 07777) != 0700) {
+      mydbg(1, "$dir: not a directory owned by uid $> with mode 0700, no ssh master sessions");
+      return "";
+   }
+
+   return $dir;
+}
+
+#
+# Function: close_ssh_sessions(@hosts)
+# @hosts -- remote host names; default to all hosts of the sessions used, including
+#           those started by the workers of run_commands() and run_on_hosts()
+#
+# stop the persistent ssh master sessions, instead of letting them end idle
+#
+sub close_ssh_sessions {
+   my (@hosts) = @_;
+
+   my $host;
+
+   @hosts = keys %SSHSESSIONS if(!@hosts);
+   foreach $host (@hosts) {
+      next if(!$SSHSESSIONS{$host});
+      ssh_control($host, "-S", $SSHSESSIONS{$host}{sock}, "-O", "exit") if(-S $SSHSESSIONS{$host}{sock});
+      delete $SSHSESSIONS{$host};
+   }
+}
+
+#
+# run $MYLOG{SSHCMD} with options @opts to a host, for a control operation of
+# ssh master sessions, with no input and outputs discarded
+#
+# return the exit status as $?
+#
+sub ssh_control {
+   my ($host, @opts) = @_;
+
+   my ($pid, @args);
+
+   @args = (split(' ', $MYLOG{SSHCMD}), @opts, $host);
+   $pid = fork();
+   return -1 if(!defined $pid);
+   if($pid == 0) {
+      open(STDIN, "< /dev/null");
+      open(STDOUT, "> /dev/null");
+      open(STDERR, "> /dev/null");
+      { exec {$args[0]} @args; }
+      POSIX::_exit(127);
+   }
+   waitpid($pid, 0);
+
+   return $?;
+}
+
 #
 # wrap a given hpss command $cmd with sudo either before his of after hsi
 # to run as user $asuser
@@ -1453,10 +4518,44 @@ sub untaint_suid {
    SETMYLOG("LOGFILE", "mydss.log");                   # log file name
    SETMYLOG("EMLFILE", "myemail.log");                 # email log file name
    SETMYLOG("ERRFILE", "");                            # error file name
+   SETMYLOG("LOGFORMAT", "text");                      # log record format, text or json
+   SETMYLOG("DUPMAX", 0);                              # max repeated messages logged per window, 0 all
+   SETMYLOG("EMLMAX", 4194304);                        # max bytes of messages buffered for email
+   SETMYLOG("EMLMEM", 1048576);                        # max bytes of email details kept in memory, spill over
+   SETMYLOG("METRICPATH", "");                         # directory to dump metrics at exit, empty not
+   SETMYLOG("METRICFMT", "prom");                      # metrics format, prom (Prometheus text) or json
+   SETMYLOG("LOGBUFSZ", 8192);                         # flush buffered log records at size in bytes
+   SETMYLOG("LOGFLUSH", 5);                            # flush buffered log records after seconds
+   SETMYLOG("LOGASYNC", 0);                            # 1 to write log records in background
+   SETMYLOG("LOGQSIZE", 1000);                         # max records queued for background writer
+   SETMYLOG("LOGQMODE", "block");                      # block/drop/spill if log queue is full
+   SETMYLOG("LOGROTSZ", 0);                            # roll log files at size in bytes, 0 never
+   SETMYLOG("LOGROTDAY", 0);                           # 1 to roll log files modified on previous days
+   SETMYLOG("LOGCOMPRESS", "gzip");                    # command to compress rolled log files
    SETMYLOG("EMLSEND", "/usr/lib/sendmail -t");        # send email command
+   SETMYLOG("EMLDIGEST", 0);                           # seconds to merge emails to same To/Cc, -1 till exit, 0 off
+   SETMYLOG("WORKERS", 4);                             # max commands run in parallel by run_commands()
+   SETMYLOG("CMDSTATS", "");                           # directory of per-host command resource usage files
+   SETMYLOG("CMDCACHETTL", 300);                       # seconds to reuse results of commands cached
+   SETMYLOG("CMDCACHEMAX", 1000);                      # max command results cached, 0 no cache
+   SETMYLOG("CMDCACHESZ", 16777216);                   # max bytes of command results cached
+   SETMYLOG("EMLARCH", 0);                             # 1 to archive emails sent in compressed EMLFILE.gz
+   SETMYLOG("EMLSPOOL", "");                           # spool directory to queue emails, empty send now
+   SETMYLOG("EMLTRIES", 10);                           # max tries to deliver a spooled email
+   SETMYLOG("EMLBACKOFF", 60);                         # seconds to wait for retrying, doubled per try
+   SETMYLOG("EMLPOLL", 10);                            # seconds to poll the spool directory
+   SETMYLOG("SMTPHOST", "");                           # SMTP server to submit email, empty EMLSEND
+   SETMYLOG("SMTPPORT", 25);                           # SMTP server port
+   SETMYLOG("SMTPTIME", 30);                           # seconds to wait for SMTP replies
+   SETMYLOG("SSHCMD", "ssh");                          # ssh command for remote commands
+   SETMYLOG("SSHMUX", 0);                              # 1 to share persistent ssh sessions per host
+   SETMYLOG("SSHIDLE", 600);                           # seconds a shared ssh session stays idle
+   SETMYLOG("SSHCHECK", 60);                           # seconds to check if a shared ssh session alive
+   SETMYLOG("SSHTIME", 10);                            # seconds to wait for ssh connecting
    SETMYLOG("DBGLEVEL", 0);                            # debug level
    SETMYLOG("DBGPATH", "$MYLOG{DSSDBHM}/log");         # path to debug log file
    SETMYLOG("DBGFILE", "mydss.dbg");                   # debug file name
+   SETMYLOG("DBGRING", 0);                             # number of recent debug records kept for errors
    SETMYLOG("CNFPATH", "$MYLOG{DSSHOME}/config");      # path to configuration files
    SETMYLOG("PUSGDIR", "$MYLOG{DSSDBHM}/prog_usage");  # path to program usage files
    SETMYLOG("DSSURL",  "http://rda.ucar.edu");         # current dss web URL
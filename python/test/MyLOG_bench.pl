@@ -0,0 +1,379 @@
+#!/usr/bin/perl
+#
+###############################################################################
+#
+#     Title : MyLOG_bench.pl  -- benchmarks for package MyLOG
+#    Author : Zaihua Ji,  zji@ucar.edu
+#   Purpose : measure the costs of logging functions in MyLOG, in a scratch log
+#             directory, so the numbers can be compared before and after changes
+#
+#     Usage : MyLOG_bench.pl [-n Count] [BenchName ...]
+#
+###############################################################################
+use strict;
+use Cwd qw(abs_path);
+use File::Basename;
+use File::Temp qw(tempdir);
+use IO::Socket::INET;
+use Socket qw(IPPROTO_TCP TCP_NODELAY);
+use Time::HiRes qw(time);
+
+our ($LIBDIR, $LOGDIR);
+
+BEGIN {
+   $LIBDIR = dirname(abs_path(__FILE__)) . "/../lib";
+   $LOGDIR = tempdir("mylogbench.XXXXXX", TMPDIR => 1, CLEANUP => 1);
+   $ENV{LOGPATH} = $ENV{DBGPATH} = $ENV{TMPPATH} = $LOGDIR;
+   require "$LIBDIR/MyLOG.py";
+   MyLOG->import();
+}
+
+my %BENCHES = (
+   mylog => \&bench_mylog,
+   lazy  => \&bench_lazy,
+   email => \&bench_email,
+   smtp  => \&bench_smtp,
+   exec  => \&bench_exec,
+   ssh   => \&bench_ssh,
+);
+
+my $count = 100000;
+my @names;
+
+while(@ARGV) {
+   my $arg = shift @ARGV;
+   if($arg eq "-n") {
+      $count = shift @ARGV;
+   } else {
+      push @names, $arg;
+   }
+}
+@names = sort keys %BENCHES if(!@names);
+
+foreach my $name (@names) {
+   die "$name: Unknown benchmark\n" if(!$BENCHES{$name});
+   print "$name ($count):\n";
+   $BENCHES{$name}->($count);
+}
+
+#
+# show the rate of a timed loop
+#
+sub show_rate {
+   my ($title, $cnt, $secs) = @_;
+
+   $secs = 0.000001 if($secs <= 0);
+   printf "  %-40s %10.3fs %12.0f/s\n", $title, $secs, $cnt / $secs;
+}
+
+#
+# messages/sec of appending to mydss.log by open/append/close per message
+# as mylog() did before, and by mylog() with the buffered log writer
+#
+sub bench_mylog {
+   my ($cnt) = @_;
+
+   my ($i, $start, $file);
+
+   $file = "$LOGDIR/$MYLOG{LOGFILE}";
+   $start = time;
+   for($i = 0; $i < $cnt; $i++) {
+      open LOG, ">> $file" or die "$file: $!\n";
+      print LOG "benchmark message $i\n";
+      close(LOG);
+   }
+   show_rate("open/append/close per message", $cnt, time - $start);
+   unlink $file;
+
+   $start = time;
+   for($i = 0; $i < $cnt; $i++) {
+      MyLOG::write_log($file, "benchmark message $i\n");
+   }
+   MyLOG::flush_logs();
+   show_rate("write_log() buffered writer", $cnt, time - $start);
+   unlink $file;
+
+   $start = time;
+   for($i = 0; $i < $cnt; $i++) {
+      mylog("benchmark message $i", MSGLOG);
+   }
+   MyLOG::flush_logs();
+   show_rate("mylog() buffered writer", $cnt, time - $start);
+   unlink $file;
+}
+
+#
+# cost of mylog()/mydbg() calls whose records are filtered out, with messages
+# built eagerly and deferred as code or sprintf() array references
+#
+sub bench_lazy {
+   my ($cnt) = @_;
+
+   my ($i, $start, %info);
+   my $mask = $MYLOG{LOGMASK};
+   my $dlvl = $MYLOG{DBGLEVEL};
+
+   %info = map {("key$_" => "value$_")} (1..20);
+   $MYLOG{LOGMASK} &= ~(MSGLOG);   # filter out MSGLOG records
+   $MYLOG{DBGLEVEL} = 1;           # filter out debug levels over 1
+
+   $start = time;
+   for($i = 0; $i < $cnt; $i++) {
+      mylog("record $i: " . join(", ", map {"$_=$info{$_}"} sort keys %info), MSGLOG);
+   }
+   show_rate("mylog() filtered, eager message", $cnt, time - $start);
+
+   $start = time;
+   for($i = 0; $i < $cnt; $i++) {
+      mylog(sub {"record $i: " . join(", ", map {"$_=$info{$_}"} sort keys %info)}, MSGLOG);
+   }
+   show_rate("mylog() filtered, code reference", $cnt, time - $start);
+
+   $start = time;
+   for($i = 0; $i < $cnt; $i++) {
+      mylog(["record %d: %s", $i, \%info], MSGLOG);
+   }
+   show_rate("mylog() filtered, sprintf array", $cnt, time - $start);
+
+   $start = time;
+   for($i = 0; $i < $cnt; $i++) {
+      mydbg(5, "record $i: " . join(", ", map {"$_=$info{$_}"} sort keys %info));
+   }
+   show_rate("mydbg() filtered, eager message", $cnt, time - $start);
+
+   $start = time;
+   for($i = 0; $i < $cnt; $i++) {
+      mydbg(5, sub {"record $i: " . join(", ", map {"$_=$info{$_}"} sort keys %info)});
+   }
+   show_rate("mydbg() filtered, code reference", $cnt, time - $start);
+
+   $MYLOG{LOGMASK} = $mask;
+   $MYLOG{DBGLEVEL} = $dlvl;
+}
+
+#
+# cost of buffering detail lines for email, $cnt and 10 times $cnt lines, by
+# flat strings appended and prepended, and by set_email() with the details
+# spilled to file over $MYLOG{EMLMEM}, read back in chunks as send_email() does
+#
+sub bench_email {
+   my ($cnt) = @_;
+
+   my ($i, $n, $start, $buf, $msg, $len);
+   my $max = $MYLOG{EMLMAX};
+
+   $MYLOG{EMLMAX} = 1000000000;
+   foreach $n ($cnt, 10 * $cnt) {
+      $start = time;
+      $buf = "";
+      for($i = 0; $i < $n; $i++) {
+         $buf .= "\n" if($buf && $i%100 == 0);
+         $buf .= "file $i of $n has been processed\n";
+         $buf = "Title $i\n" . $buf if($i%10000 == 0);
+      }
+      $msg = $buf;
+      show_rate("flat string, $n lines", $n, time - $start);
+      printf "  %-40s %10d bytes in memory\n", "", length($buf);
+      $buf = $msg = undef;
+
+      $start = time;
+      for($i = 0; $i < $n; $i++) {
+         set_email("file $i of $n has been processed\n", EMLLOG|($i%100 ? 0 : BRKLIN));
+         set_email("Title $i", EMLTOP) if($i%10000 == 0);
+      }
+      $buf = MyLOG::email_size();
+      $msg = MyLOG::take_email();
+      $len = 0;
+      MyLOG::email_chunks($msg, sub { $len += length($_[0]) });
+      show_rate("set_email() with spill, $n lines", $n, time - $start);
+      printf "  %-40s %10d bytes in memory, %d in total\n", "", $buf, $len;
+      set_email(undef);
+      $msg = undef;
+   }
+   $MYLOG{EMLMAX} = $max;
+}
+
+#
+# emails/sec delivered by piping to $MYLOG{EMLSEND} per email, and over one
+# SMTP session to a local stand-in SMTP server
+#
+sub bench_smtp {
+   my ($cnt) = @_;
+
+   my ($i, $start, $pid, $server, $emlmsg);
+   my ($host, $port, $send) = ($MYLOG{SMTPHOST}, $MYLOG{SMTPPORT}, $MYLOG{EMLSEND});
+
+   $cnt = int($cnt / 100) || 1;   # spawning a process per email is slow
+   $emlmsg = "From: bench\@ucar.edu\nTo: nobody\@ucar.edu\nSubject: benchmark\n\n" .
+             ".line started with a dot\nbenchmark email body\n";
+
+   $MYLOG{EMLSEND} = "cat > /dev/null";
+   $MYLOG{SMTPHOST} = "";
+   $start = time;
+   for($i = 0; $i < $cnt; $i++) {
+      MyLOG::deliver_email($emlmsg);
+   }
+   show_rate("pipe to '$MYLOG{EMLSEND}' per email", $cnt, time - $start);
+
+   ($server, $pid) = start_smtp_server();
+   $MYLOG{SMTPHOST} = "127.0.0.1";
+   $MYLOG{SMTPPORT} = $server->sockport();
+   $start = time;
+   for($i = 0; $i < $cnt; $i++) {
+      MyLOG::deliver_email($emlmsg);
+   }
+   MyLOG::smtp_close();
+   show_rate("one SMTP session, PIPELINING", $cnt, time - $start);
+   waitpid($pid, 0);
+   die "SMTP stand-in server: " . ($? >> 8) . " of $cnt emails received\n" if(($? >> 8) != $cnt % 256);
+
+   ($MYLOG{SMTPHOST}, $MYLOG{SMTPPORT}, $MYLOG{EMLSEND}) = ($host, $port, $send);
+}
+
+#
+# fork a stand-in SMTP server on a local port that accepts one session, and
+# exits with the number of emails received
+#
+sub start_smtp_server {
+   my ($server, $pid, $conn, $line, $data, $cnt);
+
+   $server = IO::Socket::INET->new(LocalAddr => "127.0.0.1", LocalPort => 0,
+                                   Listen => 1, ReuseAddr => 1) or die "Listen: $!\n";
+   $pid = fork();
+   die "fork: $!\n" if(!defined $pid);
+   return ($server, $pid) if($pid);
+
+   $conn = $server->accept();
+   $conn->autoflush(1);
+   $conn->setsockopt(IPPROTO_TCP, TCP_NODELAY, 1);
+   print $conn "220 localhost stand-in\r\n";
+   $cnt = $data = 0;
+   while(defined($line = <$conn>)) {
+      if($data) {
+         if($line eq ".\r\n") {
+            $data = 0;
+            $cnt++;
+            print $conn "250 queued\r\n";
+         }
+      } elsif($line =~ /^EHLO/i) {
+         print $conn "250-localhost\r\n250-PIPELINING\r\n250 8BITMIME\r\n";
+      } elsif($line =~ /^DATA/i) {
+         $data = 1;
+         print $conn "354 go ahead\r\n";
+      } elsif($line =~ /^QUIT/i) {
+         print $conn "221 bye\r\n";
+         last;
+      } else {
+         print $conn "250 ok\r\n";
+      }
+   }
+   POSIX::_exit($cnt % 256);
+}
+
+#
+# per call overhead of mysystem() on a trivial command, and throughput of a
+# command with large output, by the shell and sed pipeline mysystem() used
+# before, and by run_command() with separate output pipes
+#
+sub bench_exec {
+   my ($cnt) = @_;
+
+   my ($i, $start, $line, $out, $lines, $calls);
+
+   $calls = int($cnt / 100) || 1;
+   $lines = 10 * $cnt;
+
+   $start = time;
+   for($i = 0; $i < $calls; $i++) {
+      open CMD, "(true | sed 's/^/STDOUT /') 2>&1 |" or die "true: $!\n";
+      while($line = <CMD>) {}
+      close(CMD);
+   }
+   show_rate("shell+sed per call, true", $calls, time - $start);
+
+   $start = time;
+   for($i = 0; $i < $calls; $i++) {
+      mysystem("true", MSGLOG, 0);
+   }
+   show_rate("mysystem() per call, true", $calls, time - $start);
+
+   $start = time;
+   $out = "";
+   open CMD, "(seq 1 $lines | sed 's/^/STDOUT /') 2>&1 |" or die "seq: $!\n";
+   while($line = <CMD>) {
+      $line =~ s/^STDOUT //;
+      $out .= $line;
+   }
+   close(CMD);
+   show_rate("shell+sed output lines, seq 1 $lines", $lines, time - $start);
+
+   $start = time;
+   $out = mysystem("seq 1 $lines", MSGLOG, 16);
+   show_rate("mysystem() output lines, seq 1 $lines", $lines, time - $start);
+}
+
+#
+# remote commands/sec by get_remote_command() with an ssh connection per command,
+# and with a shared ssh master session per host, to a local fake ssh stand-in that
+# takes 20ms to "connect" if not through the control socket of a master session
+#
+sub bench_ssh {
+   my ($cnt) = @_;
+
+   my ($i, $start, $fake, $fh, $ssh, $mux, $on);
+
+   $cnt = int($cnt / 100) || 1;
+   $fake = "$LOGDIR/fakessh";
+   open($fh, "> $fake") or die "$fake: $!\n";
+   print $fh <<'FAKESSH';
+#!/usr/bin/perl
+# fake ssh: [-S sock] [-O check|exit] [-o opt] [-f] [-N] host [command]
+my ($sock, $op, $master, $persist, $host);
+while(@ARGV && $ARGV[0] =~ /^-/) {
+   my $opt = shift @ARGV;
+   if($opt eq "-S") {
+      $sock = shift @ARGV;
+   } elsif($opt eq "-O") {
+      $op = shift @ARGV;
+   } elsif($opt eq "-o") {
+      $opt = shift @ARGV;
+      $master = 1 if($opt eq "ControlMaster=yes");
+      $persist = $1 if($opt =~ /^ControlPersist=(\d+)/);
+   }
+}
+$host = shift @ARGV;
+exit((-S $sock) ? 0 : 255) if($op eq "check");
+if($op eq "exit") {
+   unlink($sock);
+   exit(0);
+}
+select(undef, undef, undef, 0.02) if(!($sock && -S $sock));   # handshake
+if($master) {
+   require IO::Socket::UNIX;
+   my $srv = IO::Socket::UNIX->new(Local => $sock, Listen => 1) or exit(255);
+   exit(0) if(fork());
+   open(STDIN, "< /dev/null"); open(STDOUT, "> /dev/null"); open(STDERR, "> /dev/null");
+   for(my $i = 0; $i < 10 * $persist && -S $sock; $i++) {
+      select(undef, undef, undef, 0.1);
+   }
+   unlink($sock);
+   exit(0);
+}
+exec("/bin/sh", "-c", join(" ", @ARGV)) if(@ARGV);
+FAKESSH
+   close($fh);
+   chmod(0755, $fake);
+   ($ssh, $mux) = ($MYLOG{SSHCMD}, $MYLOG{SSHMUX});
+   $MYLOG{SSHCMD} = $fake;
+
+   foreach $on (0, 1) {
+      $MYLOG{SSHMUX} = $on;
+      $start = time;
+      for($i = 0; $i < $cnt; $i++) {
+         mysystem(get_remote_command("true", "fakehost"), MSGLOG, 0);
+      }
+      show_rate($on ? "shared master session" : "ssh connection per command", $cnt, time - $start);
+   }
+   close_ssh_sessions();
+   ($MYLOG{SSHCMD}, $MYLOG{SSHMUX}) = ($ssh, $mux);
+}
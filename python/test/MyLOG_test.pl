@@ -0,0 +1,896 @@
+#!/usr/bin/perl
+#
+###############################################################################
+#
+#     Title : MyLOG_test.pl  -- behavioral tests for package MyLOG
+#    Author : Zaihua Ji,  zji@ucar.edu
+#   Purpose : check the behaviors of logging, email and command functions in MyLOG,
+#             in a scratch log directory, without real mail servers or remote hosts
+#
+#     Usage : MyLOG_test.pl, or prove MyLOG_test.pl
+#
+###############################################################################
+use strict;
+use Cwd qw(abs_path);
+use File::Basename;
+use File::Temp qw(tempdir);
+use IO::Socket::INET;
+use JSON::PP;
+use Time::HiRes qw(time);
+use Test::More;
+
+our ($LIBDIR, $LOGDIR);
+
+BEGIN {
+   $LIBDIR = dirname(abs_path(__FILE__)) . "/../lib";
+   $LOGDIR = tempdir("mylogtest.XXXXXX", TMPDIR => 1, CLEANUP => 1);
+   $ENV{LOGPATH} = $ENV{DBGPATH} = $ENV{TMPPATH} = $LOGDIR;
+   require "$LIBDIR/MyLOG.py";
+   MyLOG->import();
+}
+
+$MYLOG{EMLSEND} = "cat >> $LOGDIR/sent";
+
+#
+# return the text of a file, and remove it
+#
+sub take_file {
+   my ($file) = @_;
+
+   my ($fh, $str);
+
+   return "" if(!open($fh, "<", $file));
+   $str = do {local $/; <$fh>};
+   close($fh);
+   unlink($file);
+
+   return $str;
+}
+
+#
+# run perl code with MyLOG in a new process, return the exit status as $?
+#
+sub run_perl {
+   my ($code) = @_;
+
+   return system($^X, "-e", "BEGIN {require '$LIBDIR/MyLOG.py'; MyLOG->import()} $code");
+}
+
+#
+# write a fake ssh command to the scratch log directory, that runs the command given
+# locally, and starts a "master session" by creating the control socket given by -S
+#
+sub make_fake_ssh {
+   my ($fake, $fh);
+
+   $fake = "$LOGDIR/fakessh";
+   open($fh, "> $fake") or die "$fake: $!\n";
+   print $fh <<'FAKESSH';
+#!/usr/bin/perl
+# fake ssh: [-S sock] [-O check|exit] [-o opt] [-f] [-N] host [command]
+my ($sock, $op, $master);
+while(@ARGV && $ARGV[0] =~ /^-/) {
+   my $opt = shift @ARGV;
+   if($opt eq "-S") {
+      $sock = shift @ARGV;
+   } elsif($opt eq "-O") {
+      $op = shift @ARGV;
+   } elsif($opt eq "-o") {
+      $master = 1 if(shift(@ARGV) eq "ControlMaster=yes");
+   }
+}
+shift @ARGV;
+exit((-S $sock) ? 0 : 255) if($op eq "check");
+exit(unlink($sock) ? 0 : 255) if($op eq "exit");
+if($master) {
+   require IO::Socket::UNIX;
+   IO::Socket::UNIX->new(Local => $sock, Listen => 1) or exit(255);
+   exit(0);
+}
+exec("/bin/sh", "-c", join(" ", @ARGV)) if(@ARGV);
+FAKESSH
+   close($fh);
+   chmod(0755, $fake);
+
+   return $fake;
+}
+
+subtest "buffered log writer" => sub {
+   my $file = "$LOGDIR/buffered.log";
+
+   local $MYLOG{LOGFILE} = "buffered.log";
+   local $MYLOG{LOGBUFSZ} = 1000;
+   local $MYLOG{LOGFLUSH} = 3600;
+   mylog("first record", MSGLOG);
+   ok(!-s $file, "record buffered");
+   mylog("x" x 50, MSGLOG) for(1 .. 20);
+   like(take_file($file), qr/^first record\n(x{50}\n){20}$/, "written at LOGBUFSZ bytes");
+   mylog("second record", MSGLOG);
+   MyLOG::flush_logs();
+   is(take_file($file), "second record\n", "written by flush_logs()");
+
+   run_perl(q{$MYLOG{LOGFILE} = "buffered.log"; $MYLOG{LOGFLUSH} = 3600; mylog("at end", MSGLOG)});
+   is(take_file($file), "at end\n", "written at END");
+   is(run_perl(q{$MYLOG{LOGFILE} = "buffered.log"; $MYLOG{LOGFLUSH} = 3600; mylog("before", MSGLOG); mylog("quit", LOGEXT)}) >> 8,
+      1, "exit 1 for EXITLG");
+   like(take_file($file), qr/^before\nQUITS .*\nquit; Exit 1\n$/, "written before exit");
+};
+
+subtest "background log writer" => sub {
+   my $file = "$LOGDIR/async.log";
+   my ($str, $cnt, @spills);
+
+   local $MYLOG{LOGFILE} = "async.log";
+   local $MYLOG{LOGASYNC} = 1;
+   local $MYLOG{LOGQSIZE} = 10;
+   local $MYLOG{LOGQMODE} = "block";
+   mylog("record $_", MSGLOG) for(1 .. 500);
+   ok($MyLOG::LOGFILES{writer}, "writer started");
+   is(waitpid(-1, 0), -1, "writer is not a child");
+   MyLOG::close_logs();
+   is(take_file($file), join("", map {"record $_\n"} 1 .. 500), "all records in order when blocked");
+
+   $MYLOG{LOGQMODE} = "drop";
+   mylog("start", MSGLOG);
+   kill("STOP", $MyLOG::LOGFILES{writer});
+   mylog("x" x 50 . " $_", MSGLOG) for(1 .. 2000);
+   kill("CONT", $MyLOG::LOGFILES{writer});
+   MyLOG::close_logs();
+   $str = take_file($file);
+   $cnt = () = $str =~ /^x{50} \d+$/mg;
+   ok($str =~ /^(\d+) log record\(s\) dropped for full log queue$/m && $cnt + $1 == 2000, "dropped records counted");
+
+   $MYLOG{LOGQMODE} = "spill";
+   mylog("start", MSGLOG);
+   kill("STOP", $MyLOG::LOGFILES{writer});
+   mylog("x" x 50 . " $_", MSGLOG) for(1 .. 2000);
+   @spills = glob("$LOGDIR/mylog.$$.spill.*");
+   kill("CONT", $MyLOG::LOGFILES{writer});
+   MyLOG::close_logs();
+   ok(@spills && !grep(-e, @spills), "records spilled and replayed");
+   is(take_file($file), join("", "start\n", map {"x" x 50 . " $_\n"} 1 .. 2000), "all records in order when spilled");
+
+   is(run_perl(q{$SIG{ALRM} = sub {exit 2}; alarm 10; $MYLOG{LOGFILE} = "async.log"; $MYLOG{LOGASYNC} = 1;
+                 mylog("before reaping", MSGLOG); 1 while(wait() != -1); mylog("after reaping", MSGLOG)}), 0,
+      "script reaping its children");
+   is(take_file($file), "before reaping\nafter reaping\n", "records written by the script reaping its children");
+};
+
+subtest "JSON log records and index" => sub {
+   my ($str, $rec, @recs, @idxes);
+
+   local $MYLOG{LOGFILE} = "json.log";
+   local $MYLOG{ERRFILE} = "json.err";
+   local $MYLOG{LOGFORMAT} = "json";
+   mylog("message\twith \"quotes\"", MSGLOG);
+   mylog("failed", ERRLOG);
+   MyLOG::flush_logs();
+
+   $str = take_file("$LOGDIR/json.log");
+   $rec = eval {decode_json($str)};
+   ok($rec, "one JSON record per line");
+   is($rec->{msg}, "message\twith \"quotes\"", "message");
+   is($rec->{level}, "LOG", "level");
+   is($rec->{logact}, MSGLOG, "logact bits");
+   is($rec->{host}, $MYLOG{HOSTNAME}, "host");
+   is($rec->{uid}, $MYLOG{CURUID}, "uid");
+   like(take_file("$LOGDIR/json.log.idx"), qr/^0\t${\length($str)}\t$rec->{time}\t\Q$rec->{pid}\E\t\tLOG\t$rec->{elapsed}\n$/, "indexed");
+
+   $str = take_file("$LOGDIR/json.err");
+   $rec = eval {decode_json($str)};
+   is($rec->{level}, "ERROR", "error record");
+   is($rec->{msg}, "failed", "error message");
+   @idxes = split(/\t/, take_file("$LOGDIR/json.err.idx"));
+   is(substr($str, $idxes[0], $idxes[1]), $str, "error record indexed");
+};
+
+subtest "log rotation and locked appends" => sub {
+   my ($str, $pid, @rolled, @recs, %cnts);
+
+   local $MYLOG{LOGFILE} = "roll.log";
+   local $MYLOG{LOGBUFSZ} = 100;
+   local $MYLOG{LOGROTSZ} = 1000;
+   local $MYLOG{LOGCOMPRESS} = "";
+   local $MYLOG{LOGFORMAT} = "json";
+   mylog("record $_", MSGLOG) for(1 .. 30);
+   MyLOG::flush_logs();
+   @rolled = grep {!/\.idx$/} glob("$LOGDIR/roll.log.*");
+   ok(@rolled > 1, "rolled by size");
+   ok(!grep({-s $_ > 1000} @rolled, "$LOGDIR/roll.log"), "no segment over LOGROTSZ");
+   $str = join("", map {take_file($_)} @rolled);
+   is(scalar(() = $str =~ /"msg":"record \d+"/g) + scalar(() = take_file("$LOGDIR/roll.log") =~ /"msg":"record \d+"/g),
+      30, "no record lost");
+   ok(!grep({!-e "$_.idx"} @rolled), "index rolled with uncompressed segment");
+   unlink(glob("$LOGDIR/roll.log*"));
+
+   $MYLOG{LOGCOMPRESS} = "gzip";
+   mylog("record $_", MSGLOG) for(1 .. 30);
+   MyLOG::flush_logs();
+   for(1 .. 50) {
+      last if(!grep {!/\.(gz|idx)$/} glob("$LOGDIR/roll.log.*"));
+      select(undef, undef, undef, 0.1);
+   }
+   ok(glob("$LOGDIR/roll.log.*.gz"), "rolled segments compressed");
+   ok(!glob("$LOGDIR/roll.log.*.idx"), "no index for compressed segment");
+   is(scalar(query_logs({}, "$LOGDIR/roll.log")), () = take_file("$LOGDIR/roll.log") =~ /\n/g, "current segment queried");
+   unlink(glob("$LOGDIR/roll.log*"));
+
+   $MYLOG{LOGROTSZ} = 0;
+   $MYLOG{LOGFORMAT} = "";
+   for(1 .. 4) {
+      next if($pid = fork);
+      mylog("$$ record $_ line 1\n$$ record $_ line 2\n$$ record $_ line 3", MSGLOG) for(1 .. 200);
+      MyLOG::flush_logs();
+      POSIX::_exit(0);
+   }
+   1 while(wait() != -1);
+   @recs = take_file("$LOGDIR/roll.log") =~ /(.*\n.*\n.*\n)/g;
+   is(scalar(@recs), 800, "all records appended");
+   is(scalar(grep {/^(\d+ record \d+) line 1\n\1 line 2\n\1 line 3\n$/} @recs), 800, "records not interleaved");
+
+   mkdir("$LOGDIR/moved");
+   $MYLOG{LOGBUFSZ} = 1000;
+   MyLOG::write_log("$LOGDIR/moved/kept.log", "record 1\n", 0, "1\tpid\t\tLOG\t0");
+   rename("$LOGDIR/moved", "$LOGDIR/moving");
+   MyLOG::flush_logs();
+   rename("$LOGDIR/moving", "$LOGDIR/moved");
+   MyLOG::write_log("$LOGDIR/moved/kept.log", "record 2\n", 1, "2\tpid\t\tLOG\t0");
+   is(take_file("$LOGDIR/moved/kept.log"), "record 1\nrecord 2\n", "records kept when cannot reopen");
+   is(take_file("$LOGDIR/moved/kept.log.idx"), "0\t9\t1\tpid\t\tLOG\t0\n9\t9\t2\tpid\t\tLOG\t0\n", "index kept when cannot reopen");
+};
+
+subtest "query logs by index" => sub {
+   my ($pid, @recs);
+
+   local $MYLOG{LOGFILE} = "query.log";
+   local $MYLOG{ERRFILE} = "query.err";
+   local %MyLOG::CPID = %MyLOG::CPID;
+   cmdlog("job A", time - 100);
+   $pid = $MyLOG::CPID{PID};
+   mylog("job A failed", ERRLOG);
+   cmdlog("End", time);
+   cmdlog("job B", time - 10);
+   cmdlog("End", time);
+
+   @recs = query_logs({pid => $pid});
+   is(join(",", sort map {$_->{kind}} @recs), "END,ERROR,START", "all records of a run");
+   is($recs[0]{kind}, "START", "sorted by time");
+   @recs = grep {$_->{kind} eq "ERROR"} @recs;
+   like($recs[0]{record}, qr/^ERROR \Q$pid\E .*\njob A failed\n$/, "error record read");
+   @recs = query_logs({kind => "ERROR", btime => time - 3600});
+   is(scalar(@recs), 1, "errors in last hour");
+   is(scalar(query_logs({kind => "ERROR", etime => time - 3600})), 0, "no errors before last hour");
+   @recs = query_logs({kind => "END", slowest => 1});
+   is($recs[0]{pid}, $pid, "slowest run");
+   cmp_ok($recs[0]{secs}, ">=", 100, "run time");
+   is(scalar(query_logs({host => "nohost"})), 0, "by host");
+
+   take_file("$LOGDIR/query.log.idx");
+   @recs = query_log_records("$LOGDIR/query.log", {kind => "START"});
+   is(scalar(@recs), 2, "indexed when queried");
+   like($recs[0], qr/^\Q$pid\E: job A\n$/, "record read");
+   ok(-s "$LOGDIR/query.log.idx", "index written");
+};
+
+subtest "repeated messages suppressed" => sub {
+   local $MYLOG{LOGFILE} = "dup.log";
+   local $MYLOG{DUPMAX} = 2;
+   mylog("job $_ failed", MSGLOG|EMLLOG) for(1 .. 10);
+   mylog("other message", MSGLOG|EMLLOG);
+   MyLOG::flush_logs();
+   is(take_file("$LOGDIR/dup.log"), "job 1 failed\njob 2 failed\nother message\n", "repeats over DUPMAX not logged");
+   is(MyLOG::get_email(), "job 1 failed\njob 2 failed\nother message\n", "repeats over DUPMAX not emailed");
+   MyLOG::report_duplicates(1);
+   MyLOG::flush_logs();
+   like(take_file("$LOGDIR/dup.log"), qr/^Repeated 10 times over \w+ \(8 not logged\): job 1 failed\n$/, "repeats reported");
+   like(MyLOG::get_email(), qr/\nRepeated 10 times .*: job 1 failed\n$/, "repeats reported in email");
+   MyLOG::clear_email();
+
+   mylog("job $_ failed", MSGLOG) for(1 .. 3);
+   MyLOG::flush_logs();
+   is(take_file("$LOGDIR/dup.log"), "job 1 failed\njob 2 failed\njob 3 failed\n", "not suppressed for a class without window");
+};
+
+subtest "deferred messages" => sub {
+   my $built = 0;
+   my $msg = sub {$built++; "built message"};
+
+   local $MYLOG{LOGFILE} = "lazy.log";
+   local $MYLOG{DBGFILE} = "lazy.dbg";
+   local $MYLOG{LOGMASK} = $MYLOG{LOGMASK} & ~MSGLOG;
+   mylog($msg, MSGLOG);
+   is($built, 0, "not built when filtered by LOGMASK");
+   $MYLOG{LOGMASK} |= MSGLOG;
+   mylog($msg, MSGLOG);
+   mylog(["%s %03d", "count", 5], MSGLOG);
+   MyLOG::flush_logs();
+   is($built, 1, "built once when logged");
+   is(take_file("$LOGDIR/lazy.log"), "built message\ncount 005\n", "code and sprintf messages");
+   is(mylog(["%d records", 3], RETMSG), "3 records\n", "built for returned message");
+
+   mydbg(1, $msg);
+   is($built, 1, "not built for DBGLEVEL unset");
+   set_debug_level("0-3");
+   mydbg(5, $msg);
+   is($built, 1, "not built for level out of range");
+   mydbg(2, $msg);
+   MyLOG::flush_logs();
+   is($built, 2, "built for level in range");
+   is(take_file("$LOGDIR/lazy.dbg"), "2:built message\n", "debug record");
+   set_debug_level(0);
+};
+
+subtest "debug level filter" => sub {
+   local $MYLOG{DBGFILE} = "filter.dbg";
+   set_debug_level("0-1,MyLOG_test:5-6");
+   mydbg(5, "by this file");
+   mydbg(1, "below the range of this file");
+   mydbg(5, "over the range of other files", "other.pl", 10);
+   mydbg(1, "by other file", "other.pl", 10);
+   MyLOG::flush_logs();
+   like(take_file("$LOGDIR/filter.dbg"), qr/^5:by this file\n1:by other file\n.*other\.pl/, "levels by caller file");
+
+   $MYLOG{DBGLEVEL} = "3-4";
+   mydbg(5, "over the changed levels");
+   mydbg(3, "in the changed levels");
+   MyLOG::flush_logs();
+   is(take_file("$LOGDIR/filter.dbg"), "3:in the changed levels\n", "recompiled when DBGLEVEL changed");
+   set_debug_level(0);
+   mydbg(0, "no debug");
+   MyLOG::flush_logs();
+   ok(!-e "$LOGDIR/filter.dbg", "no debug for level 0");
+};
+
+subtest "metrics" => sub {
+   my ($str, $json, %vals);
+
+   local $MYLOG{LOGFILE} = "metric.log";
+   local $MYLOG{BCKGRND} = 1;
+   local %MyLOG::METRICS = (counters => {}, histograms => {});
+   mylog("counted", WARNLG);
+   mylog("counted", WARNLG);
+   mysystem("echo out", 0);
+   mysystem("sh -c 'echo err >&2'", 0);
+   MyLOG::flush_logs();
+   take_file("$LOGDIR/metric.log");
+
+   ok(dump_metrics("$LOGDIR/metrics.prom", "prom"), "dumped in Prometheus format");
+   $str = take_file("$LOGDIR/metrics.prom");
+   like($str, qr/^# TYPE mylog_records_total counter$/m, "counter type");
+   like($str, qr/^mylog_records_total\{host="[^"]*",prog="[^"]*",class="WARNLG"\} 2$/m, "mylog records by class");
+   like($str, qr/^mysystem_calls_total\{.*cmd="echo",status="success"\} 1$/m, "mysystem successes");
+   like($str, qr/^mysystem_calls_total\{.*cmd="sh",status="failure"\} 1$/m, "mysystem failures");
+   like($str, qr/^mysystem_seconds_bucket\{.*cmd="echo",le="\+Inf"\} 1$/m, "mysystem time histogram");
+   like($str, qr/^mysystem_seconds_count\{.*cmd="echo"\} 1$/m, "mysystem time count");
+
+   ok(dump_metrics("$LOGDIR/metrics.json", "json"), "dumped in JSON format");
+   $json = eval {decode_json(take_file("$LOGDIR/metrics.json"))};
+   %vals = map {("$_->{name}\{$_->{labels}\}" => $_->{value})} grep {defined $_->{value}} @{$json->{metrics}};
+   is($vals{'mylog_records_total{class="WARNLG"}'}, 2, "JSON counter");
+   is($json->{pid}, $$, "JSON pid");
+};
+
+subtest "debug ring dumped on error" => sub {
+   my $built = 0;
+
+   local $MYLOG{LOGFILE} = "ring.log";
+   local $MYLOG{ERRFILE} = "ring.err";
+   local $MYLOG{BCKGRND} = 1;
+   local $MYLOG{DBGRING} = 3;
+   mydbg($_, sub {$built++; "debug record"}) for(1 .. 5);
+   is($built, 0, "not built when recorded");
+   mylog("failed", ERRLOG);
+   MyLOG::flush_logs();
+   is($built, 3, "last records built when dumped");
+   like(take_file("$LOGDIR/ring.err"), qr/^ERROR .*\nfailed\nDEBUG RING for .*: last 3 debug record\(s\)\n\d+ 3:debug record\n\d+ 4:debug record\n\d+ 5:debug record\nEND DEBUG RING\n$/,
+        "dumped after the error record");
+
+   run_perl(q{$MYLOG{LOGFILE} = "ring.log"; $MYLOG{DBGRING} = 3; mydbg(1, "before quit"); mylog("quit", EXITLG)});
+   like(take_file("$LOGDIR/ring.log"), qr/^QUITS .*\nquit; Exit 1\nDEBUG RING for .*\n\d+ 1:before quit\nEND DEBUG RING\n$/, "dumped for EXITLG");
+};
+
+subtest "email details spilled over EMLMEM" => sub {
+   my ($i, $sent);
+
+   local $MYLOG{EMLMEM} = 2000;
+   local $MYLOG{EMLMAX} = $MYLOG{EMLMAX};
+   for($i = 1; $i <= 300; $i++) {
+      set_email("line $i\n", EMLLOG);
+   }
+   set_email("err\n", ERRLOG|EMLLOG);
+   ok($MyLOG::EMLBUF{spilled} > 0, "details spilled");
+   ok(MyLOG::email_size() <= $MYLOG{EMLMEM}, "memory bounded by EMLMEM");
+   like($MYLOG{ERRMSG}, qr/^1\. err$/m, "ERRMSG kept in %MYLOG");
+   set_email("Title", EMLTOP);
+   like($MyLOG::EMLBUF{head}, qr/^Title with 1 Error:\n/, "title kept in head segment");
+   unlike($MYLOG{EMLMSG}, qr/Title/, "title not prepended to details");
+   send_email("spill", "zji");
+   $sent = take_file("$LOGDIR/sent");
+   is(scalar(() = $sent =~ /^line \d+$/mg), 300, "all spilled lines sent");
+   like($sent, qr/Title with 1 Error:\n1\. err\n/, "title with errors before the details");
+   ok(!MyLOG::email_pending(), "buffer cleared");
+   is_deeply([glob("$LOGDIR/myemail.*.spill")], [], "spill file removed");
+
+   set_email("line 1\n", EMLLOG);
+   set_email("Title", EMLTOP);
+   is(MyLOG::get_email(), "Title!\n$MYLOG{SEPLINE}line 1\n", "title joined before details not spilled");
+   send_email("joined", "zji");
+   like(take_file("$LOGDIR/sent"), qr/\n\nTitle!\n\Q$MYLOG{SEPLINE}\Eline 1\n/, "title sent before details");
+
+   $MYLOG{EMLMAX} = 3000;
+   for($i = 1; $i <= 1000; $i++) {
+      set_email("line $i\n", EMLLOG);
+   }
+   ok(MyLOG::email_size() + $MyLOG::EMLBUF{spilled} <= $MYLOG{EMLMAX}, "spilled bytes bounded by EMLMAX");
+   ok($MYLOG{EMLSKIP} > 0, "messages over EMLMAX counted");
+   send_email("capped", "zji");
+   like(take_file("$LOGDIR/sent"), qr/\(\d+ more message\(s\) not included, over 3000 bytes\)\n/, "skipped messages noted");
+};
+
+subtest "SMTP session" => sub {
+   my ($srv, $sock, $conn, $ret, $pid, $line, $fh, $str);
+
+   local @MYLOG{qw(SMTPHOST SMTPPORT)} = ("127.0.0.1", 0);
+   $srv = IO::Socket::INET->new(LocalAddr => "127.0.0.1", LocalPort => 0, Listen => 1, ReuseAddr => 1);
+   $MYLOG{SMTPPORT} = $srv->sockport;
+   if(!($pid = fork)) {   # stand-in SMTP server, record the session
+      $conn = $srv->accept;
+      $conn->autoflush(1);
+      open($fh, ">", "$LOGDIR/smtp");
+      print $conn "220 stand-in\r\n";
+      while(defined($line = <$conn>)) {
+         print $fh $line;
+         if($line =~ /^DATA/) {
+            print $conn "354 go ahead\r\n";
+            while(defined($line = <$conn>)) {
+               print $fh $line;
+               last if($line eq ".\r\n");
+            }
+            print $conn "250 queued\r\n";
+         } elsif($line =~ /^EHLO/) {
+            print $conn "250-stand-in\r\n250 PIPELINING\r\n";
+         } elsif($line =~ /^QUIT/) {
+            print $conn "221 bye\r\n";
+            last;
+         } else {
+            print $conn "250 ok\r\n";
+         }
+      }
+      close($fh);
+      POSIX::_exit(0);
+   }
+   send_email("first", "zji", "first body\n");
+   send_email("second", "zji", ".dotted line\n");
+   MyLOG::smtp_close();
+   waitpid($pid, 0);
+   $str = take_file("$LOGDIR/smtp");
+   is(scalar(() = $str =~ /^DATA\r$/mg), 2, "two emails in one session");
+   like($str, qr/^MAIL FROM:<\S+>\r\nRCPT TO:<zji\@ucar.edu>\r\n/m, "envelope");
+   like($str, qr/^Subject: second!\r\n\r\n\.\.dotted line\r\n/m, "dot stuffed");
+   is(take_file("$LOGDIR/sent"), "", "no EMLSEND for SMTP");
+
+   close($srv);
+   send_email("fallback", "zji", "fallback body\n");
+   like(take_file("$LOGDIR/sent"), qr/Subject: fallback!\n\nfallback body\n/, "EMLSEND when SMTP server is down");
+
+   $srv = IO::Socket::INET->new(LocalAddr => "127.0.0.1", LocalPort => 0, Listen => 1, ReuseAddr => 1);
+   $sock = IO::Socket::INET->new(PeerAddr => "127.0.0.1", PeerPort => $srv->sockport);
+   $conn = $srv->accept;
+   close($conn);
+   Time::HiRes::sleep(0.2);
+   @MyLOG::SMTPCONN{qw(sock pid)} = ($sock, $$);
+   $ret = 1;
+   $ret = MyLOG::smtp_write("x" x 100000) while($ret && $MyLOG::SMTPCONN{sock});
+   ok(!$ret, "write fails instead of SIGPIPE");
+   ok(!$MyLOG::SMTPCONN{sock}, "session dropped");
+};
+
+subtest "email digests" => sub {
+   my ($str, $key);
+
+   local $MYLOG{LOGFILE} = "digest.log";
+   local $MYLOG{EMLDIGEST} = -1;
+   like(send_email("job failed", "zji", "job 1 failed\n"), qr/held for digest \(1 pending\)/, "held");
+   like(send_email("job failed", "zji", "job 2 failed\n"), qr/held for digest \(2 pending\)/, "held with the same recipients");
+   like(send_email("job done", "zji", "job 3 done\n", "other"), qr/held for digest \(1 pending\)/, "held apart for other sender");
+   is(take_file("$LOGDIR/sent"), "", "not sent yet");
+   is(MyLOG::flush_email_digests(1), 2, "one email per digest");
+   $str = take_file("$LOGDIR/sent");
+   like($str, qr/^Subject: job failed \(2 Messages\)!\n\n2 messages between .*\n     2 x job failed\n/m, "digest summary");
+   like($str, qr/Message 1 of 2 at .*, Subject: job failed\n\njob 1 failed\n.*Message 2 of 2 .*\n\njob 2 failed\n/s, "digest sections");
+   like($str, qr/^From: other\@ucar.edu\n(.*\n)*Subject: job done!\n\njob 3 done\n/m, "other sender");
+
+   $MYLOG{EMLDIGEST} = 60;
+   send_email("job failed", "zji", "job 4 failed\n");
+   mylog("not due", MSGLOG);
+   is(take_file("$LOGDIR/sent"), "", "held within the window");
+   $_->{time} -= 60 foreach(values %MyLOG::EMLDIGESTS);
+   mylog("due", MSGLOG);
+   like(take_file("$LOGDIR/sent"), qr/^Subject: job failed!\n\njob 4 failed\n/m, "sent by mylog() past the window");
+   ok(!%MyLOG::EMLDIGESTS, "no digest left");
+   MyLOG::flush_logs();
+   take_file("$LOGDIR/digest.log");
+};
+
+subtest "email spool" => sub {
+   my ($spool, @files);
+
+   local $MYLOG{LOGFILE} = "spool.log";
+   local $MYLOG{BCKGRND} = 1;
+   local $MYLOG{EMLSPOOL} = $spool = "$LOGDIR/spool";
+   local $MYLOG{EMLTRIES} = 2;
+   send_email("spooled", "zji", "spooled body\n");
+   @files = glob("$spool/new/*");
+   is(scalar(@files), 1, "spooled in new/");
+   like($files[0], qr/\/\d+-0-[^\/]+-$$-\d+$/, "spool file name");
+   is(take_file("$LOGDIR/sent"), "", "not sent yet");
+
+   is(run_email_spool(0), 1, "delivered by the worker");
+   like(take_file("$LOGDIR/sent"), qr/Subject: spooled!\n\nspooled body\n/, "spooled email sent");
+   is_deeply([glob("$spool/new/* $spool/cur/*")], [], "spool emptied");
+   like(take_file("$LOGDIR/$MYLOG{EMLFILE}"), qr/Subject: spooled!/, "email recorded");
+
+   send_email("failing", "zji", "failing body\n");
+   {
+      local $MYLOG{EMLSEND} = "cat > /dev/null; exit 1";
+      is(run_email_spool(0), 0, "not delivered");
+      @files = glob("$spool/new/*");
+      like($files[0], qr/\/(\d+)-1-/, "tried once");
+      ok(($files[0] =~ /\/(\d+)-/)[0] > time, "retried later");
+      rename($files[0], $files[0] =~ s/\/\d+-1-/\/0-1-/r);
+      run_email_spool(0);
+      is(scalar(() = glob("$spool/failed/*")), 1, "moved to failed/ after EMLTRIES tries");
+   }
+
+   send_email("claimed", "zji", "claimed body\n");
+   @files = glob("$spool/new/*");
+   rename($files[0], $files[0] =~ s/\/new\//\/cur\//r);
+   utime(time - 7200, time - 7200, glob("$spool/cur/*"));
+   is(run_email_spool(0), 1, "stale claim delivered");
+   like(take_file("$LOGDIR/sent"), qr/Subject: claimed!/, "claimed email sent");
+   MyLOG::flush_logs();
+   unlink("$LOGDIR/spool.log", "$LOGDIR/spool.err", "$LOGDIR/$MYLOG{EMLFILE}");
+};
+
+subtest "recipients with display names" => sub {
+   my (%set, $sent);
+
+   MyLOG::add_email_recipients(\%set, '"Ji, Zaihua" <ZJI@ucar.edu>, Tom Cram <tcram>, hua zji, bob@x.org', 1);
+   is_deeply($set{list}, ['"Ji, Zaihua" <ZJI@ucar.edu>', 'Tom Cram <tcram@ucar.edu>', 'hua@ucar.edu', 'bob@x.org'],
+             "display names kept, duplicates dropped");
+   is_deeply([MyLOG::email_addresses('"Ji, Zaihua" <zji@ucar.edu>, tcram')], ['zji@ucar.edu', 'tcram@ucar.edu'],
+             "bare addresses");
+
+   add_carbon_copy();
+   add_carbon_copy("zji", 1);
+   add_carbon_copy("ji, ZJI", 1);
+   is(get_carbon_copy(), "zji\@ucar.edu, ji\@ucar.edu", "matched as whole addresses, case insensitive");
+   add_carbon_copy();
+   add_carbon_copy("Zaihua Ji <zji\@ucar.edu>, tcram", 1);
+   is($MYLOG{CCDADDR}, "Zaihua Ji <zji\@ucar.edu>, tcram\@ucar.edu", "CCDADDR follows add_carbon_copy()");
+   $MYLOG{CCDADDR} = "other\@x.org";
+   add_carbon_copy("tcram", 1);
+   is(get_carbon_copy(), "other\@x.org, tcram\@ucar.edu", "CCDADDR set directly is picked up");
+
+   send_email("names", "Zaihua Ji <zji\@ucar.edu>", "hello\n", "zji");
+   $sent = take_file("$LOGDIR/sent");
+   like($sent, qr/^To: Zaihua Ji <zji\@ucar.edu>$/m, "To header as given");
+   like($sent, qr/^Cc: other\@x.org, tcram\@ucar.edu$/m, "Cc header");
+   add_carbon_copy();
+};
+
+subtest "email archive" => sub {
+   my ($file, $i, @emails);
+
+   local $MYLOG{EMLFILE} = "archive.log";
+   local $MYLOG{EMLARCH} = 1;
+   local $MYLOG{EMLMEM} = 1000;
+   $file = "$LOGDIR/archive.log.gz";
+   send_email("dsupdt notice", "zji", "first notice\n");
+   send_email("dsrqst notice", "tcram, bob\@x.org", "second notice\n");
+   set_email("line $_\n", EMLLOG) for(1 .. 200);
+   send_email("dsupdt details", "zji");
+   take_file("$LOGDIR/sent");
+
+   @emails = search_emails({to => "zji"});
+   is(join(",", map {$_->{subject}} @emails), "dsupdt notice!,dsupdt details!", "by recipient");
+   @emails = search_emails({to => "BOB\@x.org"});
+   is(scalar(@emails), 1, "by recipient case insensitive");
+   like($emails[0]{email}, qr/^Subject: dsrqst notice!\n\nsecond notice\n/m, "decompressed email");
+   like($emails[0]{recipients}, qr/^tcram\@ucar.edu,bob\@x.org(,|$)/, "recipients");
+   @emails = search_emails({subject => "^dsupdt", text => "line 200\n"});
+   is(scalar(@emails), 1, "by subject and text");
+   is(scalar(() = $emails[0]{email} =~ /^line \d+$/mg), 200, "spilled details archived");
+   is(scalar(search_emails({btime => time + 60})), 0, "by time");
+   is(scalar(search_emails({pid => "nopid"})), 0, "by PID tag");
+   like(`gzip -dc $file`, qr/first notice\n.*second notice\n.*line 200\n/s, "archive readable by gzip");
+   unlink($file, "$file.idx");
+};
+
+subtest "command output by pipes" => sub {
+   local $MYLOG{BCKGRND} = 1;
+   is(mysystem("printf 'a\\nb\\n'", 0, 16), "a\nb\n", "standard output returned");
+   is(mysystem("echo 'a  b' \"c  d\"", 0, 16), "a  b c  d\n", "quoted arguments");
+   is(mysystem("echo out; echo err >&2", 0, 16+256), "out\n", "standard output apart from error");
+   like($MYLOG{SYSERR}, qr/\nerr\n$/, "error output cached");
+   is(mysystem("echo err >&2", 0, 16+32), "err\n", "error as standard output");
+   is(length(mysystem("seq 1 100000", 0, 16)), length(join("", map {"$_\n"} 1 .. 100000)), "large output");
+   is(mysystem("echo piped | tr a-z A-Z", 0, 16), "PIPED\n", "shell syntax");
+   like(mysystem("command -v sh", 0, 16), qr/sh$/m, "command -v");
+   like(mysystem("umask", 0, 16), qr/^\d+$/m, "umask");
+   is(mysystem("cd /", 0, 16), "", "cd");
+};
+
+subtest "parallel commands" => sub {
+   my (@cmds, @res, @lines, %seen, $last);
+
+   local $MYLOG{LOGFILE} = "parallel.log";
+   local $MYLOG{BCKGRND} = 1;
+   @cmds = map {["sleep 0.$_; echo $_", 0, 16]} (6, 1, 3);
+   @res = run_commands(\@cmds, {workers => 3});
+   is(join("", map {$_->{ret}} @res), "6\n1\n3\n", "results in submission order");
+   is(join(",", map {$_->{status}} @res), "success,success,success", "all succeeded");
+   @res = run_commands(\@cmds, {workers => 3, order => 'complete'});
+   is(join("", map {$_->{ret}} @res), "1\n3\n6\n", "results in completion order");
+
+   @res = run_commands(["sleep 5", "sh -c 'echo bad >&2; exit 1'", "sleep 5", "echo skipped"], {workers => 3, failfast => 1});
+   is(join(",", map {$_->{status}} @res), "killed,failure,killed,skipped", "failfast");
+   cmp_ok($res[0]{secs}, "<", 4, "running commands killed");
+   @res = run_commands(["sh -c 'echo bad >&2; exit 1'", "echo ok"], {workers => 1});
+   is(join(",", map {$_->{status}} @res), "failure,success", "collect all");
+
+   run_commands([map {["sh -c 'for i in 1 2 3; do echo $_ \$i; sleep 0.1; done'", MSGLOG, 7]} 1 .. 3], {workers => 3});
+   MyLOG::flush_logs();
+   @lines = grep {/^\d \d$/} split(/\n/, take_file("$LOGDIR/parallel.log"));
+   is(scalar(@lines), 9, "output lines logged");
+   $last = "";
+   foreach (@lines) {
+      /^(\d)/;
+      $seen{$1}++ if($1 ne $last);
+      $last = $1;
+   }
+   is(join(",", map {$seen{$_}} 1 .. 3), "1,1,1", "log lines of each command kept together");
+
+   is(run_perl(q{$MYLOG{LOGFILE} = "parallel.log"; $MYLOG{BCKGRND} = 1;
+                 run_commands([["sh -c 'echo bad >&2'", LOGEXT|ERRLOG], "sleep 5"], {workers => 2}); exit 0}) >> 8,
+      1, "exit for EXITLG once results collected");
+   $last = take_file("$LOGDIR/parallel.err");
+   like($last, qr/Command failure: sh -c 'echo bad >&2'; Exit 1\n/, "exit logged by the caller");
+   like($last, qr/^ERROR .*\nError Execute: sh -c 'echo bad >&2'\nbad\nABORTS /, "worker logged the error without exit");
+   unlink("$LOGDIR/parallel.log");
+};
+
+subtest "CMDTIME deadline across retries" => sub {
+   my $stime = time;
+
+   local $MYLOG{BCKGRND} = 1;
+   local $MYLOG{CMDTIME} = 2;
+   local $MYLOG{SYSRETRY} = {attempts => 5, backoff => 0};
+   mysystem("sleep 1.5; echo bad >&2", 0, 0);
+   ok(time - $stime < 3, "ends by the deadline");
+   ok($MyLOG::SYSRESULT{timedout}, "last try timed out");
+
+   $stime = time;
+   is(tosystem("sleep 5", 1, 0, 0), FAILURE, "tosystem() timed out");
+   ok($MyLOG::SYSRESULT{timedout}, "timeout flagged");
+   ok(time - $stime < 3, "command stopped at the timeout");
+};
+
+subtest "streamed command output" => sub {
+   my (@lines, $cnt, $stime);
+
+   local $MYLOG{BCKGRND} = 1;
+   mysystem_stream("echo out1; echo err1 >&2; echo out2", 0, 0, sub {push @lines, ($_[1] ? 1 : 0) . ":$_[0]"; 0});
+   is(join("", sort @lines), "0:err1\n1:out1\n1:out2\n", "lines classified");
+   $cnt = 0;
+   $stime = time;
+   mysystem_stream("seq 1 1000000; sleep 5", 0, 0, sub {++$cnt >= 10});
+   is($cnt, 10, "stopped by the callback");
+   ok($MyLOG::SYSRESULT{stopped}, "stopped flagged");
+   ok(time - $stime < 3, "command stopped");
+};
+
+subtest "mytar replaces a member" => sub {
+   my $dir = Cwd::getcwd();
+
+   mkdir("$LOGDIR/tar");
+   chdir("$LOGDIR/tar");
+   foreach (qw(a b c)) {
+      open(my $fh, ">", $_);
+      print $fh "$_\n";
+      close($fh);
+   }
+   mysystem("tar -cf t.tar a b c", 0, 0);
+   open(my $fh, ">", "b");
+   print $fh "B2\n";
+   close($fh);
+   ok(mytar("t.tar", "b", 0), "replaced");
+   is(mysystem("tar -xOf t.tar b", 0, 16), "B2\n", "new content");
+   is(mysystem("tar -tf t.tar", 0, 16), "a\nb\nc\n", "members in order");
+   chdir($dir);
+};
+
+subtest "retry by a SYSRETRY hash" => sub {
+   my $cnt = "$LOGDIR/tries";
+
+   local $MYLOG{BCKGRND} = 1;
+   local $MYLOG{SYSRETRY} = {attempts => 3, backoff => 0};
+   mysystem("echo x >> $cnt; echo bad >&2", 0, 0);
+   is(scalar(() = take_file($cnt) =~ /x/g), 3, "tried 3 times with the default settings");
+   $MYLOG{SYSRETRY} = {attempts => 3, backoff => 0, fatal => ['No such file']};
+   mysystem("echo x >> $cnt; echo 'No such file' >&2", 0, 0);
+   is(scalar(() = take_file($cnt) =~ /x/g), 1, "not retried for a fatal error");
+   $MYLOG{SYSRETRY} = {attempts => 3, backoff => 0, retry => ['busy']};
+   mysystem("echo x >> $cnt; echo 'other error' >&2", 0, 0);
+   is(scalar(() = take_file($cnt) =~ /x/g), 1, "not retried for an error not retryable");
+   mysystem("echo x >> $cnt; echo 'device busy' >&2", 0, 0);
+   is(scalar(() = take_file($cnt) =~ /x/g), 3, "retried for a retryable error");
+   ok(!grep({MyLOG::retry_wait({backoff => 10, factor => 2, maxwait => 15, jitter => 0.5}, 5) > 15} 1 .. 100),
+      "wait with jitter capped by maxwait");
+};
+
+subtest "circuit results passed back from workers" => sub {
+   my (@res, $ssh);
+
+   local $MYLOG{BCKGRND} = 1;
+   $ssh = "$LOGDIR/ssh";
+   open(my $fh, ">", $ssh) or die "$ssh: $!\n";
+   print $fh "#!/bin/sh\necho down >&2\n";
+   close($fh);
+   chmod(0755, $ssh);
+   set_retry_policy("circuit", {attempts => 1, breaker => 2, cooldown => 60}, "^$ssh ");
+   @res = run_commands([map {["$ssh hostx echo $_", 0, 256]} 1..4], {workers => 1});
+   ok($MyLOG::CIRCUITS{"ssh:hostx"}{opened}, "circuit opened in the parent");
+   like($res[3]{error}, qr/Circuit open for ssh:hostx/, "later worker rejected");
+   @MyLOG::RETRYRULES = grep {$_->[1] ne "circuit"} @MyLOG::RETRYRULES;
+};
+
+subtest "command resource usage" => sub {
+   my ($dir, @lines, @fields, $report);
+
+   local $MYLOG{BCKGRND} = 1;
+   local $MYLOG{CMDSTATS} = $dir = "$LOGDIR/stats";
+   mkdir($dir);
+   mysystem("$^X -e '\$x++ for 1 .. 3000000'", 0, 0);
+   ok($MyLOG::SYSRESULT{utime} + $MyLOG::SYSRESULT{stime} > 0, "CPU time");
+   cmp_ok($MyLOG::SYSRESULT{secs}, ">", 0, "wall time");
+   ok($MyLOG::SYSRESULT{maxrss} > 1000, "max RSS by wait4()") if($MyLOG::WAIT4);
+   mysystem("sh -c 'exit 3'", 0, 0);
+   is($MyLOG::SYSRESULT{status} >> 8, 3, "exit status");
+   {
+      local $MyLOG::WAIT4 = 0;
+      mysystem("sh -c 'exit 4'", 0, 0);
+      is($MyLOG::SYSRESULT{status} >> 8, 4, "exit status by waitpid()");
+   }
+
+   MyLOG::flush_logs();
+   @lines = split(/\n/, take_file("$dir/cmdstats.$MYLOG{HOSTNAME}"));
+   is(scalar(@lines), 3, "a stats line per command");
+   @fields = split(/\t/, $lines[1]);
+   is(scalar(@fields), 12, "tab separated fields");
+   is($fields[2], "sh", "command name");
+   is($fields[3], 768, "status");
+   is($fields[11], "sh -c 'exit 3'", "command");
+
+   open(my $fh, ">", "$dir/cmdstats.other");
+   print $fh join("\t", time, 1, "tar", 0, "", 2, 1.5, 0.5, 2000, 10, 20, "tar -cf x.tar x") . "\n";
+   print $fh join("\t", time, 2, "tar", 512, "", 4, 0.5, 0.5, 3000, 10, 20, "tar -cf y.tar y") . "\n";
+   print $fh join("\t", time - 7200, 3, "hsi", 0, "T", 9, 1, 1, 100, 0, 0, "hsi ls") . "\n";
+   close($fh);
+   $report = report_command_stats(undef, time - 3600);
+   like($report, qr/^Command\s+Runs\s+Fails\s+Wall/, "report header");
+   like($report, qr/^tar\s+2\s+1\s+6\.000\s+3\.000\s+4\.000\s+2\.000\s+1\.000\s+3000\s+20\s+40$/m, "aggregated by command name");
+   unlike($report, qr/^hsi/m, "by time");
+   like(report_command_stats(["$dir/cmdstats.other"]), qr/^tar .*\nhsi\s+1\s+1\s/m, "in order of CPU time, timeout as failure");
+   unlink("$dir/cmdstats.other");
+};
+
+subtest "ssh socket directory" => sub {
+   my $dir = "$LOGDIR/myssh." . ($MYLOG{CURUID} ? $MYLOG{CURUID} : $<);
+
+   mkdir($dir, 0755);
+   chmod(0755, $dir);
+   is(MyLOG::ssh_socket_dir(), "", "refused with mode 0755");
+   chmod(0700, $dir);
+   is(MyLOG::ssh_socket_dir(), $dir, "used with mode 0700");
+};
+
+subtest "ssh master sessions" => sub {
+   local $MYLOG{SSHCMD} = make_fake_ssh();
+   local $MYLOG{SSHMUX} = 1;
+   my ($sock, $cmd);
+
+   $sock = MyLOG::ssh_session("hosta");
+   ok($sock && -S $sock, "master session started");
+   $cmd = get_remote_command("echo hi", "hosta");
+   like($cmd, qr/ -S \Q$sock\E hosta echo hi$/, "command through the control socket");
+   is(mysystem($cmd, 0, 16), "hi\n", "command run");
+   is(MyLOG::ssh_session("hosta"), $sock, "session reused");
+   close_ssh_sessions();
+   ok(!-e $sock, "master session stopped");
+   ok(!$MyLOG::SSHSESSIONS{hosta}, "session forgotten");
+};
+
+subtest "command made by the worker" => sub {
+   my @res = run_commands([[sub { "echo $$" }, 0, 16]]);
+
+   is($res[0]{status}, "success", "status");
+   like($res[0]{cmd}, qr/^echo \d+$/, "command made in the worker");
+   isnt($res[0]{ret}, "$$\n", "run in the worker");
+};
+
+subtest "ssh master sessions of the workers" => sub {
+   local $MYLOG{SSHCMD} = make_fake_ssh();
+   local $MYLOG{SSHMUX} = 1;
+   my (%res, @socks);
+
+   %res = run_on_hosts("echo hi", ["hostb", "hostc"], {logact => 0});
+   is(join(",", map {$res{$_}{status}} sort keys %res), "success,success", "run on hosts");
+   like($res{hostb}{cmd}, qr/ -S \S+ hostb echo hi$/, "through a master session");
+   @socks = map {$MyLOG::SSHSESSIONS{$_} ? $MyLOG::SSHSESSIONS{$_}{sock} : ""} ("hostb", "hostc");
+   ok(($socks[0] && -S $socks[0]) && ($socks[1] && -S $socks[1]), "sessions taken over from the workers");
+   close_ssh_sessions();
+   ok(!-e $socks[0] && !-e $socks[1], "sessions stopped by the parent");
+};
+
+subtest "command cache by directory and environment" => sub {
+   my ($dir, $ret);
+
+   $dir = Cwd::getcwd();
+   mkdir("$LOGDIR/$_") foreach ("d1", "d2");
+   open(my $fh, ">", "$LOGDIR/d1/one");
+   close($fh);
+   chdir("$LOGDIR/d1");
+   is(mysystem("ls", 0, 16|512), "one\n", "listed in d1");
+   chdir("$LOGDIR/d2");
+   is(mysystem("ls", 0, 16|512), "", "not the stale result of d1");
+   $MYLOG{SYSERR} = "x";
+   mysystem("ls", 0, 16|256|512);
+   mysystem("ls", 0, 16|256|512);
+   ok($MyLOG::SYSRESULT{cached} && defined $MYLOG{SYSERR}, "SYSERR defined on a hit");
+   {
+      local $ENV{PATH} = "/bin:/usr/bin:$LOGDIR";
+      mysystem("ls", 0, 16|256|512);
+      ok(!$MyLOG::SYSRESULT{cached}, "not cached for another PATH");
+   }
+   chdir($dir);
+};
+
+subtest "command cache expiry, invalidation and eviction" => sub {
+   local $MYLOG{CMDCACHEMAX} = 2;
+   my $file = "$LOGDIR/cached";
+   my $fh;
+
+   clear_command_cache();
+   open($fh, ">", $file);
+   print $fh "one\n";
+   close($fh);
+   is(mysystem("cat $file", 0, 16|512), "one\n", "first run");
+   mysystem("cat $file", 0, 16|512);
+   ok($MyLOG::SYSRESULT{cached}, "hit");
+   open($fh, ">", $file);
+   print $fh "two\n";
+   close($fh);
+   utime(undef, time + 10, $file);
+   is(mysystem("cat $file", 0, 16|512), "two\n", "rerun once the file is modified");
+   ok(!$MyLOG::SYSRESULT{cached}, "not a hit for the modified file");
+   {
+      local $MYLOG{CMDCACHETTL} = -1;
+      mysystem("cat $file", 0, 16|512);
+      ok(!$MyLOG::SYSRESULT{cached}, "not a hit once expired");
+   }
+   mysystem("echo a", 0, 16|512);
+   mysystem("echo b", 0, 16|512);
+   is(scalar(keys %{$MyLOG::CMDCACHE{entries}}), 2, "evicted to the max entries");
+   mysystem("echo a", 0, 16|512);
+   ok($MyLOG::SYSRESULT{cached}, "recently used result kept");
+   mysystem("cat $file", 0, 16|512);
+   ok(!$MyLOG::SYSRESULT{cached}, "least recently used result evicted");
+   clear_command_cache("^echo");
+   mysystem("echo a", 0, 16|512);
+   ok(!$MyLOG::SYSRESULT{cached}, "cleared by pattern");
+   clear_command_cache();
+   is($MyLOG::CMDCACHE{size}, 0, "all cleared");
+};
+
+done_testing();